@@ -2,9 +2,620 @@
 import numpy as np
 import pandas as pd
 import os
+import json
+import tempfile
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
 import alpaca_trade_api as tradeapi
 import datetime as dt
 import pytz
+from scipy.special import ndtri
+
+# Scrambled Sobol sequences need scipy.stats.qmc (scipy 1.7 or later), the other simulation options do not
+try:
+    from scipy.stats import qmc
+except ImportError:
+    qmc = None
+
+# Simulation used by the worker processes of a parallel run, set once per worker by _init_worker
+_worker_simulation = None
+
+def _init_worker(simulation):
+    global _worker_simulation
+    _worker_simulation = simulation
+
+def _simulate_block(seed_sequence, num_paths, start):
+    return _worker_simulation.simulate_block(seed_sequence, num_paths, start)
+
+def average_daily_returns(paths):
+    """
+    Returns the average simulated daily return of every path of paths, shape (rows, number of simulations).
+    It is the control variate of the final cumulative return: its expected value, the weighted mean of the stocks'
+    daily returns, is known without simulating.
+
+    """
+    return (paths[1:] / paths[:-1]).mean(axis=0) - 1
+
+def terminal_estimates(final_values, controls=None, control_mean=None, quantiles=(0.025, 0.975)):
+    """
+    Estimates the mean and the quantiles of the final cumulative returns.
+
+    Parameters
+    ----------
+    final_values: numpy.ndarray
+        Final cumulative return of every simulation
+    controls: numpy.ndarray
+        Control variate of every simulation, its average simulated daily return (see average_daily_returns). DEFAULT: None
+    control_mean: float
+        Known expected value of the control variate. When given with controls, the mean is the regression (control variate)
+        estimate, and the quantiles are read from the simulations reweighted by the regression weights, which give the
+        controls a weighted mean of control_mean. DEFAULT: None (plain estimates)
+    quantiles: tuple(float)
+        Quantiles to estimate. DEFAULT: the 95% confidence interval bounds
+
+    Returns a pandas.Series indexed by "mean" followed by the quantiles.
+    """
+    final_values = np.asarray(final_values, dtype=float)
+    index = ["mean"] + list(quantiles)
+    if controls is None or control_mean is None:
+        return pd.Series([final_values.mean()] + list(np.quantile(final_values, quantiles)), index=index)
+    
+    controls = np.asarray(controls, dtype=float)
+    deviations = controls - controls.mean()
+    sum_of_squares = (deviations ** 2).sum()
+    if sum_of_squares == 0:
+        return pd.Series([final_values.mean()] + list(np.quantile(final_values, quantiles)), index=index)
+    
+    # Regress the final values on the controls and correct the mean by the controls' deviation from their known mean
+    slope = (deviations * (final_values - final_values.mean())).sum() / sum_of_squares
+    mean = final_values.mean() - slope * (controls.mean() - control_mean)
+    
+    # The regression weights can be negative for controls far out in the tails, they are clipped so the weighted
+    # distribution function stays non decreasing before it is inverted
+    weights = np.clip(1 / len(final_values) - (controls.mean() - control_mean) * deviations / sum_of_squares, 0, None)
+    order = np.argsort(final_values)
+    cumulative_weights = np.cumsum(weights[order]) / weights.sum()
+    positions = np.minimum(np.searchsorted(cumulative_weights, quantiles), len(final_values) - 1)
+    return pd.Series([mean] + list(final_values[order][positions]), index=index)
+
+def mean_standard_error(final_values, units, controls=None, control_mean=None):
+    """
+    Estimates the standard error of the mean of terminal_estimates from the residuals of the control variate regression
+    (the final values themselves without control), averaged over the independent units of the simulation.
+
+    Parameters
+    ----------
+    final_values, units:
+        As for bootstrap_standard_errors
+    controls, control_mean:
+        As for terminal_estimates
+
+    Returns a float, NaN with fewer than two units.
+    """
+    residuals = np.asarray(final_values, dtype=float)
+    if controls is not None and control_mean is not None:
+        deviations = np.asarray(controls, dtype=float) - np.mean(controls)
+        sum_of_squares = (deviations ** 2).sum()
+        if sum_of_squares > 0:
+            residuals = residuals - (deviations * (residuals - residuals.mean())).sum() / sum_of_squares * deviations
+    unit_numbers, unit_sizes = np.unique(units, return_inverse=True, return_counts=True)[1:]
+    if len(unit_sizes) < 2:
+        return np.nan
+    unit_means = np.bincount(unit_numbers, weights=residuals) / unit_sizes
+    return unit_means.std(ddof=1) / np.sqrt(len(unit_sizes))
+
+def bootstrap_standard_errors(final_values, units, controls=None, control_mean=None, quantiles=(0.025, 0.975),
+                              num_resamples=200, seed=0):
+    """
+    Estimates the standard errors of terminal_estimates: the mean's from the control regression residuals
+    (see mean_standard_error), the quantiles' by resampling the independent units of the simulation.
+
+    Parameters
+    ----------
+    final_values: numpy.ndarray
+        Final cumulative return of every simulation
+    units: numpy.ndarray
+        Independent unit of every simulation: the simulation itself, its antithetic pair or its Sobol scramble.
+        Simulations of the same unit are resampled together
+    controls, control_mean, quantiles:
+        As for terminal_estimates
+    num_resamples: int
+        Number of bootstrap resamples. DEFAULT: 200
+    seed: int
+        Seed of the resampling. DEFAULT: 0
+
+    Returns a pandas.Series of standard errors indexed like terminal_estimates, NaN with fewer than two units.
+    """
+    final_values = np.asarray(final_values, dtype=float)
+    controls = None if controls is None else np.asarray(controls, dtype=float)
+    order = np.argsort(units, kind="stable")
+    unit_sizes = np.unique(units, return_counts=True)[1]
+    unit_starts = np.cumsum(unit_sizes) - unit_sizes
+    num_units = len(unit_sizes)
+    if num_units < 2:
+        return pd.Series(np.nan, index=["mean"] + list(quantiles))
+    
+    rng = np.random.default_rng(seed)
+    estimates = []
+    for _ in range(num_resamples):
+        # Gather every simulation of the drawn units in one fancy-indexing step
+        drawn = rng.integers(0, num_units, num_units)
+        sizes = unit_sizes[drawn]
+        offsets = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        resample = order[np.repeat(unit_starts[drawn], sizes) + offsets]
+        estimates.append(terminal_estimates(final_values[resample], None if controls is None else controls[resample],
+                                            control_mean, quantiles))
+    standard_errors = pd.DataFrame(estimates).std()
+    standard_errors["mean"] = mean_standard_error(final_values, units, controls, control_mean)
+    return standard_errors
+
+def batch_standard_errors(batch_estimates):
+    """
+    Estimates the standard errors of terminal_estimates by batch means: the standard deviation of the estimates of
+    independent batches of simulations of equal size, divided by the square root of the number of batches.
+
+    Parameters
+    ----------
+    batch_estimates: list(pandas.Series)
+        terminal_estimates of every batch
+
+    Returns a pandas.Series of standard errors indexed like terminal_estimates, NaN with fewer than two batches.
+    """
+    batch_estimates = pd.DataFrame(batch_estimates)
+    return batch_estimates.std() / np.sqrt(len(batch_estimates))
+
+class QuantileSketch:
+    """
+    A mergeable sketch of per-row quantiles (one row per trading day).
+
+    Values are folded in chunk by chunk and compressed into a fixed number of weighted centroids per row, so
+    memory does not grow with the number of simulations. Centroids are finer in the tails, which keeps the
+    2.5% and 97.5% bands accurate.
+
+    Attributes
+    ----------
+    compression: int
+        maximum number of centroids kept per row
+    centroids: numpy.ndarray
+        centroid values, shape (rows, centroids)
+    centroid_weights: numpy.ndarray
+        number of values represented by each centroid, shape (rows, centroids)
+
+    """
+
+    def __init__(self, num_rows, compression=300):
+        """
+        Constructs an empty sketch.
+
+        Parameters
+        ----------
+        num_rows: int
+            Number of rows (trading days) tracked by the sketch
+        compression: int
+            Maximum number of centroids kept per row. DEFAULT: 300
+        """
+        self.compression = compression
+        self.centroids = np.empty((num_rows, 0))
+        self.centroid_weights = np.empty((num_rows, 0))
+
+    def update(self, values):
+        """
+        Folds a chunk of values, shape (rows, number of values), into the sketch.
+
+        """
+        self._add(values, np.ones(values.shape))
+
+    def merge(self, other):
+        """
+        Folds another QuantileSketch with the same number of rows into this sketch.
+
+        """
+        self._add(other.centroids, other.centroid_weights)
+
+    def _add(self, values, weights):
+        values = np.concatenate([self.centroids, values], axis=1)
+        weights = np.concatenate([self.centroid_weights, weights], axis=1)
+
+        # Sort each row by value, empty centroids carry no weight and do not matter
+        order = np.argsort(values, axis=1)
+        values = np.take_along_axis(values, order, axis=1)
+        weights = np.take_along_axis(weights, order, axis=1)
+
+        # Keep the values exactly while they fit
+        if values.shape[1] <= self.compression:
+            self.centroids, self.centroid_weights = values, weights
+            return
+
+        # Assign each value to a centroid using the arcsine scale of its quantile, which gives the tails
+        # smaller centroids than the middle of the distribution
+        num_rows = values.shape[0]
+        cumulative_weights = np.cumsum(weights, axis=1)
+        quantiles = (cumulative_weights - weights / 2) / cumulative_weights[:, -1:]
+        groups = np.floor(self.compression * (np.arcsin(2 * quantiles - 1) / np.pi + 0.5)).astype(int)
+        groups = np.clip(groups, 0, self.compression - 1) + self.compression * np.arange(num_rows)[:, None]
+
+        # Weighted mean of the values falling in each centroid, all rows at once
+        size = num_rows * self.compression
+        group_weights = np.bincount(groups.ravel(), weights=weights.ravel(), minlength=size)
+        group_sums = np.bincount(groups.ravel(), weights=(weights * np.nan_to_num(values)).ravel(), minlength=size)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            group_values = np.where(group_weights > 0, group_sums / group_weights, np.inf)
+        self.centroids = group_values.reshape(num_rows, self.compression)
+        self.centroid_weights = group_weights.reshape(num_rows, self.compression)
+
+    def quantile(self, q):
+        """
+        Returns the q-th quantile of every row, interpolated linearly like pandas.Series.quantile.
+
+        """
+        result = np.empty(self.centroids.shape[0])
+        for row, (values, weights) in enumerate(zip(self.centroids, self.centroid_weights)):
+            keep = weights > 0
+            values, weights = values[keep], weights[keep]
+            # Centroids sit at the middle of the mass they represent, targets are in the same units
+            positions = np.cumsum(weights) - weights / 2
+            target = q * (weights.sum() - 1) + 0.5
+            result[row] = np.interp(target, positions, values)
+        return result
+
+class StreamingSummary:
+    """
+    Running per-day statistics of simulated cumulative returns, folded in one chunk of simulations at a time.
+
+    Attributes
+    ----------
+    count: int
+        number of simulations folded into the summary
+    mean: numpy.ndarray
+        per-day mean of the simulations
+    m2: numpy.ndarray
+        per-day sum of squared deviations from the mean
+    min: numpy.ndarray
+        per-day minimum of the simulations
+    max: numpy.ndarray
+        per-day maximum of the simulations
+    sketch: QuantileSketch
+        per-day quantile sketch used for the median, quartiles and confidence interval
+    control_average: float
+        mean of the control variate (average simulated daily return) of the simulations
+    control_m2: float
+        sum of squared deviations of the control variate from its mean
+    control_comoment: float
+        sum of the products of the deviations of the control variate and of the final cumulative return from their means
+    batch_count: int
+        number of chunks (batches) folded into the summary
+    batch_mean: numpy.ndarray
+        mean over the chunks of their own terminal_estimates (mean, 2.5% and 97.5% final quantiles)
+    batch_m2: numpy.ndarray
+        sum of squared deviations of the chunks' terminal_estimates from their mean
+
+    Every attribute has a fixed size, so memory does not grow with the number of simulations.
+
+    """
+
+    def __init__(self, num_rows, compression=300):
+        """
+        Constructs an empty summary.
+
+        Parameters
+        ----------
+        num_rows: int
+            Number of rows (trading days, including the starting day) to summarize
+        compression: int
+            Maximum number of centroids kept per row by the quantile sketch. DEFAULT: 300
+        """
+        self.count = 0
+        self.mean = np.zeros(num_rows)
+        self.m2 = np.zeros(num_rows)
+        self.min = np.full(num_rows, np.inf)
+        self.max = np.full(num_rows, -np.inf)
+        self.sketch = QuantileSketch(num_rows, compression)
+        self.control_average = 0.0
+        self.control_m2 = 0.0
+        self.control_comoment = 0.0
+        self.batch_count = 0
+        self.batch_mean = np.zeros(3)
+        self.batch_m2 = np.zeros(3)
+
+    def update(self, paths, control_mean=None):
+        """
+        Folds a chunk of simulated cumulative returns, shape (rows, number of simulations), into the summary.
+        The chunk is one batch of the batch means standard errors. control_mean is the known expected value of the
+        control variate, if it is used (see terminal_estimates).
+
+        """
+        chunk = StreamingSummary(paths.shape[0], self.sketch.compression)
+        chunk.count = paths.shape[1]
+        chunk.mean = paths.mean(axis=1)
+        chunk.m2 = ((paths - chunk.mean[:, None]) ** 2).sum(axis=1)
+        chunk.min = paths.min(axis=1)
+        chunk.max = paths.max(axis=1)
+        chunk.sketch.update(paths)
+        controls = None
+        if control_mean is not None:
+            controls = average_daily_returns(paths)
+            chunk.control_average = controls.mean()
+            chunk.control_m2 = ((controls - chunk.control_average) ** 2).sum()
+            chunk.control_comoment = ((controls - chunk.control_average) * (paths[-1] - chunk.mean[-1])).sum()
+        chunk.batch_count = 1
+        chunk.batch_mean = terminal_estimates(paths[-1], controls, control_mean).values
+        self.merge(chunk)
+
+    def merge(self, other):
+        """
+        Folds another StreamingSummary with the same number of rows into this summary.
+
+        """
+        # Combine the means, squared deviations and co-moments with the parallel variance formula
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        control_delta = other.control_average - self.control_average
+        self.control_comoment += other.control_comoment + control_delta * delta[-1] * self.count * other.count / count
+        self.control_m2 += other.control_m2 + control_delta ** 2 * self.count * other.count / count
+        self.control_average += control_delta * other.count / count
+        self.mean = self.mean + delta * other.count / count
+        self.m2 = self.m2 + other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        self.sketch.merge(other.sketch)
+        
+        # The chunks' estimates are combined the same way, one batch per chunk
+        batch_count = self.batch_count + other.batch_count
+        batch_delta = other.batch_mean - self.batch_mean
+        self.batch_mean = self.batch_mean + batch_delta * other.batch_count / batch_count
+        self.batch_m2 = self.batch_m2 + other.batch_m2 + batch_delta ** 2 * self.batch_count * other.batch_count / batch_count
+        self.batch_count = batch_count
+
+    def std(self):
+        """
+        Returns the per-day sample standard deviation.
+
+        """
+        return np.sqrt(self.m2 / (self.count - 1))
+
+    def final_estimates(self, control_mean=None):
+        """
+        Returns the mean and the 95% confidence interval bounds of the final cumulative returns, indexed like
+        terminal_estimates. The mean is the control variate estimate when control_mean is given, the bounds are read
+        from the quantile sketch.
+
+        """
+        mean = self.mean[-1]
+        if control_mean is not None and self.control_m2 > 0:
+            mean -= self.control_comoment / self.control_m2 * (self.control_average - control_mean)
+        return pd.Series([mean, self.sketch.quantile(0.025)[-1], self.sketch.quantile(0.975)[-1]],
+                         index=["mean", 0.025, 0.975])
+
+    def batch_standard_errors(self):
+        """
+        Returns the batch means standard errors of final_estimates: the standard deviation of the chunks' own estimates
+        divided by the square root of the number of chunks, NaN with fewer than two chunks.
+        Chunks are independent (a chunk holds whole antithetic pairs and its own Sobol scramble) and of equal size
+        but for the last one.
+
+        """
+        if self.batch_count < 2:
+            return pd.Series(np.nan, index=["mean", 0.025, 0.975])
+        return pd.Series(np.sqrt(self.batch_m2 / (self.batch_count - 1) / self.batch_count), index=["mean", 0.025, 0.975])
+
+    def daily_statistics(self):
+        """
+        Returns the per-day mean, median, min and max as a DataFrame indexed by trading day.
+
+        """
+        return pd.DataFrame({
+            "mean": self.mean,
+            "median": self.sketch.quantile(0.5),
+            "min": self.min,
+            "max": self.max
+        })
+
+    def describe_final(self):
+        """
+        Returns the same statistics as pandas.Series.describe for the final cumulative returns.
+
+        """
+        last_row = len(self.mean) - 1
+        return pd.Series([self.count,
+                          self.mean[-1],
+                          self.std()[-1],
+                          self.min[-1],
+                          self.sketch.quantile(0.25)[-1],
+                          self.sketch.quantile(0.5)[-1],
+                          self.sketch.quantile(0.75)[-1],
+                          self.max[-1]],
+                         index=["count", "mean", "std", "min", "25%", "50%", "75%", "max"],
+                         name=last_row)
+
+class PathStore:
+    """
+    Simulated cumulative return paths kept on disk in a memory-mapped .npy file, with a json metadata file beside it.
+
+    Rows are trading days (the first row is the starting value of 1) and columns are simulations, the same layout as
+    MCSimulation.simulated_return. Each chunk of simulations is written straight into its own columns of the file,
+    and statistics are calculated a block of trading days at a time, so the paths never have to fit in memory.
+
+    Attributes
+    ----------
+    path_file: str
+        .npy file holding the paths
+    metadata_file: str
+        json file holding the metadata of the simulation
+    metadata: dict
+        shape, dtype and parameters of the simulation, and whether every path has been written
+    paths: numpy.memmap
+        the paths, shape (trading days + 1, simulations), mapped from path_file when first used
+
+    """
+
+    def __init__(self, path_file, metadata, mode="r"):
+        """
+        Wraps an existing path file, use PathStore.create or PathStore.open to get one.
+
+        Parameters
+        ----------
+        path_file: str
+            .npy file holding the paths
+        metadata: dict
+            Metadata of the simulation, as saved in the metadata file
+        mode: str
+            Mode the file is mapped with, "r" to read it or "r+" to write paths into it. DEFAULT: "r"
+        """
+        self.path_file = path_file
+        self.metadata_file = os.path.splitext(path_file)[0] + ".json"
+        self.metadata = metadata
+        self.mode = mode
+        self._paths = None
+
+    @classmethod
+    def create(cls, path_file, num_rows, num_simulation, dtype="float32", **metadata):
+        """
+        Creates the path file, sized for every simulation, and its metadata file.
+
+        Parameters
+        ----------
+        path_file: str
+            .npy file to create, an existing file is replaced
+        num_rows: int
+            Number of rows (trading days, including the starting day)
+        num_simulation: int
+            Number of simulations
+        dtype: str
+            "float32" halves the size of the file, "float64" keeps the full precision of the simulation. DEFAULT: "float32"
+        metadata:
+            Parameters of the simulation saved in the metadata file
+        """
+        if np.dtype(dtype) not in [np.dtype("float32"), np.dtype("float64")]:
+            raise AttributeError(f"Paths can be stored as float32 or float64, not '{dtype}'.")
+        paths = np.lib.format.open_memmap(path_file, mode="w+", dtype=dtype, shape=(num_rows, num_simulation))
+        del paths
+        store = cls(path_file, dict(metadata, shape=[num_rows, num_simulation], dtype=np.dtype(dtype).name,
+                                    layout="rows are trading days starting at 1, columns are simulations",
+                                    created=dt.datetime.now().isoformat(timespec="seconds"), complete=False),
+                    mode="r+")
+        store.write_metadata()
+        return store
+
+    @classmethod
+    def open(cls, path_file):
+        """
+        Opens a path file written by a simulation, read only. The paths are mapped, not read, so opening is zero-copy.
+
+        """
+        with open(os.path.splitext(path_file)[0] + ".json") as file:
+            metadata = json.load(file)
+        if not metadata.get("complete", False):
+            raise AttributeError(f"The simulation writing {path_file} did not finish.")
+        return cls(path_file, metadata)
+
+    @property
+    def paths(self):
+        # Mapped on first use, so the store can be sent to worker processes without its contents
+        if self._paths is None:
+            self._paths = np.load(self.path_file, mmap_mode=self.mode)
+        return self._paths
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_paths"] = None
+        return state
+
+    @property
+    def num_rows(self):
+        return self.metadata["shape"][0]
+
+    @property
+    def num_simulation(self):
+        return self.metadata["shape"][1]
+
+    def write(self, start, paths):
+        """
+        Writes a chunk of paths, shape (rows, number of simulations), into the columns beginning at start.
+
+        """
+        self.paths[:, start:start + paths.shape[1]] = paths
+
+    def finish(self):
+        """
+        Flushes the paths to disk and marks the simulation complete in the metadata file.
+
+        """
+        self.paths.flush()
+        self.metadata["complete"] = True
+        self.write_metadata()
+
+    def write_metadata(self):
+        # Replace the metadata file atomically, so it never describes half written metadata
+        directory = os.path.dirname(os.path.abspath(self.metadata_file))
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=directory, suffix=".json.tmp")
+        try:
+            with os.fdopen(file_descriptor, "w") as file:
+                json.dump(self.metadata, file, indent=2, default=str)
+            os.replace(temporary_path, self.metadata_file)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+    def row_blocks(self, max_block_bytes=64 * 2**20):
+        """
+        Yields the start row and the float64 values of consecutive blocks of rows, each block at most max_block_bytes.
+
+        """
+        block_rows = max(1, max_block_bytes // (8 * self.num_simulation))
+        for start in range(0, self.num_rows, block_rows):
+            yield start, np.asarray(self.paths[start:start + block_rows], dtype=float)
+
+    def final_values(self):
+        """
+        Returns the final cumulative return of every simulation, read from the last row only.
+
+        """
+        return pd.Series(np.asarray(self.paths[-1], dtype=float), name=self.num_rows - 1)
+
+    def sample_paths(self, max_paths=1000, max_block_bytes=64 * 2**20):
+        """
+        Returns at most max_paths simulations, evenly strided over the file, as a DataFrame with their simulation
+        numbers as columns. Only the sampled columns of each block of trading days are read into memory.
+
+        """
+        columns = np.arange(0, self.num_simulation, -(-self.num_simulation // max_paths))
+        block_rows = max(1, max_block_bytes // (self.paths.dtype.itemsize * self.num_simulation))
+        sample = np.empty((self.num_rows, len(columns)))
+        for start in range(0, self.num_rows, block_rows):
+            sample[start:start + block_rows] = self.paths[start:start + block_rows, columns]
+        return pd.DataFrame(sample, columns=columns)
+
+    def average_daily_returns(self, max_block_bytes=64 * 2**20):
+        """
+        Returns the average simulated daily return of every simulation (see average_daily_returns), reading the file
+        a block of trading days at a time.
+
+        """
+        total = np.zeros(self.num_simulation)
+        previous = None
+        for start, block in self.row_blocks(max_block_bytes):
+            # Each block carries the last row of the one before it, so the return into its first row is counted
+            if previous is not None:
+                block = np.concatenate([previous, block])
+            total += (block[1:] / block[:-1]).sum(axis=0)
+            previous = block[-1:]
+        return total / (self.num_rows - 1) - 1
+
+    def daily_statistics(self, max_block_bytes=64 * 2**20):
+        """
+        Returns the per-day mean, median, min and max as a DataFrame indexed by trading day, reading the file
+        a block of trading days at a time.
+
+        """
+        blocks = [pd.DataFrame({"mean": block.mean(axis=1),
+                                "median": np.median(block, axis=1),
+                                "min": block.min(axis=1),
+                                "max": block.max(axis=1)},
+                               index=pd.RangeIndex(start, start + len(block)))
+                  for start, block in self.row_blocks(max_block_bytes)]
+        return pd.concat(blocks)
+
 
 class MCSimulation:
     """
@@ -19,17 +630,64 @@ class MCSimulation:
     weights: list(float)
         portfolio investment breakdown
     nSim: int
-        number of samples in simulation
+        number of samples in simulation, in adaptive mode the number the last run stopped at
+    initial_simulation: int
+        number of samples requested, in adaptive mode the first batch of a run
     nTrading: int
         number of trading days to simulate
     simulated_return : pandas.DataFrame
         Simulated data from Monte Carlo
     confidence_interval : pandas.Series
         the 95% confidence intervals for simulated final cumulative returns
+    vectorized: bool
+        whether to use the vectorized path generator instead of the original per-step loop
+    seed: int
+        seed from which the random streams of the vectorized path generator are spawned
+    streaming: bool
+        whether simulations are folded into running per-day statistics instead of being stored
+    chunk_size: int
+        number of simulations generated at once, each chunk with its own random stream
+    n_workers: int
+        number of worker processes running the chunks
+    method: str
+        how daily returns are simulated: "gaussian", "stationary_bootstrap" or "circular_bootstrap"
+    block_size: int
+        mean (stationary) or fixed (circular) length in days of the resampled historical blocks
+    historical_returns : numpy.ndarray
+        contiguous array of the historical daily returns, one row per day and one column per stock
+    streamed_summary : StreamingSummary
+        running per-day statistics of the simulations, set in streaming mode
+    path_file: str
+        .npy file the paths are written to instead of being kept in memory
+    path_dtype: str
+        dtype of the paths in path_file, "float32" or "float64"
+    path_store : PathStore
+        the memory-mapped paths, set when path_file is given or the simulation is reopened with from_path_file
+    variance_reduction: list(str)
+        variance reduction schemes of the gaussian path generator: "antithetic", "sobol" and/or "control_variate"
+    control_mean: float
+        known expected portfolio daily return, the expected value of the control variate with "control_variate"
+    final_values : numpy.ndarray
+        final cumulative return of every simulation, in simulation order. Not kept in streaming mode
+    controls : numpy.ndarray
+        control variate (average simulated daily return) of every simulation with "control_variate". Not kept in streaming mode
+    target_half_width: float
+        target half-width of the 95% intervals of the 2.5% and 97.5% final quantiles in adaptive mode
+    target_mean_half_width: float
+        target half-width of the 95% interval of the final mean in adaptive mode
+    max_simulation: int
+        path budget of adaptive mode
+    precision_method: str
+        how adaptive mode estimates the precision: "batch_means" or "order_statistic"
+    precision : pandas.DataFrame
+        estimates, achieved and target half-widths, and paths used, set by an adaptive run
         
     """
     
-    def __init__(self, portfolio_data, weights="", num_simulation=1000, num_trading_days=252):
+    def __init__(self, portfolio_data, weights="", num_simulation=1000, num_trading_days=252, vectorized=True, seed=None,
+                 streaming=False, chunk_size=1000, n_workers=1, method="gaussian", block_size=21,
+                 path_file=None, path_dtype="float32", variance_reduction=None,
+                 target_half_width=None, target_mean_half_width=None, max_simulation=100000, precision_method="batch_means"):
         """
         Constructs all the necessary attributes for the MCSimulation object.
 
@@ -43,6 +701,46 @@ class MCSimulation:
             Number of simulation samples. DEFAULT: 1000 simulation samples
         num_trading_days: int
             Number of trading days to simulate. DEFAULT: 252 days (1 year of business days)
+        vectorized: bool
+            Generate all simulations at once with NumPy. Set to False to run the original loop, e.g. for parity testing. DEFAULT: True
+        seed: int
+            Seed of the numpy.random.SeedSequence that spawns one random stream per chunk of simulations.
+            Results for a given seed do not depend on n_workers. DEFAULT: None (fresh entropy)
+        streaming: bool
+            Generate the simulations in chunks and keep only running per-day statistics, so memory does not grow with num_simulation. DEFAULT: False
+        chunk_size: int
+            Number of simulations generated at once. DEFAULT: 1000
+        n_workers: int
+            Number of processes to spread the chunks over. None uses every CPU. DEFAULT: 1 (run in this process)
+        method: str
+            "gaussian" draws independent normal returns per stock from their historical mean and standard deviation.
+            "stationary_bootstrap" and "circular_bootstrap" resample whole historical days (all stocks together) in blocks,
+            keeping cross-asset correlation and fat tails. DEFAULT: "gaussian"
+        block_size: int
+            Mean block length in days for the stationary bootstrap, fixed block length for the circular bootstrap. DEFAULT: 21
+        path_file: str
+            Write every path, one chunk at a time, to this memory-mapped .npy file (with a .json metadata file beside it)
+            instead of keeping them in memory. Statistics and plots then read the file in blocks. DEFAULT: None (keep the paths in memory)
+        path_dtype: str
+            "float32" or "float64", dtype of the paths written to path_file. DEFAULT: "float32"
+        variance_reduction: str or list(str)
+            Variance reduction schemes of the "gaussian" method, to reach the same confidence interval precision with fewer paths.
+            "antithetic" pairs every draw with its mirror image. "sobol" maps a scrambled Sobol sequence through the inverse
+            normal distribution, one scramble per chunk (use power of two chunk sizes, and several chunks for standard errors).
+            "control_variate" regresses the final cumulative return on each path's average simulated daily return, whose
+            expected value (the weighted mean of the stocks' daily returns) is known, it can be combined with either. See standard_error for the precision achieved. DEFAULT: None (plain pseudo-random draws)
+        target_half_width: float
+            Run adaptively: after the first num_simulation paths keep adding chunks of simulations until the 95% intervals
+            of the 2.5% and 97.5% final quantiles have at most this half-width, or max_simulation is reached. DEFAULT: None
+        target_mean_half_width: float
+            Run adaptively until the 95% interval of the final mean has at most this half-width, alone or with target_half_width. DEFAULT: None
+        max_simulation: int
+            Path budget of an adaptive run. DEFAULT: 100000
+        precision_method: str
+            "batch_means" compares the estimates of the independent chunks of simulations (see batch_standard_errors), it is
+            the only method in streaming mode. "order_statistic" uses
+            distribution free order statistic intervals for the quantiles and the normal interval for the mean, it is
+            cheaper but needs plain independent draws. DEFAULT: "batch_means"
         """
         
         # Check to make sure that all attributes are set
@@ -57,6 +755,41 @@ class MCSimulation:
             if round(sum(weights),2) < .99:
                 raise AttributeError("Sum of portfolio weights must equal one.")
         
+        # Make sure the simulation method is known and can be run
+        if method not in ["gaussian", "stationary_bootstrap", "circular_bootstrap"]:
+            raise AttributeError(f"Unknown simulation method '{method}'.")
+        if method != "gaussian" and not vectorized:
+            raise AttributeError("Bootstrap simulation methods require vectorized=True.")
+        if path_file is not None and (streaming or not vectorized):
+            raise AttributeError("Writing the paths to path_file requires streaming=False and vectorized=True.")
+        
+        # Make sure the variance reduction schemes are known and fit the simulation method
+        if variance_reduction is None:
+            variance_reduction = []
+        elif isinstance(variance_reduction, str):
+            variance_reduction = [variance_reduction]
+        variance_reduction = list(variance_reduction)
+        for scheme in variance_reduction:
+            if scheme not in ["antithetic", "sobol", "control_variate"]:
+                raise AttributeError(f"Unknown variance reduction scheme '{scheme}'.")
+        if len(variance_reduction) > 0 and (method != "gaussian" or not vectorized):
+            raise AttributeError("Variance reduction requires method='gaussian' and vectorized=True.")
+        if "antithetic" in variance_reduction and "sobol" in variance_reduction:
+            raise AttributeError("Antithetic and Sobol draws cannot be combined.")
+        if "sobol" in variance_reduction and qmc is None:
+            raise AttributeError("Sobol draws require scipy.stats.qmc (scipy 1.7 or later).")
+        
+        # Make sure an adaptive run can be carried out
+        if precision_method not in ["batch_means", "order_statistic"]:
+            raise AttributeError(f"Unknown precision method '{precision_method}'.")
+        if target_half_width is not None or target_mean_half_width is not None:
+            if not vectorized or path_file is not None:
+                raise AttributeError("Adaptive runs require vectorized=True and no path_file, the number of paths is not known in advance.")
+            if precision_method == "order_statistic" and len(variance_reduction) > 0:
+                raise AttributeError("Order statistic precision needs plain independent draws, use precision_method='batch_means'.")
+            if precision_method == "order_statistic" and streaming:
+                raise AttributeError("Order statistic precision needs every final value, streaming runs use precision_method='batch_means'.")
+        
         # Calculate daily return if not within dataframe
         if not "daily_return" in portfolio_data.columns.get_level_values(1).unique():
             close_df = portfolio_data.xs('close',level=1,axis=1).pct_change()
@@ -69,15 +802,452 @@ class MCSimulation:
         self.portfolio_data = portfolio_data
         self.weights = weights
         self.nSim = num_simulation
+        self.initial_simulation = num_simulation
         self.nTrading = num_trading_days
+        self.vectorized = vectorized
+        self.seed = seed
+        self.streaming = streaming
+        self.chunk_size = chunk_size
+        self.n_workers = n_workers if n_workers is not None else os.cpu_count()
+        self.method = method
+        self.block_size = block_size
+        self.historical_returns = np.ascontiguousarray(portfolio_data.xs('daily_return',level=1,axis=1).dropna().values)
         self.simulated_return = ""
+        self.streamed_summary = None
+        self.path_file = path_file
+        self.path_dtype = path_dtype
+        self.path_store = None
+        self.variance_reduction = variance_reduction
+        self.final_values = None
+        self.controls = None
+        self.target_half_width = target_half_width
+        self.target_mean_half_width = target_mean_half_width
+        self.max_simulation = max_simulation
+        self.precision_method = precision_method
+        self.precision = None
+        
+        # Every simulated daily return is drawn around the stocks' mean returns, so the expected portfolio daily return
+        # is known and serves as the mean of the control variate
+        self.control_mean = None
+        if "control_variate" in variance_reduction:
+            mean_returns = portfolio_data.xs('daily_return',level=1,axis=1).mean().values
+            self.control_mean = float(mean_returns @ np.asarray(weights, dtype=float))
         
+    @classmethod
+    def from_path_file(cls, path_file):
+        """
+        Reopens a simulation whose paths were written to path_file, without reading them.
+        Statistics, summaries and plots are available, running the simulation again is not.
+
+        """
+        store = PathStore.open(path_file)
+        simulation = cls.__new__(cls)
+        simulation.portfolio_data = None
+        simulation.historical_returns = None
+        simulation.weights = store.metadata["weights"]
+        simulation.nSim = store.num_simulation
+        simulation.initial_simulation = store.num_simulation
+        simulation.nTrading = store.num_rows - 1
+        simulation.vectorized = True
+        simulation.seed = store.metadata["seed"]
+        simulation.streaming = False
+        simulation.chunk_size = store.metadata["chunk_size"]
+        simulation.n_workers = 1
+        simulation.method = store.metadata["method"]
+        simulation.block_size = store.metadata["block_size"]
+        simulation.simulated_return = ""
+        simulation.streamed_summary = None
+        simulation.path_file = path_file
+        simulation.path_dtype = store.metadata["dtype"]
+        simulation.path_store = store
+        simulation.variance_reduction = store.metadata.get("variance_reduction", [])
+        simulation.control_mean = store.metadata.get("control_mean")
+        simulation.final_values = store.final_values().values
+        simulation.controls = None if simulation.control_mean is None else store.average_daily_returns()
+        simulation.target_half_width = None
+        simulation.target_mean_half_width = None
+        simulation.max_simulation = simulation.nSim
+        simulation.precision_method = "batch_means"
+        simulation.precision = None
+        simulation.confidence_interval = simulation.estimate_confidence_interval()
+        return simulation
+    
+    def chunk_sizes(self):
+        """
+        Returns the number of simulations of every chunk, in chunk order.
+
+        """
+        return [min(self.chunk_size, self.nSim - start) for start in range(0, self.nSim, self.chunk_size)]
+    
     def calc_cumulative_return(self):
         """
         Calculates the cumulative return of a stock over time using a Monte Carlo simulation (Brownian motion with drift).
 
         """
         
+        # Fall back to the original per-step loop if requested
+        if not self.vectorized:
+            return self.calc_cumulative_return_loop()
+        
+        # Split the simulations into chunks, each with an independent random stream spawned from the seed.
+        # The chunks are always combined in the same order, so results do not depend on the number of workers.
+        seed_sequence = np.random.SeedSequence(self.seed)
+        if self.target_half_width is not None or self.target_mean_half_width is not None:
+            return self.calc_cumulative_return_adaptive(seed_sequence)
+        chunk_sizes = self.chunk_sizes()
+        chunk_starts = list(range(0, self.nSim, self.chunk_size))
+        chunk_seeds = seed_sequence.spawn(len(chunk_sizes))
+        print(f"Running {self.nSim} Monte Carlo simulations in chunks of {self.chunk_size} on {self.n_workers} worker(s).")
+        
+        # Create the path file before the chunks run, each chunk then writes its own columns of it
+        if self.path_file is not None:
+            self.path_store = PathStore.create(self.path_file, self.nTrading + 1, self.nSim, self.path_dtype,
+                                               weights=list(self.weights), seed=self.seed, entropy=seed_sequence.entropy,
+                                               chunk_size=self.chunk_size, method=self.method, block_size=self.block_size,
+                                               variance_reduction=self.variance_reduction,
+                                               control_mean=self.control_mean,
+                                               tickers=list(self.portfolio_data.columns.get_level_values(0).unique()))
+        
+        if self.n_workers > 1:
+            with ProcessPoolExecutor(max_workers=self.n_workers, initializer=_init_worker, initargs=(self,)) as executor:
+                return self.combine_chunks(executor.map(_simulate_block, chunk_seeds, chunk_sizes, chunk_starts))
+        return self.combine_chunks(map(self.simulate_block, chunk_seeds, chunk_sizes, chunk_starts))
+    
+    def calc_cumulative_return_adaptive(self, seed_sequence):
+        """
+        Runs chunks of simulations in batches until the target precision is met or the path budget is spent.
+        Chunk seeds are spawned from seed_sequence one batch at a time, in the same order as a single run, so an adaptive
+        run stopping at n paths gives the same paths as a run of n paths with the same seed and chunk_size.
+        Only the new chunks of a batch are folded into the running result and the precision estimates.
+
+        """
+        
+        # Batches are whole chunks, so every chunk has chunk_size simulations
+        num_chunks = max(1, -(-self.initial_simulation // self.chunk_size))
+        max_chunks = max(num_chunks, self.max_simulation // self.chunk_size)
+        num_run = 0
+        
+        # Running result: the streamed summary, or the paths with their final values, controls and chunk estimates.
+        # The paths are laid out one simulation per row and grown in place batch by batch (realloc can extend the
+        # allocation without copying it), so they are held once, never next to a gathered copy.
+        summary = StreamingSummary(self.nTrading + 1) if self.streaming else None
+        paths = None if self.streaming else np.empty((0, self.nTrading + 1))
+        final_values, controls, batch_estimates = [], [], []
+        self.streamed_summary = None
+        
+        with contextlib.ExitStack() as stack:
+            if self.n_workers > 1:
+                executor = stack.enter_context(ProcessPoolExecutor(max_workers=self.n_workers, initializer=_init_worker,
+                                                                   initargs=(self,)))
+                simulate = lambda seeds, sizes: executor.map(_simulate_block, seeds, sizes, [0] * len(sizes))
+            else:
+                simulate = lambda seeds, sizes: map(self.simulate_block, seeds, sizes, [0] * len(sizes))
+            
+            while True:
+                print(f"Running {num_chunks * self.chunk_size} more Monte Carlo simulations in chunks of {self.chunk_size} "
+                      f"on {self.n_workers} worker(s).")
+                if not self.streaming:
+                    # No view of paths is kept, so it can be resized without checking references
+                    paths.resize(((num_run + num_chunks) * self.chunk_size, self.nTrading + 1), refcheck=False)
+                for number, chunk in enumerate(simulate(seed_sequence.spawn(num_chunks), [self.chunk_size] * num_chunks)):
+                    if self.streaming:
+                        summary.merge(chunk)
+                        continue
+                    start = (num_run + number) * self.chunk_size
+                    paths[start:start + self.chunk_size] = chunk.T
+                    final_values.append(chunk[-1].copy())
+                    controls.append(None if self.control_mean is None else average_daily_returns(chunk))
+                    batch_estimates.append(terminal_estimates(chunk[-1], controls[-1], self.control_mean))
+                num_run += num_chunks
+                self.nSim = num_run * self.chunk_size
+                if self.streaming:
+                    self.streamed_summary = summary
+                else:
+                    self.final_values = np.concatenate(final_values)
+                    self.controls = None if self.control_mean is None else np.concatenate(controls)
+                self.precision = self.estimate_precision(batch_estimates)
+                if self.precision["met"].all() or num_run >= max_chunks:
+                    break
+                
+                # Half-widths shrink with the square root of the number of paths, ask for as many as the
+                # furthest target needs (doubling when the precision cannot be estimated yet), within the budget
+                ratios = (self.precision["half_width"] / self.precision["target"]).dropna()
+                growth = (ratios.max() ** 2 - 1) if len(ratios) == len(self.precision["target"].dropna()) else 1
+                num_chunks = int(min(max(np.ceil(num_run * growth), 1), max_chunks - num_run))
+        
+        # The transposed buffer is the layout pandas keeps a frame's values in, so the frame does not copy it
+        if self.streaming:
+            result = summary
+        else:
+            result = pd.DataFrame(paths.T, copy=False)
+            self.simulated_return = result
+        self.confidence_interval = self.estimate_confidence_interval()
+        outcome = "target precision met" if self.precision["met"].all() else f"path budget of {self.max_simulation} reached"
+        print(f"Stopped after {self.nSim} simulations, {outcome}.")
+        return result
+    
+    def estimate_precision(self, batch_estimates=None):
+        """
+        Estimates the half-widths of the 95% intervals of the final mean and confidence interval bounds, and compares them
+        with the targets of an adaptive run. Returns a DataFrame with the estimate, half_width, target, met and paths.
+        batch_estimates are the terminal_estimates of every chunk, used by the batch means method outside streaming mode.
+
+        """
+        estimates = self.terminal_estimates()
+        if self.streamed_summary is not None:
+            half_widths = 1.96 * self.streamed_summary.batch_standard_errors().values
+        elif self.precision_method == "order_statistic":
+            # Distribution free interval of each quantile between the order statistics n q -/+ 1.96 sqrt(n q (1 - q))
+            sorted_values = np.sort(self.final_values)
+            num_values = len(sorted_values)
+            half_widths = [1.96 * sorted_values.std(ddof=1) / np.sqrt(num_values)]
+            for q in [0.025, 0.975]:
+                spread = 1.96 * np.sqrt(num_values * q * (1 - q))
+                lower = int(np.clip(np.floor(num_values * q - spread), 0, num_values - 1))
+                upper = int(np.clip(np.ceil(num_values * q + spread), 0, num_values - 1))
+                half_widths.append((sorted_values[upper] - sorted_values[lower]) / 2)
+        else:
+            half_widths = 1.96 * batch_standard_errors(batch_estimates).values
+        targets = [self.target_mean_half_width, self.target_half_width, self.target_half_width]
+        precision = pd.DataFrame({"estimate": estimates.values,
+                                  "half_width": half_widths,
+                                  "target": [np.nan if target is None else target for target in targets]},
+                                 index=["mean", "95% CI Lower", "95% CI Upper"])
+        
+        # A bound without a target is met, one whose precision cannot be estimated is not
+        precision["met"] = precision["target"].isna() | (precision["half_width"] <= precision["target"])
+        precision["paths"] = self.streamed_summary.count if self.streamed_summary is not None else len(self.final_values)
+        return precision
+    
+    def combine_chunks(self, chunks):
+        """
+        Combines the results of simulate_block, in chunk order, into the simulated returns or the streamed summary.
+
+        """
+        
+        # In streaming mode fold each chunk's running statistics into the total, the paths are already discarded
+        if self.streaming:
+            summary = StreamingSummary(self.nTrading + 1)
+            for chunk in chunks:
+                summary.merge(chunk)
+            
+            # Set attribute to use in plotting and summaries
+            self.streamed_summary = summary
+            
+            # Calculate 95% confidence intervals for final cumulative returns
+            self.confidence_interval = self.estimate_confidence_interval()
+            return summary
+        
+        # With a path file every chunk is already written to it, only the final row is read back
+        if self.path_store is not None:
+            for chunk in chunks:
+                pass
+            self.path_store.finish()
+            self.final_values = self.path_store.final_values().values
+            if self.control_mean is not None:
+                self.controls = self.path_store.average_daily_returns()
+            
+            # Calculate 95% confidence intervals for final cumulative returns
+            self.confidence_interval = self.estimate_confidence_interval()
+            return self.path_store
+        
+        # Copy each chunk into its own columns as it arrives, so the paths are held once plus the chunk being copied
+        paths = np.empty((self.nTrading + 1, self.nSim))
+        controls = []
+        start = 0
+        for chunk in chunks:
+            paths[:, start:start + chunk.shape[1]] = chunk
+            if self.control_mean is not None:
+                controls.append(average_daily_returns(chunk))
+            start += chunk.shape[1]
+        portfolio_cumulative_returns = pd.DataFrame(paths, copy=False)
+        
+        # Set attribute to use in plotting
+        self.simulated_return = portfolio_cumulative_returns
+        self.final_values = paths[-1].copy()
+        self.controls = np.concatenate(controls) if self.control_mean is not None else None
+        
+        # Calculate 95% confidence intervals for final cumulative returns
+        self.confidence_interval = self.estimate_confidence_interval()
+        
+        return portfolio_cumulative_returns
+    
+    def estimate_confidence_interval(self):
+        """
+        Estimates the 95% confidence interval of the final cumulative returns, with the control variate if enabled.
+        In streaming mode the bounds are read from the quantile sketch of the final day.
+
+        """
+        estimates = self.terminal_estimates()
+        return pd.Series(estimates[[0.025, 0.975]].values, index=[0.025, 0.975], name=self.nTrading)
+    
+    def terminal_estimates(self):
+        """
+        Returns the mean and the 95% confidence interval bounds of the final cumulative returns (see terminal_estimates),
+        from the streamed summary in streaming mode.
+
+        """
+        if self.streamed_summary is not None:
+            return self.streamed_summary.final_estimates(self.control_mean)
+        return terminal_estimates(self.final_values, self.controls, self.control_mean)
+    
+    def independent_units(self):
+        """
+        Returns the independent unit of every simulation for bootstrap_standard_errors: its antithetic pair,
+        its Sobol scramble (the chunk) or the simulation itself.
+
+        """
+        if "sobol" in self.variance_reduction:
+            return np.repeat(np.arange(len(self.chunk_sizes())), self.chunk_sizes())
+        if "antithetic" in self.variance_reduction:
+            # A chunk holds its draws followed by their mirror images, the pairs of every chunk are numbered after
+            # those of the chunks before it
+            units, first_pair = [], 0
+            for size in self.chunk_sizes():
+                num_pairs = (size + 1) // 2
+                units.append(first_pair + np.arange(size) % num_pairs)
+                first_pair += num_pairs
+            return np.concatenate(units)
+        return np.arange(len(self.final_values))
+    
+    def standard_error(self, num_resamples=200, seed=0):
+        """
+        Reports the precision of the simulation: the mean and the 95% confidence interval bounds of the final cumulative
+        returns with their standard errors (see bootstrap_standard_errors), and the number of paths they were estimated from.
+        In streaming mode the paths are not kept and the standard errors are batch means over the chunks.
+
+        """
+        
+        # Check to make sure that simulation has run previously. 
+        if not self.has_simulated():
+            self.calc_cumulative_return()
+        
+        estimates = self.terminal_estimates()
+        if self.streamed_summary is not None:
+            standard_errors = self.streamed_summary.batch_standard_errors()
+        else:
+            standard_errors = bootstrap_standard_errors(self.final_values, self.independent_units(), self.controls,
+                                                        self.control_mean, num_resamples=num_resamples, seed=seed)
+        report = pd.DataFrame({"estimate": estimates.values,
+                               "standard_error": standard_errors.values},
+                              index=["mean", "95% CI Lower", "95% CI Upper"])
+        report["paths"] = self.streamed_summary.count if self.streamed_summary is not None else len(self.final_values)
+        report["variance_reduction"] = "+".join(self.variance_reduction) or "none"
+        return report
+    
+    def simulate_block(self, seed_sequence, num_paths, start=0):
+        """
+        Simulates one chunk of num_paths paths from its own random stream.
+        Returns the paths, or their StreamingSummary in streaming mode. With a path file the paths are written
+        to its columns beginning at start and None is returned.
+
+        """
+        paths = self.simulate_paths(np.random.default_rng(seed_sequence), num_paths)
+        if self.path_store is not None:
+            self.path_store.write(start, paths)
+            return None
+        if self.streaming:
+            summary = StreamingSummary(self.nTrading + 1)
+            summary.update(paths, self.control_mean)
+            return summary
+        return paths
+    
+    def simulate_paths(self, rng, num_paths):
+        """
+        Generates num_paths simulated cumulative return paths with the vectorized path generator.
+        Returns a numpy.ndarray of shape (nTrading + 1, num_paths) starting at 1.
+
+        """
+        
+        if self.method == "gaussian":
+            # Calculate the mean and standard deviation of daily returns for each stock
+            daily_returns = self.portfolio_data.xs('daily_return',level=1,axis=1)
+            mean_returns = daily_returns.mean().values
+            std_returns = daily_returns.std().values
+            
+            # Draw the daily returns of every stock, for every trading day and every simulation, in one call.
+            # The tensor is laid out as (nTrading, num_paths, number of stocks) so the time axis comes first.
+            if "antithetic" in self.variance_reduction or "sobol" in self.variance_reduction:
+                simulated_daily_returns = mean_returns + std_returns * self.standard_normal_draws(rng, num_paths, len(mean_returns))
+            else:
+                simulated_daily_returns = rng.normal(mean_returns, std_returns, size=(self.nTrading, num_paths, len(mean_returns)))
+        else:
+            # Gather whole historical days for every trading day and every simulation in one fancy-indexing step
+            simulated_daily_returns = self.historical_returns[self.bootstrap_indices(rng, num_paths)]
+        
+        # Compounding a price path and taking its pct_change gives back the drawn returns, so the weights
+        # can be applied to them directly with a single batched dot product
+        portfolio_daily_returns = simulated_daily_returns @ np.asarray(self.weights, dtype=float)
+        
+        # Calculate the normalized, cumulative return series. The first row is the starting value of 1.
+        cumulative_returns = np.ones((self.nTrading + 1, num_paths))
+        np.cumprod(1 + portfolio_daily_returns, axis=0, out=cumulative_returns[1:])
+        return cumulative_returns
+    
+    def standard_normal_draws(self, rng, num_paths, num_stocks):
+        """
+        Draws standard normal variates with the antithetic or Sobol variance reduction scheme.
+        Returns a numpy.ndarray of shape (nTrading, num_paths, num_stocks).
+
+        """
+        
+        if "antithetic" in self.variance_reduction:
+            # The second half of the chunk mirrors the first, an odd chunk leaves its last draw unpaired
+            draws = rng.standard_normal((self.nTrading, (num_paths + 1) // 2, num_stocks))
+            return np.concatenate([draws, -draws], axis=1)[:, :num_paths]
+        
+        # One scrambled Sobol point per path, laid out day by day so each stock's first day takes the first dimensions.
+        # Sobol sequences are balanced in powers of two, a chunk of another size uses the first points of the next one.
+        # Only the first 32 days come from the sequence and the rest are pseudo-random: they matter least (see below),
+        # and scrambling thousands of dimensions would cost far more than it gains.
+        sobol_days = min(self.nTrading, 32, qmc.Sobol.MAXDIM // num_stocks)
+        points = qmc.Sobol(sobol_days * num_stocks, scramble=True, seed=rng).random_base2(int(np.ceil(np.log2(num_paths))))
+        draws = np.concatenate([ndtri(np.clip(points[:num_paths], 2.0 ** -32, 1 - 2.0 ** -32)).reshape(num_paths, sobol_days, num_stocks),
+                                rng.standard_normal((num_paths, self.nTrading - sobol_days, num_stocks))], axis=1)
+        
+        # The final cumulative return depends mostly on the sum of a path's draws. Like a Brownian bridge construction,
+        # an orthogonal (Householder) reflection turns the first day's draw into that sum, scaled by sqrt(nTrading), so the
+        # best stratified Sobol dimensions drive the final value. The reflection keeps the draws independent standard normals.
+        if self.nTrading > 1:
+            reflection = np.full(self.nTrading, -1 / np.sqrt(self.nTrading))
+            reflection[0] += 1
+            projections = np.einsum("t,pts->ps", reflection, draws)
+            draws = draws - (2 / (reflection @ reflection)) * reflection[None, :, None] * projections[:, None, :]
+        return draws.transpose(1, 0, 2)
+    
+    def bootstrap_indices(self, rng, num_paths):
+        """
+        Draws the historical day to use for every trading day and simulation with a block bootstrap.
+        Returns a numpy.ndarray of shape (nTrading, num_paths) indexing rows of historical_returns.
+
+        """
+        num_days = len(self.historical_returns)
+        days = np.arange(self.nTrading)[:, None]
+        
+        # Decide where new blocks begin: with probability 1/block_size each day for the stationary bootstrap,
+        # every block_size days for the circular bootstrap. Every simulation starts a block on its first day.
+        if self.method == "stationary_bootstrap":
+            new_block = rng.random((self.nTrading, num_paths)) < 1 / self.block_size
+            new_block[0] = True
+        else:
+            new_block = np.broadcast_to(days % self.block_size == 0, (self.nTrading, num_paths))
+        
+        # Draw the random historical starting day of every block in one shot
+        block_starts = rng.integers(0, num_days, size=(self.nTrading, num_paths))
+        
+        # For each simulated day find the day its block began, then walk forward through history from the
+        # block's starting day, wrapping around the end of the history
+        block_began = np.maximum.accumulate(np.where(new_block, days, 0), axis=0)
+        start_index = np.take_along_axis(block_starts, block_began, axis=0)
+        return (start_index + days - block_began) % num_days
+    
+    def calc_cumulative_return_loop(self):
+        """
+        Calculates the cumulative return using the original simulation loop, one random draw per stock and trading day.
+        Kept for parity testing against the vectorized path generator.
+
+        """
+        
         # Get closing prices of each stock
         last_prices = self.portfolio_data.xs('close',level=1,axis=1)[-1:].values.tolist()[0]
         
@@ -118,24 +1288,65 @@ class MCSimulation:
         
         # Set attribute to use in plotting
         self.simulated_return = portfolio_cumulative_returns
+        self.final_values = portfolio_cumulative_returns.iloc[-1, :].values
         
         # Calculate 95% confidence intervals for final cumulative returns
         self.confidence_interval = portfolio_cumulative_returns.iloc[-1, :].quantile(q=[0.025, 0.975])
         
         return portfolio_cumulative_returns
     
-    def plot_simulation(self):
+    def has_simulated(self):
+        """
+        Returns True if the simulation has run, storing every path in memory or in a path file, or in streaming mode.
+
+        """
+        return (isinstance(self.simulated_return,pd.DataFrame) or self.streamed_summary is not None
+                or self.path_store is not None)
+    
+    def daily_statistics(self):
+        """
+        Calculates the mean, median, min and max of the simulated cumulative returns for every trading day.
+
+        """
+        
+        # Check to make sure that simulation has run previously. 
+        if not self.has_simulated():
+            self.calc_cumulative_return()
+        
+        if self.streamed_summary is not None:
+            return self.streamed_summary.daily_statistics()
+        if self.path_store is not None:
+            return self.path_store.daily_statistics()
+        return pd.DataFrame({
+            "mean": self.simulated_return.mean(axis=1),
+            "median": self.simulated_return.median(axis=1),
+            "min": self.simulated_return.min(axis=1),
+            "max": self.simulated_return.max(axis=1)
+        })
+    
+    def plot_simulation(self, max_paths=1000):
         """
         Visualizes the simulated stock trajectories using calc_cumulative_return method.
+        Paths in a path file are sampled, at most max_paths evenly strided simulations are drawn.
 
         """ 
         
         # Check to make sure that simulation has run previously. 
-        if not isinstance(self.simulated_return,pd.DataFrame):
+        if not self.has_simulated():
             self.calc_cumulative_return()
+        
+        # Streaming mode does not keep the individual trajectories
+        if not isinstance(self.simulated_return,pd.DataFrame) and self.path_store is None:
+            raise AttributeError("plot_simulation needs every simulated path, run the simulation with streaming=False.")
             
-        # Use Pandas plot function to plot the return data
+        # Use Pandas plot function to plot the return data, only a sample of the paths in a path file is read to be drawn
         plot_title = f"{self.nSim} Simulations of Cumulative Portfolio Return Trajectories Over the Next {self.nTrading} Trading Days."
+        if self.path_store is not None:
+            sample = self.path_store.sample_paths(max_paths)
+            if len(sample.columns) < self.nSim:
+                plot_title = (f"{len(sample.columns)} of {self.nSim} Simulations of Cumulative Portfolio Return Trajectories "
+                              f"Over the Next {self.nTrading} Trading Days.")
+            return sample.plot(legend=None,title=plot_title)
         return self.simulated_return.plot(legend=None,title=plot_title)
     
     def plot_distribution(self):
@@ -145,13 +1356,23 @@ class MCSimulation:
         """
         
         # Check to make sure that simulation has run previously. 
-        if not isinstance(self.simulated_return,pd.DataFrame):
+        if not self.has_simulated():
             self.calc_cumulative_return()
         
         # Use the `plot` function to create a probability distribution histogram of simulated ending prices
         # with markings for a 95% confidence interval
         plot_title = f"Distribution of Final Cumuluative Returns Across All {self.nSim} Simulations"
-        plt = self.simulated_return.iloc[-1, :].plot(kind='hist', bins=10,density=True,title=plot_title)
+        if self.streamed_summary is not None:
+            # In streaming mode plot the weighted centroids of the final day's quantile sketch
+            sketch = self.streamed_summary.sketch
+            keep = sketch.centroid_weights[-1] > 0
+            plt = pd.Series(sketch.centroids[-1][keep]).plot(kind='hist', bins=10,density=True,title=plot_title,
+                                                              weights=sketch.centroid_weights[-1][keep])
+        elif self.path_store is not None:
+            # Only the final row of the path file is read
+            plt = self.path_store.final_values().plot(kind='hist', bins=10,density=True,title=plot_title)
+        else:
+            plt = self.simulated_return.iloc[-1, :].plot(kind='hist', bins=10,density=True,title=plot_title)
         plt.axvline(self.confidence_interval.iloc[0], color='r')
         plt.axvline(self.confidence_interval.iloc[1], color='r')
         return plt
@@ -163,10 +1384,15 @@ class MCSimulation:
         """
         
         # Check to make sure that simulation has run previously. 
-        if not isinstance(self.simulated_return,pd.DataFrame):
+        if not self.has_simulated():
             self.calc_cumulative_return()
             
-        metrics = self.simulated_return.iloc[-1].describe()
+        if self.streamed_summary is not None:
+            metrics = self.streamed_summary.describe_final()
+        elif self.path_store is not None:
+            metrics = self.path_store.final_values().describe()
+        else:
+            metrics = self.simulated_return.iloc[-1].describe()
         ci_series = self.confidence_interval
         ci_series.index = ["95% CI Lower","95% CI Upper"]
         return metrics.append(ci_series)
\ No newline at end of file
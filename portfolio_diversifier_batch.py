@@ -0,0 +1,194 @@
+'''
+portfolio_diversifier_batch.py
+
+Headless diversification of many client profiles in parallel
+
+'''
+
+# Import appropriate modules
+import os
+import io
+import json
+import time
+import hashlib
+import tempfile
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+import fire
+import numpy as np
+import pandas as pd
+from portfolio_diversifier_market_data import MarketDataSession, LocalDirectoryProvider
+from portfolio_diversifier_market_data import export_prices, fetch_returns, provider_from_name, default_provider_name
+from portfolio_diversifier_ratios_and_calculations import BasePortfolio, calculate_risk_return_batch
+from portfolio_diversifier_ratios_and_calculations import calculate_new_risk_return_batch
+from portfolio_diversifier_results import ResultStore
+from portfolio_diversifier_session import age_band_allocations, default_ticker_list
+
+# Values used for anything a profile does not set, the same as the defaults of the UI
+default_profile = {"tickers": default_ticker_list,
+                   "overlay_weight": 0.20,
+                   "stock_weight": 0.60,
+                   "risk_free_rate": 0.00,
+                   "financing_rate": 0.00,
+                   "ticker_base_portfolio_stock": "spy",
+                   "ticker_base_portfolio_bond": "ief",
+                   "start_date": "2008-01-01",
+                   "end_date": "2020-12-31"}
+
+# Read the profiles file and complete every profile with the defaults
+def read_profiles(profiles_file):
+    """profiles_file = json file holding a list of profiles, or csv file with one profile per row
+    Each profile can set profile_id, age_band (one of the age menu choices) or stock_weight (bond_weight defaults
+    to the rest), overlay_weight, tickers (a list, or separated by spaces or semicolons in csv), start_date,
+    end_date, risk_free_rate, financing_rate, ticker_base_portfolio_stock and ticker_base_portfolio_bond.
+    Returns the list of complete profiles."""
+    if str(profiles_file).endswith(".json"):
+        with open(profiles_file) as file:
+            rows = json.load(file)
+    else:
+        rows = pd.read_csv(profiles_file, dtype = str, keep_default_na = False).to_dict("records")
+
+    profiles = []
+    for number, row in enumerate(rows):
+        row = {key: value for key, value in row.items() if value is not None and value != ""}
+        profile = dict(default_profile, **row)
+        profile["profile_id"] = str(row.get("profile_id", number))
+        if isinstance(profile["tickers"], str):
+            profile["tickers"] = profile["tickers"].replace(";", " ").split()
+        if "age_band" in row:
+            if row["age_band"] not in age_band_allocations:
+                raise ValueError(f"Unknown age band '{row['age_band']}' in profile {profile['profile_id']}")
+            profile["stock_weight"], profile["bond_weight"] = age_band_allocations[row["age_band"]]
+        for key in ["overlay_weight", "stock_weight", "risk_free_rate", "financing_rate"]:
+            profile[key] = float(profile[key])
+        profile["bond_weight"] = float(profile.get("bond_weight", 1 - profile["stock_weight"]))
+        profiles.append(profile)
+    return profiles
+
+# Market data session of a worker process, reading the shared price files
+worker_session = None
+
+def initialize_worker(prices_dir):
+    global worker_session
+    worker_session = MarketDataSession(provider = LocalDirectoryProvider(prices_dir))
+
+# True if the session has prices of the ticker over the date range, tickers that failed to load have no price file
+def has_prices(session, ticker, start_date, end_date):
+    try:
+        return session.close(ticker, start_date, end_date).shape[0] > 0
+    except FileNotFoundError:
+        return False
+
+# Calculate the ratios of every ticker of one profile, one row per ticker
+def evaluate_profile(profile, session = None):
+    session = session if session is not None else worker_session
+    start_date, end_date = profile["start_date"], profile["end_date"]
+    stock_returns = session.returns(profile["ticker_base_portfolio_stock"], start_date, end_date)
+    bond_returns = session.returns(profile["ticker_base_portfolio_bond"], start_date, end_date)
+    if stock_returns.shape[0] == 0 or bond_returns.shape[0] == 0:
+        raise ValueError("Base portfolio data not available")
+    # profiles sharing an allocation and date range share the base portfolio within a worker
+    base_portfolio = BasePortfolio.build(stock_returns, bond_returns, profile["stock_weight"], profile["bond_weight"],
+                                         profile["risk_free_rate"], profile["financing_rate"], 252)
+    tickers = [ticker for ticker in profile["tickers"] if has_prices(session, ticker, start_date, end_date)]
+    # tickers starting after start_date are padded with missing returns, the batch ratios only count the
+    # standalone downside over each ticker's own history so they match calculate_diversification
+    returns_df = session.aligned_returns(tickers, start_date, end_date)
+
+    weights = {"weight_asset": profile["overlay_weight"], "weight_base_portfolio": 1 - profile["overlay_weight"]}
+    # ratios that cannot be calculated (e.g. WARP of a portfolio made worse on one side only) are left as NaN quietly
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        risk_return_df = calculate_risk_return_batch(returns_df, base_portfolio,
+                                                     risk_free_rate = profile["risk_free_rate"],
+                                                     financing_rate = profile["financing_rate"], **weights)
+        new_risk_return_df = calculate_new_risk_return_batch(returns_df, base_portfolio,
+                                                             risk_free_rate = profile["risk_free_rate"],
+                                                             financing_rate = profile["financing_rate"], **weights)
+    result_df = pd.concat([risk_return_df, new_risk_return_df.add_prefix("new_")], axis = 1)
+    result_df.index.name = "ticker"
+    result_df = result_df.reset_index()
+    for position, key in enumerate(["profile_id", "stock_weight", "bond_weight", "overlay_weight",
+                                    "start_date", "end_date"]):
+        result_df.insert(position, key, profile[key])
+    return result_df
+
+# Evaluate a profile, returning the error message instead of raising so one profile never stops the batch
+def evaluate_profile_safely(profile):
+    try:
+        return evaluate_profile(profile), None
+    except Exception as ex:
+        return None, f"{type(ex).__name__}: {ex}"
+
+# Fetch the prices every profile needs once and write them where the worker processes read them
+def load_shared_prices(profiles, prices_dir, provider = None, max_workers = 8):
+    provider = provider if provider is not None else provider_from_name(default_provider_name)
+    session = MarketDataSession(provider = provider)
+    tickers = list(dict.fromkeys(ticker for profile in profiles for ticker in
+                                 [profile["ticker_base_portfolio_stock"], profile["ticker_base_portfolio_bond"]]
+                                 + profile["tickers"]))
+    start_date = min(pd.Timestamp(profile["start_date"]) for profile in profiles)
+    end_date = max(pd.Timestamp(profile["end_date"]) for profile in profiles)
+    with contextlib.redirect_stdout(io.StringIO()):
+        fetch_result = fetch_returns(tickers, start_date, end_date, store = session, max_workers = max_workers)
+    if len(fetch_result.failed) > 0:
+        print(fetch_result.report())
+    export_prices(session, list(fetch_result.returns_by_ticker), start_date, end_date, prices_dir)
+    return fetch_result
+
+# Diversify every profile of the profiles file and save one consolidated result set
+def run_batch(profiles_file, output = None, provider = None, max_workers = None, prices_dir = None,
+              results_dir = None, chunk_size = 16):
+    """profiles_file = json or csv file of client profiles, see read_profiles
+    output = csv (or parquet) file the consolidated results are also written to (default none)
+    provider = market data provider name, yahoo, synthetic, synthetic:<seed> or a directory of price files
+               (default $PORTFOLIO_DIVERSIFIER_PROVIDER, yahoo)
+    max_workers = number of worker processes (default one per cpu), 1 evaluates the profiles in this process
+    prices_dir = directory the shared prices are written to (default a temporary directory removed at the end)
+    results_dir = result store the consolidated results are written to as a 'batch' run (default results)
+    chunk_size = number of profiles sent to a worker at once
+    The prices of all the tickers are fetched once for the widest date range, every worker reads them from
+    prices_dir. Profiles that fail are reported and left out of the results."""
+    start_time = time.perf_counter()
+    profiles = read_profiles(profiles_file)
+    print(f"{len(profiles)} profiles read from {profiles_file}")
+
+    with contextlib.ExitStack() as stack:
+        if prices_dir is None:
+            prices_dir = stack.enter_context(tempfile.TemporaryDirectory(prefix = "portfolio_diversifier_prices_"))
+        provider = provider_from_name(provider) if provider is not None else None
+        fetch_result = load_shared_prices(profiles, prices_dir, provider = provider)
+        print(f"Prices of {len(fetch_result.returns_by_ticker)} tickers loaded in {time.perf_counter() - start_time:.1f} s")
+
+        if max_workers == 1:
+            initialize_worker(prices_dir)
+            evaluated = [evaluate_profile_safely(profile) for profile in profiles]
+        else:
+            with ProcessPoolExecutor(max_workers = max_workers, initializer = initialize_worker,
+                                     initargs = (prices_dir,)) as executor:
+                evaluated = list(executor.map(evaluate_profile_safely, profiles, chunksize = chunk_size))
+
+    results = [result_df for result_df, error in evaluated if result_df is not None]
+    failed = {profile["profile_id"]: error for profile, (result_df, error) in zip(profiles, evaluated) if error is not None}
+    for profile_id, error in failed.items():
+        print(f"Sorry, profile '{profile_id}' could not be evaluated: {error}")
+    results_df = pd.concat(results, ignore_index = True) if len(results) > 0 else pd.DataFrame()
+
+    # one run of the result store holds the results of all the profiles of the file
+    with open(profiles_file, "rb") as file:
+        profiles_digest = hashlib.sha1(file.read()).hexdigest()
+    profiles_df = pd.DataFrame([dict(profile, tickers = " ".join(profile["tickers"]),
+                                     error = failed.get(profile["profile_id"], "")) for profile in profiles])
+    ResultStore(results_dir).write("batch", {"profiles_file": os.path.basename(str(profiles_file)),
+                                             "profiles_digest": profiles_digest},
+                                   {"batch_risk_return": results_df, "batch_profiles": profiles_df})
+    if output is not None:
+        if str(output).endswith(".parquet"):
+            results_df.to_parquet(output)
+        else:
+            results_df.to_csv(output, index = False)
+    print(f"{len(profiles) - len(failed)} profiles evaluated, {len(failed)} failed, "
+          f"{results_df.shape[0]} rows in {time.perf_counter() - start_time:.1f} s")
+
+# the main entry point for the program
+if __name__ == "__main__":
+    fire.Fire(run_batch)
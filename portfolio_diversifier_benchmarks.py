@@ -0,0 +1,226 @@
+'''
+portfolio_diversifier_benchmarks.py
+
+Micro benchmarks of the ratio and drawdown kernels
+
+'''
+
+# Import appropriate modules
+import sys
+import json
+import time
+import platform
+import datetime
+import tracemalloc
+import subprocess
+import fire
+import numpy as np
+import pandas as pd
+from portfolio_diversifier_ratios_and_calculations import sharpe_ratio, sortino_ratio, target_downside_deviation
+from portfolio_diversifier_ratios_and_calculations import annualized_return, maximum_drawdown, get_maximum_drawdown
+from portfolio_diversifier_ratios_and_calculations import win_above_base_portfolio, return_statistics
+from portfolio_diversifier_ratios_and_calculations import BasePortfolio, calculate_risk_return, calculate_new_risk_return
+from portfolio_diversifier_ratios_and_calculations import calculate_risk_return_batch, calculate_new_risk_return_batch
+
+# Series lengths and input types benchmarked by default
+default_lengths = [1_000, 10_000, 100_000, 1_000_000, 10_000_000]
+input_types = ["numpy", "series", "values"]
+
+# Kernels benchmarked, each called with the asset returns and the base portfolio returns of the same input type
+kernels = {
+    "sharpe_ratio": lambda returns, base_returns: sharpe_ratio(returns),
+    "sortino_ratio": lambda returns, base_returns: sortino_ratio(returns),
+    "target_downside_deviation": lambda returns, base_returns: target_downside_deviation(returns),
+    "annualized_return": lambda returns, base_returns: annualized_return(returns),
+    "maximum_drawdown": lambda returns, base_returns: maximum_drawdown(returns),
+    "get_maximum_drawdown": lambda returns, base_returns: get_maximum_drawdown(returns),
+    "win_above_base_portfolio": lambda returns, base_returns: win_above_base_portfolio(returns, base_returns),
+    "return_statistics": lambda returns, base_returns: return_statistics(returns),
+}
+
+# Deterministic synthetic daily returns of an asset and a base portfolio correlated with it
+def synthetic_returns(length, seed = 0, annual_return = 0.07, annual_volatility = 0.18, correlation = 0.5,
+                      periodicity = 252):
+    """Returns two numpy arrays of daily returns, the same length and seed always give the same values"""
+    rng = np.random.default_rng(seed)
+    common = rng.standard_normal(length)
+    asset = np.sqrt(correlation) * common + np.sqrt(1 - correlation) * rng.standard_normal(length)
+    base = np.sqrt(correlation) * common + np.sqrt(1 - correlation) * rng.standard_normal(length)
+    daily_return = annual_return / periodicity
+    daily_volatility = annual_volatility / np.sqrt(periodicity)
+    return daily_return + daily_volatility * asset, daily_return + daily_volatility * base
+
+# Convert returns to one of the input types the kernels are called with
+def as_input_type(returns, input_type, index = None):
+    """numpy = one dimensional array
+    series = pandas series on a range index (a business day index of 10M days would run past the last pandas date)
+    values = two dimensional (length, 1) array, the values of a one column data frame"""
+    if input_type == "numpy":
+        return returns
+    if input_type == "series":
+        return pd.Series(returns, index = index)
+    if input_type == "values":
+        return pd.DataFrame({'PercentReturn': returns}).values
+    raise ValueError(f"Unknown input type '{input_type}'")
+
+# Time a call, repeating it enough times for each measurement to last at least min_time seconds
+def time_call(call, repeats = 5, min_time = 0.2):
+    call()
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            call()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or loops >= 1_000_000:
+            break
+        loops *= 10 if elapsed < min_time / 10 else 2
+    timings = [elapsed / loops]
+    for _ in range(repeats - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            call()
+        timings.append((time.perf_counter() - start) / loops)
+    return timings, loops
+
+# Peak memory allocated during one call
+def peak_memory(call):
+    tracemalloc.start()
+    try:
+        call()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+# Describe the environment the benchmarks ran in
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output = True, text = True,
+                                check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "commit": commit,
+            "created": datetime.datetime.now().isoformat(timespec = "seconds")}
+
+# Run the benchmarks and save the results as json
+def run(output = "benchmark_results.json", lengths = None, functions = None, types = None,
+        repeats = 5, min_time = 0.2, seed = 0, baseline = None, threshold = 0.10):
+    """output = json file the results are written to
+    lengths = series lengths (default 1k to 10M points)
+    functions = names of the kernels to benchmark (default all)
+    types = input types among numpy, series and values (default all)
+    repeats = measurements per benchmark, the minimum and median are reported
+    min_time = minimum duration of one measurement in seconds, short calls are looped
+    baseline = json results of a previous run to compare with, regressions beyond threshold are flagged"""
+    lengths = default_lengths if lengths is None else [int(length) for length in np.atleast_1d(lengths)]
+    functions = list(kernels) if functions is None else list(np.atleast_1d(functions))
+    types = input_types if types is None else list(np.atleast_1d(types))
+
+    results = []
+    for length in lengths:
+        returns, base_returns = synthetic_returns(length, seed = seed)
+        index = pd.RangeIndex(length) if "series" in types else None
+        for input_type in types:
+            asset_input = as_input_type(returns, input_type, index)
+            base_input = as_input_type(base_returns, input_type, index)
+            for name in functions:
+                call = lambda: kernels[name](asset_input, base_input)
+                timings, loops = time_call(call, repeats = repeats, min_time = min_time)
+                result = {"function": name,
+                          "input_type": input_type,
+                          "length": length,
+                          "seconds_min": min(timings),
+                          "seconds_median": float(np.median(timings)),
+                          "loops": loops,
+                          "repeats": repeats,
+                          "peak_memory_bytes": peak_memory(call)}
+                results.append(result)
+                print(f"{name:<26} {input_type:<7} {length:>10,d} "
+                      f"{result['seconds_min'] * 1e3:>12.4f} ms {result['peak_memory_bytes'] / 2**20:>10.2f} MiB")
+
+    report = {"environment": environment(), "results": results}
+    with open(output, "w") as file:
+        json.dump(report, file, indent = 2)
+    print(f"Results saved to {output}")
+
+    if baseline is not None:
+        regressions = compare(output, baseline, threshold)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+# Compare benchmark results with a baseline and flag the regressions
+def compare(results, baseline, threshold = 0.10):
+    """results, baseline = json files written by run
+    threshold = relative slow down of the minimum time (or growth of peak memory) flagged as a regression
+    Returns the list of regressions."""
+    with open(results) as file:
+        current = {(result["function"], result["input_type"], result["length"]): result
+                   for result in json.load(file)["results"]}
+    with open(baseline) as file:
+        previous = {(result["function"], result["input_type"], result["length"]): result
+                    for result in json.load(file)["results"]}
+
+    regressions = []
+    for key in sorted(set(current) & set(previous)):
+        time_ratio = current[key]["seconds_min"] / previous[key]["seconds_min"]
+        memory_ratio = (current[key]["peak_memory_bytes"] + 1) / (previous[key]["peak_memory_bytes"] + 1)
+        flag = ""
+        if time_ratio > 1 + threshold or memory_ratio > 1 + threshold:
+            flag = "REGRESSION"
+            regressions.append({"function": key[0], "input_type": key[1], "length": key[2],
+                                "time_ratio": time_ratio, "memory_ratio": memory_ratio})
+        elif time_ratio < 1 - threshold:
+            flag = "faster"
+        print(f"{key[0]:<26} {key[1]:<7} {key[2]:>10,d} time x{time_ratio:>6.2f} memory x{memory_ratio:>6.2f} {flag}")
+    print(f"{len(regressions)} regression(s) beyond {threshold:.0%}")
+    return regressions
+
+# Check the batched ratios against the ratios calculated ticker by ticker, including a ticker starting later
+# than the base portfolio
+def parity(length = 3000, late_start = 1000, seed = 0, tolerance = 1e-9):
+    """length = number of days of the base portfolio
+    late_start = day the history of the later starting ticker begins
+    tolerance = largest relative difference accepted between the two calculations
+    Returns the largest relative difference of each column, exits with an error beyond tolerance."""
+    index = pd.bdate_range('2000-01-01', periods = length)
+    # daily returns as the market data session gives them, the first return of each history is missing
+    def history(returns, start = 0):
+        returns = pd.Series(returns[start:], index = index[start:])
+        returns.iloc[0] = np.nan
+        return returns
+    stock_returns, bond_returns = synthetic_returns(length, seed = seed)
+    asset_returns, late_returns = synthetic_returns(length, seed = seed + 1)
+    returns_by_ticker = {"asset": history(asset_returns), "late": history(late_returns, late_start)}
+    base_portfolio = BasePortfolio.build(history(stock_returns).rename("stock"), history(bond_returns).rename("bond"),
+                                         0.60, 0.40, 0.01, 0.02, 252)
+
+    risk_return_df = pd.DataFrame(index = list(returns_by_ticker),
+                                  columns = ['WARP', '+Sortino', '+Ret_To_MaxDD', 'Sharpe', 'Sortino', 'Max_DD'])
+    new_risk_return_df = pd.DataFrame(index = list(returns_by_ticker),
+                                      columns = ['Return', 'Vol', 'Sharpe', 'Sortino', 'Max_DD', 'Ret_To_MaxDD', 'WARP_20%_asset'])
+    for ticker, returns in returns_by_ticker.items():
+        calculate_risk_return(ticker, returns, base_portfolio, 0.01, 0.02, 0.20, 0.80, 252, risk_return_df)
+        calculate_new_risk_return(ticker, returns, base_portfolio, 0.01, 0.02, 0.20, 0.80, 252,
+                                  risk_return_df, new_risk_return_df, {})
+    returns_df = pd.DataFrame(returns_by_ticker)
+    batch_df = pd.concat([calculate_risk_return_batch(returns_df, base_portfolio, 0.01, 0.02),
+                          calculate_new_risk_return_batch(returns_df, base_portfolio, 0.01, 0.02).add_prefix("new_")], axis = 1)
+    expected_df = pd.concat([risk_return_df, new_risk_return_df.drop(columns = 'WARP_20%_asset').add_prefix("new_")], axis = 1)
+
+    differences = ((batch_df - expected_df.astype(float)).abs() / expected_df.astype(float).abs()).max()
+    for column, difference in differences.items():
+        print(f"{column:<20} {difference:.2e}")
+    if differences.max() > tolerance:
+        print(f"Batched ratios differ from the ratios calculated ticker by ticker beyond {tolerance:.0e}")
+        sys.exit(1)
+    return differences.to_dict()
+
+# the main entry point for the program
+if __name__ == "__main__":
+    fire.Fire({"run": run, "compare": compare, "parity": parity})
@@ -0,0 +1,73 @@
+'''
+portfolio_diversifier_downsampling.py
+
+Downsampling of long daily series before they are plotted
+
+'''
+
+# Import appropriate modules
+import numpy as np
+import pandas as pd
+
+# Positions of the points kept by largest triangle three buckets, for every column of y at once
+def lttb_indices(x, y, threshold):
+    """x = one dimensional array of increasing x values
+    y = two dimensional array with one column per series, NaNs are allowed
+    threshold = number of points kept per series, the first and last points are always kept
+    Returns an array of shape (threshold, number of series) with the positions kept in each series.
+    The points are split in threshold - 2 buckets, in each bucket the point forming the largest triangle
+    with the point kept in the previous bucket and the average of the next bucket is kept.
+    The buckets are visited in turn but every bucket is processed for all the series together."""
+    num_points, num_series = y.shape
+    if threshold >= num_points or threshold < 3:
+        return np.tile(np.arange(num_points)[:, None], (1, num_series))
+
+    every = (num_points - 2) / (threshold - 2)
+    edges = (np.arange(threshold - 1) * every).astype(int) + 1
+    edges[-1] = num_points - 1
+    # bucket i spans edges[i] to edges[i + 1], the last point is a bucket of its own
+    edges = np.append(edges, num_points)
+
+    # averages of every bucket from cumulative sums, ignoring the NaNs
+    valid = ~np.isnan(y)
+    y_sum = np.concatenate([np.zeros((1, num_series)), np.cumsum(np.where(valid, y, 0), axis = 0)])
+    y_count = np.concatenate([np.zeros((1, num_series)), np.cumsum(valid, axis = 0)])
+    x_sum = np.concatenate([[0.0], np.cumsum(x)])
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        y_average = (y_sum[edges[1:]] - y_sum[edges[:-1]]) / (y_count[edges[1:]] - y_count[edges[:-1]])
+    x_average = (x_sum[edges[1:]] - x_sum[edges[:-1]]) / (edges[1:] - edges[:-1])
+
+    selected = np.empty((threshold, num_series), dtype = int)
+    selected[0] = 0
+    selected[-1] = num_points - 1
+    columns = np.arange(num_series)
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        previous_x = x[selected[bucket]]
+        previous_y = y[selected[bucket], columns]
+        area = np.abs((previous_x - x_average[bucket + 1]) * (y[start:end] - previous_y)
+                      - (previous_x - x[start:end, None]) * (y_average[bucket + 1] - previous_y))
+        selected[bucket + 1] = start + np.where(np.isnan(area), -1, area).argmax(axis = 0)
+    return selected
+
+# Downsample every column of a data frame and return it in long form for plotting
+def downsample_frame(df, threshold = 500):
+    """df = data frame with one series per column and an increasing numeric or date index
+    threshold = number of points kept per series
+    Returns a data frame with the index (named after the index of df, or index), variable and value columns,
+    with at most threshold rows per series."""
+    x_name = df.index.name if df.index.name is not None else 'index'
+    if isinstance(df.index, pd.DatetimeIndex):
+        x = df.index.asi8.astype(float)
+    else:
+        x = np.asarray(df.index, dtype = float)
+    y = df.to_numpy(dtype = float)
+    selected = lttb_indices(x, y, threshold)
+
+    long_frames = []
+    for column, name in enumerate(df.columns):
+        positions = np.unique(selected[:, column])
+        long_frames.append(pd.DataFrame({x_name: df.index[positions],
+                                         'variable': name,
+                                         'value': y[positions, column]}))
+    return pd.concat(long_frames, ignore_index = True)
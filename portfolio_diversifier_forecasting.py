@@ -3,8 +3,10 @@ portfolio_diversifier_forecasting.py
 
 Author: George Kraft
 """
+import os
 import pandas as pd
 from MCForecastTools import MCSimulation
+from portfolio_diversifier_market_data import MarketDataSession
 
 # Configure a Monte Carlo simulation to forecast five years cumulative returns
 # from daily_returns_df
@@ -15,14 +17,40 @@ def execute_monte_carlo_simulation(ticker,
                                     weight_diversifying_asset,
                                     weight_base_portfolio_stock,
                                     weight_base_portfolio_bond,
-                                    number_of_years = 5):
+                                    number_of_years = 5,
+                                    num_simulation = 500,
+                                    streaming = False,
+                                    n_workers = 1,
+                                    seed = None,
+                                    method = "gaussian",
+                                    block_size = 21,
+                                    path_dir = None,
+                                    path_dtype = "float32",
+                                    variance_reduction = None,
+                                    target_half_width = None,
+                                    target_mean_half_width = None,
+                                    max_simulation = 100000):
     print(f"Forecasting for portfolio compromising {ticker} {weight_diversifying_asset * 100:.02f}%") 
     print(f"weight stock {weight_base_portfolio_stock * 100:.02f}% weight bond {weight_base_portfolio_bond * 100:.02f}%")
+    # the raw paths of each ticker are written to their own file of path_dir when one is given
+    if path_dir is not None:
+        os.makedirs(path_dir, exist_ok = True)
     monte_carlo_diversified_portfolio = MCSimulation(
                     portfolio_data = daily_returns_df,
                     weights = [weight_diversifying_asset, weight_base_portfolio_stock, weight_base_portfolio_bond],
-                    num_simulation = 500,
-                    num_trading_days = number_of_trading_days_in_a_year * number_of_years)
+                    num_simulation = num_simulation,
+                    num_trading_days = number_of_trading_days_in_a_year * number_of_years,
+                    streaming = streaming,
+                    n_workers = n_workers,
+                    seed = seed,
+                    method = method,
+                    block_size = block_size,
+                    path_file = None if path_dir is None else os.path.join(path_dir, f'monte_carlo_paths_{ticker}.npy'),
+                    path_dtype = path_dtype,
+                    variance_reduction = variance_reduction,
+                    target_half_width = target_half_width,
+                    target_mean_half_width = target_mean_half_width,
+                    max_simulation = max_simulation)
 
     # Printing the first five rows of the simulation input data
     #print(f'{monte_carlo_diversified_portfolio.portfolio_data.head()}')
@@ -30,15 +58,9 @@ def execute_monte_carlo_simulation(ticker,
     # Run a Monte Carlo simulation to forecast five years cumulative returns
     cumulative_returns = monte_carlo_diversified_portfolio.calc_cumulative_return()
     # print(f'{results}')
-    simulated_selected_returns_data = {
-          "mean": list(monte_carlo_diversified_portfolio.simulated_return.mean(axis=1)),
-          "median": list(monte_carlo_diversified_portfolio.simulated_return.median(axis=1)),
-          "min": list(monte_carlo_diversified_portfolio.simulated_return.min(axis=1)),
-          "max": list(monte_carlo_diversified_portfolio.simulated_return.max(axis=1))
-    }
 
-    # Create a DataFrame with the summary statistics
-    simulated_returns = pd.DataFrame(simulated_selected_returns_data)
+    # Create a DataFrame with the mean, median, min and max for every trading day
+    simulated_returns = monte_carlo_diversified_portfolio.daily_statistics()
     simulated_returns.to_csv(f'monte_carlo_simulative_returns_{ticker}.csv')
 
     # Visualize the Monte Carlo simulation by creating an overlay line plot
@@ -55,6 +77,18 @@ def execute_monte_carlo_simulation(ticker,
     print(diversified_portfolio_table)
     diversified_portfolio_table.to_csv(f'monte_carlo_simulation_table_{ticker}.csv')
 
+    # Report how precisely the mean and the confidence interval bounds are estimated
+    standard_error_table = monte_carlo_diversified_portfolio.standard_error()
+    print(f"\nStandard Errors: ")
+    print(standard_error_table)
+    standard_error_table.to_csv(f'monte_carlo_standard_error_{ticker}.csv')
+
+    # With a target precision num_simulation only starts the run, record how many paths it took
+    if monte_carlo_diversified_portfolio.precision is not None:
+        print(f"\nPrecision: ")
+        print(monte_carlo_diversified_portfolio.precision)
+        monte_carlo_diversified_portfolio.precision.to_csv(f'monte_carlo_precision_{ticker}.csv')
+
     # Using the lower and upper `95%` confidence interval values 
     # (index positions 8 & 9 from the diversified_portfolio_table)
     # calculate  the range of the possible outcomes for a $10,000 investment 
@@ -64,3 +98,28 @@ def execute_monte_carlo_simulation(ticker,
     # Print results
     print(f"There is a 95% chance that an initial investment of $10,000 in the portfolio will result in "
          f" ${diversified_portfolio_ci_lower} to ${diversified_portfolio_ci_upper} in returns\n")
+
+# Forecast every ticker blended with the base portfolio, the prices of each ticker are fetched once
+def forecast_diversified_portfolios(tickers,
+                                    ticker_base_portfolio_stock,
+                                    ticker_base_portfolio_bond,
+                                    weight_diversifying_asset,
+                                    weight_base_portfolio_stock,
+                                    weight_base_portfolio_bond,
+                                    start_date,
+                                    end_date,
+                                    provider = None,
+                                    session = None,
+                                    **simulation_options):
+    # the session is built from the provider when none is shared by the caller
+    if session is None:
+        session = MarketDataSession(provider = provider)
+    for ticker in tickers:
+        daily_returns_df = session.close_frame(
+                                [ticker, ticker_base_portfolio_stock, ticker_base_portfolio_bond], start_date, end_date)
+        execute_monte_carlo_simulation(ticker,
+                                       daily_returns_df,
+                                       weight_diversifying_asset,
+                                       weight_base_portfolio_stock,
+                                       weight_base_portfolio_bond,
+                                       **simulation_options)
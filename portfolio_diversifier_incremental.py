@@ -0,0 +1,282 @@
+'''
+portfolio_diversifier_incremental.py
+
+Incremental daily update of the risk return ratios from running accumulators
+
+'''
+
+# Import appropriate modules
+import os
+import json
+import time
+import tempfile
+import fire
+import numpy as np
+import pandas as pd
+from portfolio_diversifier_market_data import MarketDataSession, fetch_returns, provider_from_name
+from portfolio_diversifier_ratios_and_calculations import ReturnStatistics, market_data_session
+
+# Running statistics of many return series, updated one day at a time
+class RunningStatistics:
+    """Running Statistics: the accumulators of return_statistics kept for many series, updated one day at a time.
+    size = number of series
+    Each update costs O(1) per series and produces the same numbers as return_statistics over the whole history:
+    length, count, Welford mean and sum of squared deviations, sum of squared downside, net asset value,
+    running peak and maximum drawdown."""
+
+    fields = ['length', 'count', 'mean', 'sum_of_squares', 'downside_sum_of_squares',
+              'net_asset_value', 'peak', 'maximum_drawdown']
+
+    def __init__(self, size):
+        self.length = np.zeros(size, dtype = int)
+        self.count = np.zeros(size, dtype = int)
+        self.mean = np.zeros(size)
+        self.sum_of_squares = np.zeros(size)
+        self.downside_sum_of_squares = np.zeros(size)
+        self.net_asset_value = np.ones(size)
+        self.peak = np.full(size, -np.inf)
+        self.maximum_drawdown = np.zeros(size)
+
+    def update(self, values, present = None):
+        """Add the returns of one day
+        values = return of each series, NaN for a missing return
+        present = False for the series that have no row on that day at all (default every series has one)"""
+        values = np.asarray(values, dtype = float)
+        present = np.ones(values.shape, dtype = bool) if present is None else np.asarray(present, dtype = bool)
+        # missing returns count in the length but leave the other accumulators unchanged, as in return_statistics
+        valid = present & (values == values)
+        self.length += present
+        self.count += valid
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            delta = np.where(valid, values - self.mean, 0.0)
+            self.mean = self.mean + np.where(valid, delta / self.count, 0.0)
+            self.sum_of_squares = self.sum_of_squares + np.where(valid, delta * (values - self.mean), 0.0)
+            self.downside_sum_of_squares = self.downside_sum_of_squares + np.where(valid & (values < 0), values * values, 0.0)
+            self.net_asset_value = np.where(valid, self.net_asset_value * (1 + values), self.net_asset_value)
+            self.peak = np.where(present, np.maximum(self.peak, self.net_asset_value), self.peak)
+            drawdown = np.where(present, (self.peak - self.net_asset_value) / self.peak, 0.0)
+        self.maximum_drawdown = np.maximum(self.maximum_drawdown, drawdown)
+
+    def statistics(self):
+        """ReturnStatistics holding one array per statistic, every ratio method works on all the series at once"""
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            std = np.where(self.count > 1, np.sqrt(self.sum_of_squares / (self.count - 1)), np.nan)
+            return ReturnStatistics(length = self.length,
+                                    count = self.count,
+                                    mean = np.where(self.count > 0, self.mean, np.nan),
+                                    std = std,
+                                    target_downside_deviation = np.sqrt(self.downside_sum_of_squares / self.length),
+                                    net_asset_value = self.net_asset_value,
+                                    maximum_drawdown = self.maximum_drawdown)
+
+    def arrays(self, prefix):
+        """The accumulators as a dictionary of arrays, to be saved with numpy"""
+        return {f"{prefix}_{field}": getattr(self, field) for field in self.fields}
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix):
+        running_statistics = cls(len(arrays[f"{prefix}_length"]))
+        for field in cls.fields:
+            setattr(running_statistics, field, np.array(arrays[f"{prefix}_{field}"]))
+        return running_statistics
+
+# Risk return ratios of many tickers against one base portfolio, kept up to date one trading day at a time
+class IncrementalDiversifier:
+    """Incremental Diversifier: running statistics of each ticker, of the base portfolio and of each ticker layered
+    on the base portfolio, from which the risk return and new risk return tables are derived at any time.
+    tickers = tickers of the universe
+    The other parameters are those of diversify_stocks_with_base_portfolio.
+    The days are those of the base portfolio. A ticker counts a day when it has a row that day, so its statistics
+    match calculate_risk_return on its own series and those of its new portfolio match calculate_new_risk_return.
+    The state is saved to and loaded from one numpy file, a daily refresh only reads the new days."""
+
+    def __init__(self, tickers,
+                 ticker_base_portfolio_stock = 'spy', ticker_base_portfolio_bond = 'ief',
+                 weight_base_portfolio_stock = 0.60, weight_base_portfolio_bond = 0.40,
+                 risk_free_rate = 0.00, financing_rate = 0.00,
+                 weight_asset = 0.20, weight_base_portfolio = 0.80, periodicity = 252):
+        self.tickers = list(tickers)
+        self.ticker_index = pd.Index(self.tickers)
+        self.parameters = {'ticker_base_portfolio_stock': ticker_base_portfolio_stock,
+                           'ticker_base_portfolio_bond': ticker_base_portfolio_bond,
+                           'weight_base_portfolio_stock': weight_base_portfolio_stock,
+                           'weight_base_portfolio_bond': weight_base_portfolio_bond,
+                           'risk_free_rate': risk_free_rate, 'financing_rate': financing_rate,
+                           'weight_asset': weight_asset, 'weight_base_portfolio': weight_base_portfolio,
+                           'periodicity': periodicity}
+        self.assets = RunningStatistics(len(self.tickers))
+        self.base = RunningStatistics(1)
+        self.new_portfolios = RunningStatistics(len(self.tickers))
+        self.first_dates = np.full(len(self.tickers), np.datetime64("NaT"), dtype = "datetime64[ns]")
+        self.last_dates = np.full(len(self.tickers), np.datetime64("NaT"), dtype = "datetime64[ns]")
+        self.last_date = None
+
+    def update_values(self, date, stock_return, bond_return, values, present):
+        """Add one day given as arrays of the ticker returns and of the tickers having a row that day"""
+        date = np.datetime64(pd.Timestamp(date), "ns")
+        if self.last_date is not None and date <= self.last_date:
+            raise ValueError(f"{date} is not after the last date already added {self.last_date}")
+        parameters = self.parameters
+        # same operations as BasePortfolio.build and wabp_new_portfolio_data, so the numbers are identical
+        base_return = (parameters['weight_base_portfolio_stock'] * stock_return) + \
+                      (parameters['weight_base_portfolio_bond'] * bond_return)
+        financing_rate = (1 + parameters['financing_rate'])**(1 / parameters['periodicity']) - 1
+        self.base.update([base_return])
+        self.assets.update(values, present)
+        self.new_portfolios.update((values - financing_rate) * (parameters['weight_asset'])
+                                   + base_return * (parameters['weight_base_portfolio']))
+        self.first_dates[present & np.isnat(self.first_dates)] = date
+        self.last_dates[present] = date
+        self.last_date = date
+
+    def update(self, date, stock_return, bond_return, asset_returns):
+        """Add one day
+        asset_returns = returns of the tickers that day (dictionary or series), tickers left out had no row that day"""
+        asset_returns = pd.Series(asset_returns, dtype = float)
+        self.update_values(date, stock_return, bond_return,
+                           asset_returns.reindex(self.ticker_index).to_numpy(dtype = float),
+                           self.ticker_index.isin(asset_returns.index))
+
+    def append(self, stock_returns, bond_returns, returns_by_ticker):
+        """Add every day of the base portfolio after the last day already added
+        stock_returns, bond_returns = daily returns of the base portfolio stock and bond
+        returns_by_ticker = dictionary of ticker to daily returns, each on its own dates
+        Returns the number of days added."""
+        dates = stock_returns.index.union(bond_returns.index)
+        if self.last_date is not None:
+            dates = dates[dates > pd.Timestamp(self.last_date)]
+        stock_values = stock_returns.reindex(dates).to_numpy(dtype = float)
+        bond_values = bond_returns.reindex(dates).to_numpy(dtype = float)
+        values = np.full((len(dates), len(self.tickers)), np.nan)
+        present = np.zeros((len(dates), len(self.tickers)), dtype = bool)
+        for position, ticker in enumerate(self.tickers):
+            if ticker in returns_by_ticker:
+                values[:, position] = returns_by_ticker[ticker].reindex(dates).to_numpy(dtype = float)
+                present[:, position] = dates.isin(returns_by_ticker[ticker].index)
+        for row, date in enumerate(dates):
+            self.update_values(date, stock_values[row], bond_values[row], values[row], present[row])
+        return len(dates)
+
+    def risk_return(self):
+        """Risk return table, as filled by calculate_risk_return"""
+        risk_free_rate, periodicity = self.parameters['risk_free_rate'], self.parameters['periodicity']
+        assets, base, new_portfolios = self.assets.statistics(), self.base.statistics(), self.new_portfolios.statistics()
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            sortino_improvement = (new_portfolios.sortino_ratio(risk_free = risk_free_rate, periodicity = periodicity)
+                                   / base.sortino_ratio(risk_free = risk_free_rate, periodicity = periodicity))
+            return_maximum_drawdown_improvement = (
+                new_portfolios.return_maximum_drawdown_ratio(risk_free = risk_free_rate, periodicity = periodicity)
+                / base.return_maximum_drawdown_ratio(risk_free = risk_free_rate, periodicity = periodicity))
+            return pd.DataFrame({
+                'Start Date': pd.DatetimeIndex(self.first_dates).date,
+                'End Date': pd.DatetimeIndex(self.last_dates).date,
+                'WARP': ((return_maximum_drawdown_improvement * sortino_improvement) ** (1/2) - 1) * 100,
+                '+Sortino': (sortino_improvement - 1) * 100,
+                '+Ret_To_MaxDD': (return_maximum_drawdown_improvement - 1) * 100,
+                'Sharpe': assets.sharpe_ratio(risk_free = risk_free_rate, periodicity = periodicity),
+                'Sortino': assets.sortino_ratio(risk_free = risk_free_rate, periodicity = periodicity),
+                'Max_DD': assets.maximum_drawdown},
+                index = self.tickers)
+
+    def new_risk_return(self):
+        """New risk return table, as filled by calculate_new_risk_return"""
+        risk_free_rate, periodicity = self.parameters['risk_free_rate'], self.parameters['periodicity']
+        new_portfolios = self.new_portfolios.statistics()
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            return pd.DataFrame({
+                'Return': new_portfolios.annualized_return(periodicity = periodicity) - risk_free_rate,
+                'Vol': new_portfolios.target_downside_deviation * np.sqrt(periodicity),
+                'Sharpe': new_portfolios.sharpe_ratio(risk_free = risk_free_rate, periodicity = periodicity),
+                'Sortino': new_portfolios.sortino_ratio(risk_free = risk_free_rate, periodicity = periodicity),
+                'Max_DD': new_portfolios.maximum_drawdown,
+                'Ret_To_MaxDD': new_portfolios.return_maximum_drawdown_ratio(risk_free = risk_free_rate,
+                                                                             periodicity = periodicity),
+                f"WARP_{round(100 * self.parameters['weight_asset'])}%_asset": self.risk_return()['WARP'].values},
+                index = self.tickers)
+
+    def save(self, state_file):
+        """Atomically replace the state file with the current state"""
+        directory = os.path.dirname(os.path.abspath(state_file))
+        file_descriptor, temporary_path = tempfile.mkstemp(dir = directory, suffix = ".npz.tmp")
+        try:
+            with os.fdopen(file_descriptor, "wb") as file:
+                np.savez(file,
+                         tickers = np.array(self.tickers, dtype = str),
+                         parameters = np.array(json.dumps(self.parameters)),
+                         first_dates = self.first_dates,
+                         last_dates = self.last_dates,
+                         last_date = np.array(self.last_date if self.last_date is not None else "NaT",
+                                              dtype = "datetime64[ns]"),
+                         **self.assets.arrays("assets"),
+                         **self.base.arrays("base"),
+                         **self.new_portfolios.arrays("new_portfolios"))
+            os.replace(temporary_path, state_file)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+    @classmethod
+    def load(cls, state_file):
+        """Incremental diversifier saved by save"""
+        with np.load(state_file) as arrays:
+            diversifier = cls([str(ticker) for ticker in arrays["tickers"]], **json.loads(str(arrays["parameters"])))
+            diversifier.first_dates = np.array(arrays["first_dates"])
+            diversifier.last_dates = np.array(arrays["last_dates"])
+            last_date = arrays["last_date"][()]
+            diversifier.last_date = None if np.isnat(last_date) else last_date
+            diversifier.assets = RunningStatistics.from_arrays(arrays, "assets")
+            diversifier.base = RunningStatistics.from_arrays(arrays, "base")
+            diversifier.new_portfolios = RunningStatistics.from_arrays(arrays, "new_portfolios")
+        return diversifier
+
+    def fetch_and_append(self, start_date, end_date, session = None, max_workers = 8):
+        """Fetch the returns from start date to end date and add the days after the last day already added.
+        Tickers that cannot be fetched have no row on those days. Returns the number of days added."""
+        session = session if session is not None else market_data_session
+        ticker_base_portfolio_stock = self.parameters['ticker_base_portfolio_stock']
+        ticker_base_portfolio_bond = self.parameters['ticker_base_portfolio_bond']
+        fetch_result = fetch_returns([ticker_base_portfolio_stock, ticker_base_portfolio_bond] + self.tickers,
+                                     start_date, end_date, store = session, max_workers = max_workers)
+        for base_ticker in [ticker_base_portfolio_stock, ticker_base_portfolio_bond]:
+            if base_ticker in fetch_result.failed:
+                raise ValueError(f"Base portfolio data not available for '{base_ticker}': {fetch_result.failed[base_ticker]}")
+        returns_by_ticker = dict(fetch_result.returns_by_ticker)
+        return self.append(returns_by_ticker.pop(ticker_base_portfolio_stock),
+                           returns_by_ticker.pop(ticker_base_portfolio_bond),
+                           returns_by_ticker)
+
+    def refresh(self, end_date = None, session = None, max_workers = 8):
+        """Add the trading days since the last day already added, up to end date (default tomorrow)"""
+        end_date = end_date if end_date is not None else pd.Timestamp.today().normalize() + pd.Timedelta(days = 1)
+        # the returns of the new days are relative to the close of the last day already added
+        return self.fetch_and_append(pd.Timestamp(self.last_date), end_date, session = session, max_workers = max_workers)
+
+# Market data session of a provider name, or the shared session
+def session_of(provider):
+    return market_data_session if provider is None else MarketDataSession(provider = provider_from_name(provider))
+
+# Build the state of a universe of tickers from its whole history and save it
+def build(state_file, tickers, start_date = '2008-01-01', end_date = '2020-12-31', provider = None, **parameters):
+    """state_file = numpy file the state is saved to
+    tickers = tickers of the universe
+    provider = market data provider name (default the shared market data session)
+    parameters = weights, rates and base portfolio tickers, see IncrementalDiversifier"""
+    start_time = time.perf_counter()
+    diversifier = IncrementalDiversifier(list(np.atleast_1d(tickers)), **parameters)
+    days = diversifier.fetch_and_append(start_date, end_date, session = session_of(provider))
+    diversifier.save(state_file)
+    print(f"{days} days of {len(diversifier.tickers)} tickers added in {time.perf_counter() - start_time:.3f} s")
+    print(diversifier.risk_return().sort_values('WARP', ascending = False).head())
+
+# Add the days since the last refresh to a saved state
+def refresh(state_file, end_date = None, provider = None):
+    start_time = time.perf_counter()
+    diversifier = IncrementalDiversifier.load(state_file)
+    days = diversifier.refresh(end_date = end_date, session = session_of(provider))
+    diversifier.save(state_file)
+    print(f"{days} days of {len(diversifier.tickers)} tickers added in {time.perf_counter() - start_time:.3f} s")
+    print(diversifier.risk_return().sort_values('WARP', ascending = False).head())
+
+# the main entry point for the program
+if __name__ == "__main__":
+    fire.Fire({"build": build, "refresh": refresh})
@@ -0,0 +1,228 @@
+'''
+portfolio_diversifier_instrumentation.py
+
+Timing, memory and counter instrumentation of the diversification pipeline
+
+'''
+
+# Import appropriate modules
+import os
+import json
+import time
+import datetime
+import threading
+import tracemalloc
+import contextvars
+from contextlib import contextmanager, nullcontext
+
+# Switches and report file of the instrumentation, all can be set from the environment
+default_enabled = os.environ.get("PORTFOLIO_DIVERSIFIER_PROFILE", "0") == "1"
+default_trace_memory = os.environ.get("PORTFOLIO_DIVERSIFIER_PROFILE_MEMORY", "0") == "1"
+default_report_file = os.environ.get("PORTFOLIO_DIVERSIFIER_PROFILE_FILE", "profile_report.json")
+
+# The span handed out when the instrumentation is disabled, entering and leaving it does nothing
+null_span = nullcontext()
+
+# One timed stage of a run, spans opened inside it are recorded as its children
+class Span:
+    """Span: measures the time (and optionally the peak traced memory) between entering and leaving it.
+    name = name of the stage
+    attributes = extra values saved with the span, e.g. the ticker"""
+
+    def __init__(self, instrumentation, name, attributes):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.attributes = attributes
+        self.peak_memory = 0
+
+    def __enter__(self):
+        stack = self.instrumentation.stack()
+        self.path = "/".join([span.path for span in stack[-1:]] + [self.name])
+        self.memory = self.instrumentation.tracing_memory()
+        if self.memory:
+            # the peak of the parent so far is kept before the peak is reset for this span
+            if len(stack) > 0:
+                stack[-1].peak_memory = max(stack[-1].peak_memory, tracemalloc.get_traced_memory()[1])
+            self.start_memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+        stack = self.instrumentation.stack()
+        stack.pop()
+        record = {"name": self.name, "path": self.path, "seconds": seconds, "thread": threading.current_thread().name}
+        if self.memory:
+            self.peak_memory = max(self.peak_memory, tracemalloc.get_traced_memory()[1])
+            record["peak_memory_bytes"] = max(self.peak_memory - self.start_memory, 0)
+            # the parent peak includes the peak of its children
+            if len(stack) > 0:
+                stack[-1].peak_memory = max(stack[-1].peak_memory, self.peak_memory)
+        if exc_type is not None:
+            record["error"] = exc_type.__name__
+        record.update(self.attributes)
+        self.instrumentation.record(record)
+        return False
+
+# Spans and counters of a run, reported as json and as a console summary
+class Instrumentation:
+    """Instrumentation: collects the spans and counters of a run.
+    enabled = record spans and counters, when False span() and count() return at once (default $PORTFOLIO_DIVERSIFIER_PROFILE)
+    trace_memory = also record the peak memory traced by tracemalloc in each span, this slows the run down
+                   (default $PORTFOLIO_DIVERSIFIER_PROFILE_MEMORY)
+    report_file = json file the report is written to (default profile_report.json or $PORTFOLIO_DIVERSIFIER_PROFILE_FILE)
+    Spans opened in other threads are recorded too when the threads run in a copy of the context of the run
+    (contextvars.copy_context), memory is only traced for spans of the thread that started the run."""
+
+    def __init__(self, enabled = None, trace_memory = None, report_file = None):
+        self.enabled = enabled if enabled is not None else default_enabled
+        self.trace_memory = trace_memory if trace_memory is not None else default_trace_memory
+        self.report_file = report_file if report_file is not None else default_report_file
+        self.spans = []
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.memory_thread = None
+        self.started_tracing = False
+        self.start_time = None
+        self.wall_seconds = None
+        self.peak_memory = None
+
+    def stack(self):
+        """Spans currently open in this thread, innermost last"""
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def tracing_memory(self):
+        return self.memory_thread == threading.get_ident() and tracemalloc.is_tracing()
+
+    def span(self, name, **attributes):
+        """Context manager timing the stage it wraps"""
+        if not self.enabled:
+            return null_span
+        return Span(self, name, attributes)
+
+    def count(self, name, value = 1):
+        """Add value to the counter called name"""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record(self, record):
+        with self.lock:
+            self.spans.append(record)
+
+    def start(self):
+        """Start the clock of the run and tracemalloc if memory is traced"""
+        self.start_time = time.perf_counter()
+        # reset_peak is needed to measure each span, it is not available before python 3.9
+        if self.enabled and self.trace_memory and hasattr(tracemalloc, "reset_peak"):
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracing = True
+            self.memory_thread = threading.get_ident()
+
+    def stop(self):
+        """Stop the clock of the run and tracemalloc if it was started by start"""
+        self.wall_seconds = time.perf_counter() - self.start_time
+        if self.memory_thread is not None:
+            self.peak_memory = max([span.get("peak_memory_bytes", 0) for span in self.spans], default = 0)
+            self.memory_thread = None
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def stages(self):
+        """Spans aggregated by path: calls, total, mean and maximum seconds and peak memory"""
+        stages = {}
+        for span in self.spans:
+            stage = stages.setdefault(span["path"], {"calls": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+            stage["calls"] += 1
+            stage["total_seconds"] += span["seconds"]
+            stage["max_seconds"] = max(stage["max_seconds"], span["seconds"])
+            if "peak_memory_bytes" in span:
+                stage["peak_memory_bytes"] = max(stage.get("peak_memory_bytes", 0), span["peak_memory_bytes"])
+        for stage in stages.values():
+            stage["mean_seconds"] = stage["total_seconds"] / stage["calls"]
+        return stages
+
+    def report(self):
+        """Machine readable report of the run"""
+        return {"created": datetime.datetime.now().isoformat(timespec = "seconds"),
+                "wall_seconds": self.wall_seconds,
+                "peak_memory_bytes": self.peak_memory,
+                "stages": self.stages(),
+                "counters": dict(self.counters),
+                "spans": list(self.spans)}
+
+    def write_report(self, report_file = None):
+        """Write the report as json, returns the file written"""
+        report_file = report_file if report_file is not None else self.report_file
+        with open(report_file, "w") as file:
+            json.dump(self.report(), file, indent = 2, default = str)
+        return report_file
+
+    def summary(self, top = 15):
+        """Short text summary of the slowest stages and the counters"""
+        lines = []
+        if self.wall_seconds is not None:
+            lines.append(f"Run took {self.wall_seconds:.3f} s")
+        lines.append(f"{'stage':<60} {'calls':>7} {'total s':>9} {'mean ms':>9} {'max ms':>9} {'peak MiB':>9}")
+        stages = sorted(self.stages().items(), key = lambda item: item[1]["total_seconds"], reverse = True)
+        for path, stage in stages[:top]:
+            peak = stage.get("peak_memory_bytes")
+            peak = f"{peak / 2**20:>9.2f}" if peak is not None else f"{'':>9}"
+            lines.append(f"{path[-60:]:<60} {stage['calls']:>7d} {stage['total_seconds']:>9.3f} "
+                         f"{stage['mean_seconds'] * 1e3:>9.2f} {stage['max_seconds'] * 1e3:>9.2f} {peak}")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"{name:<60} {value:>12,}")
+        return "\n".join(lines)
+
+# The instrumentation the pipeline reports to, disabled outside of an instrumented run. It is kept per context
+# so runs in other threads (dash workers, sessions) never report into each other
+disabled = Instrumentation(enabled = False)
+active_instrumentation = contextvars.ContextVar("active_instrumentation", default = disabled)
+
+# Time the stage wrapped by the returned context manager in the active instrumentation
+def span(name, **attributes):
+    instrumentation = active_instrumentation.get()
+    if not instrumentation.enabled:
+        return null_span
+    return instrumentation.span(name, **attributes)
+
+# Add value to a counter of the active instrumentation
+def count(name, value = 1):
+    instrumentation = active_instrumentation.get()
+    if instrumentation.enabled:
+        instrumentation.count(name, value)
+
+# Make an instrumentation the active one for the duration of a run, then report it
+@contextmanager
+def instrumented_run(instrumentation = None, name = "run"):
+    """instrumentation = Instrumentation to report to, True or False to enable it or not,
+                         None for the settings of the environment
+    The json report is written and the summary printed when the run ends, if the instrumentation is enabled.
+    Runs nested inside an instrumented run report to the outer run, runs in other threads report to their own run."""
+    if not isinstance(instrumentation, Instrumentation):
+        instrumentation = Instrumentation(enabled = instrumentation)
+    outer = active_instrumentation.get()
+    if not instrumentation.enabled or outer.enabled:
+        with span(name):
+            yield outer if outer.enabled else instrumentation
+        return
+
+    token = active_instrumentation.set(instrumentation)
+    instrumentation.start()
+    try:
+        with instrumentation.span(name):
+            yield instrumentation
+    finally:
+        active_instrumentation.reset(token)
+        instrumentation.stop()
+        report_file = instrumentation.write_report()
+        print(instrumentation.summary())
+        print(f"Instrumentation report saved to {report_file}")
@@ -0,0 +1,427 @@
+'''
+portfolio_diversifier_market_data.py
+
+Market data providers, local price store and market data access
+
+'''
+
+# Import appropriate modules
+import os
+import time
+import tempfile
+import threading
+import zlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import yfinance as yf
+from portfolio_diversifier_instrumentation import span, count
+
+# Default location of the price store, switch to never touch the network and market data provider,
+# all can be set from the environment
+default_cache_dir = os.environ.get("PORTFOLIO_DIVERSIFIER_CACHE_DIR", "price_cache")
+default_offline = os.environ.get("PORTFOLIO_DIVERSIFIER_OFFLINE", "0") == "1"
+default_provider_name = os.environ.get("PORTFOLIO_DIVERSIFIER_PROVIDER", "yahoo")
+
+# Download the daily close prices of a ticker from yahoo, start date included and end date excluded
+def download_close(ticker, start_date, end_date):
+    close = yf.Ticker(ticker).history(start=start_date, end=end_date).Close
+    # keep the dates without time zone so stored and downloaded prices line up
+    if close.index.tz is not None:
+        close.index = close.index.tz_localize(None)
+    return close
+
+# Keep the close prices from start date (included) to end date (excluded)
+def select_dates(close, start_date, end_date, ticker):
+    selected = close[(close.index >= pd.Timestamp(start_date)) & (close.index < pd.Timestamp(end_date))]
+    selected.name = ticker
+    return selected
+
+# Slice the close prices, sorted by date, from start date (included) to end date (excluded) without copying them
+def slice_dates(close, start_date, end_date, ticker):
+    first, last = close.index.searchsorted([pd.Timestamp(start_date), pd.Timestamp(end_date)])
+    selected = close.iloc[first:last]
+    selected.name = ticker
+    return selected
+
+# Market data providers all answer close(ticker, start_date, end_date) with the daily close prices as a series
+# and say with offline whether they work without the network
+
+# Daily close prices downloaded from yahoo
+class YahooProvider:
+    """Yahoo Provider: downloads daily close prices from yahoo finance."""
+
+    offline = False
+
+    def close(self, ticker, start_date, end_date):
+        close = download_close(ticker, start_date, end_date)
+        close.name = ticker
+        return close
+
+# Daily close prices read from a directory of files, one file per ticker
+class LocalDirectoryProvider:
+    """Local Directory Provider: daily close prices read from {ticker}.parquet or {ticker}.csv files.
+    directory = directory holding the files, each with a date index (first column) and a Close column
+    Parquet files need pyarrow or fastparquet, csv files only need pandas.
+    Each file is read once and kept in memory."""
+
+    offline = True
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.closes = {}
+        self.lock = threading.Lock()
+
+    def path(self, ticker):
+        """File holding the prices of the ticker, parquet preferred over csv"""
+        for suffix in [".parquet", ".csv"]:
+            path = os.path.join(self.directory, f"{ticker}{suffix}")
+            if os.path.exists(path):
+                return path
+        raise FileNotFoundError(f"No price file for '{ticker}' in {self.directory}")
+
+    def read(self, ticker):
+        """All the close prices stored for the ticker"""
+        with self.lock:
+            if ticker not in self.closes:
+                path = self.path(ticker)
+                if path.endswith(".parquet"):
+                    prices_df = pd.read_parquet(path)
+                else:
+                    prices_df = pd.read_csv(path, index_col = 0, parse_dates = True)
+                close = prices_df['Close'].astype(float)
+                close.index = pd.DatetimeIndex(close.index)
+                if close.index.tz is not None:
+                    close.index = close.index.tz_localize(None)
+                self.closes[ticker] = close.sort_index()
+            return self.closes[ticker]
+
+    def close(self, ticker, start_date, end_date):
+        return select_dates(self.read(ticker), start_date, end_date, ticker)
+
+# Write the close prices of the tickers from any provider into a directory a LocalDirectoryProvider can read
+def export_prices(provider, ticker_list, start_date, end_date, directory, file_format = "csv"):
+    os.makedirs(directory, exist_ok = True)
+    for ticker in ticker_list:
+        prices_df = provider.close(ticker, start_date, end_date).rename('Close').to_frame()
+        prices_df.index.name = 'Date'
+        if file_format == "parquet":
+            prices_df.to_parquet(os.path.join(directory, f"{ticker}.parquet"))
+        else:
+            prices_df.to_csv(os.path.join(directory, f"{ticker}.csv"))
+
+# Deterministic synthetic daily close prices with correlated returns, for any number of tickers
+class SyntheticProvider:
+    """Synthetic Provider: generates daily close prices for any ticker name without the network.
+    seed = seed of the generator, the same seed and ticker always give the same prices (default 0)
+    num_factors = number of common factors driving the returns (default 3)
+    correlation = share of the return variance explained by the common factors (default 0.5)
+    annual_return = average annual return (default 0.07)
+    annual_volatility = average annual volatility, each ticker gets between half and one and a half times it (default 0.18)
+    first_date, last_date = business day calendar the prices are generated on (default 1980 to 2040)
+    The common factors are generated once for the whole calendar, each ticker draws its factor loadings,
+    volatility and idiosyncratic returns from a generator seeded by the seed and the ticker name,
+    so prices do not depend on the date range or on which other tickers are requested."""
+
+    offline = True
+
+    def __init__(self, seed = 0, num_factors = 3, correlation = 0.5, annual_return = 0.07, annual_volatility = 0.18,
+                 first_date = '1980-01-01', last_date = '2040-12-31', periodicity = 252):
+        self.seed = seed
+        self.correlation = correlation
+        self.annual_return = annual_return
+        self.annual_volatility = annual_volatility
+        self.periodicity = periodicity
+        self.dates = pd.bdate_range(first_date, last_date)
+        self.factors = np.random.default_rng(seed).standard_normal((len(self.dates), num_factors))
+
+    def ticker_returns(self, ticker_list):
+        """Daily returns of the tickers over the whole calendar, one column per ticker"""
+        num_days, num_factors = self.factors.shape
+        loadings = np.empty((num_factors, len(ticker_list)))
+        volatility = np.empty(len(ticker_list))
+        idiosyncratic = np.empty((num_days, len(ticker_list)))
+        for column, ticker in enumerate(ticker_list):
+            # crc32 is stable across runs, unlike the hash of a string
+            rng = np.random.default_rng([self.seed, zlib.crc32(str(ticker).encode())])
+            ticker_loadings = rng.standard_normal(num_factors)
+            loadings[:, column] = ticker_loadings / np.linalg.norm(ticker_loadings)
+            volatility[column] = self.annual_volatility * rng.uniform(0.5, 1.5)
+            idiosyncratic[:, column] = rng.standard_normal(num_days)
+        shocks = np.sqrt(self.correlation) * (self.factors @ loadings) + np.sqrt(1 - self.correlation) * idiosyncratic
+        return self.annual_return / self.periodicity + shocks * volatility / np.sqrt(self.periodicity)
+
+    def close_frame(self, ticker_list, start_date, end_date):
+        """Close prices of many tickers at once, one column per ticker"""
+        prices = 100 * np.cumprod(1 + self.ticker_returns(ticker_list), axis = 0)
+        close_df = pd.DataFrame(prices, index = self.dates, columns = list(ticker_list))
+        return close_df[(close_df.index >= pd.Timestamp(start_date)) & (close_df.index < pd.Timestamp(end_date))]
+
+    def close(self, ticker, start_date, end_date):
+        close = self.close_frame([ticker], start_date, end_date)[ticker]
+        close.name = ticker
+        return close
+
+# Build a provider from its name: yahoo, synthetic, synthetic:<seed> or the path of a price directory
+def provider_from_name(name):
+    if name == "yahoo":
+        return YahooProvider()
+    if name == "synthetic":
+        return SyntheticProvider()
+    if name.startswith("synthetic:"):
+        return SyntheticProvider(seed = int(name.split(":", 1)[1]))
+    if os.path.isdir(name):
+        return LocalDirectoryProvider(name)
+    raise ValueError(f"Unknown market data provider '{name}'")
+
+# On-disk store of daily close prices, one file per ticker, topped up incrementally from yahoo
+class PriceStore:
+    """Price Store: persistent local copy of daily close prices.
+    cache_dir = directory holding one file per ticker (default price_cache or $PORTFOLIO_DIVERSIFIER_CACHE_DIR)
+    offline = never download, only serve what is already stored (default $PORTFOLIO_DIVERSIFIER_OFFLINE == 1)
+    provider = market data provider the missing date ranges are fetched from (default YahooProvider())
+    recheck_after = how long a date range the provider answered without prices is trusted before it is asked again,
+                    a failed download can come back empty instead of raising (default one day)
+    Each file is a numpy archive with one array per column (dates, close) plus the date range the provider answered
+    (coverage), the part of it answered with prices (confirmed) and when it last answered without prices (checked_at).
+    Files are written to a temporary file and moved into place, so concurrent readers always see a complete file."""
+
+    def __init__(self, cache_dir = None, offline = None, provider = None, recheck_after = pd.Timedelta(days = 1)):
+        self.cache_dir = cache_dir if cache_dir is not None else default_cache_dir
+        self.offline = offline if offline is not None else default_offline
+        self.provider = provider if provider is not None else YahooProvider()
+        self.recheck_after = recheck_after
+
+    def path(self, ticker):
+        """File holding the prices of the ticker"""
+        return os.path.join(self.cache_dir, f"{ticker}.npz")
+
+    def read(self, ticker):
+        """Return the stored close prices, the (start, end) date ranges covered and confirmed and when the provider
+        last answered without prices, or (None, None, None, NaT)"""
+        try:
+            with np.load(self.path(ticker)) as data:
+                close = pd.Series(data["close"], index = pd.DatetimeIndex(data["dates"]), name = ticker)
+                coverage = (pd.Timestamp(data["coverage"][0]), pd.Timestamp(data["coverage"][1]))
+                # files written before empty answers were recorded only cover date ranges answered with prices
+                confirmed = coverage
+                if "confirmed" in data.files:
+                    confirmed = (pd.Timestamp(data["confirmed"][0]), pd.Timestamp(data["confirmed"][1]))
+                checked_at = pd.Timestamp(data["checked_at"][0]) if "checked_at" in data.files else pd.NaT
+            return close, coverage, None if pd.isna(confirmed[0]) else confirmed, checked_at
+        except FileNotFoundError:
+            return None, None, None, pd.NaT
+
+    def write(self, ticker, close, coverage, confirmed = None, checked_at = pd.NaT):
+        """Atomically replace the stored close prices of the ticker"""
+        os.makedirs(self.cache_dir, exist_ok = True)
+        file_descriptor, temporary_path = tempfile.mkstemp(dir = self.cache_dir, suffix = ".npz.tmp")
+        try:
+            with os.fdopen(file_descriptor, "wb") as file:
+                np.savez(file,
+                         dates = close.index.values.astype("datetime64[ns]"),
+                         close = close.values.astype(float),
+                         coverage = np.array(coverage, dtype = "datetime64[ns]"),
+                         confirmed = pd.DatetimeIndex(confirmed if confirmed is not None else [pd.NaT, pd.NaT]).values,
+                         checked_at = pd.DatetimeIndex([checked_at]).values)
+            os.replace(temporary_path, self.path(ticker))
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+    def close(self, ticker, start_date, end_date):
+        """Return the daily close prices of the ticker from start date (included) to end date (excluded),
+        downloading and storing only the date ranges not stored yet."""
+        start_date, end_date = pd.Timestamp(start_date), pd.Timestamp(end_date)
+        close, coverage, confirmed, checked_at = self.read(ticker)
+
+        if not self.offline:
+            now = pd.Timestamp.now()
+            # date ranges answered without prices are asked again once the check is older than recheck_after
+            if not pd.isna(checked_at) and now - checked_at >= self.recheck_after:
+                coverage = confirmed
+            if coverage is None:
+                missing = [(start_date, end_date)]
+            else:
+                missing = []
+                if start_date < coverage[0]:
+                    missing.append((start_date, coverage[0]))
+                if end_date > coverage[1]:
+                    missing.append((coverage[1], end_date))
+
+            count("price_store_downloads" if len(missing) > 0 else "price_store_hits")
+            downloaded = []
+            for missing_start, missing_end in missing:
+                missing_close = self.provider.close(ticker, missing_start, missing_end)
+                if missing_close.shape[0] > 0:
+                    downloaded.append(missing_close)
+                # today's prices may still change, so the range answered never extends past today
+                answered = (missing_start, min(missing_end, now.normalize()))
+                if answered[1] <= answered[0]:
+                    continue
+                # an answer without error covers its date range even without prices, e.g. before the ticker
+                # was listed or over a holiday, but it is only confirmed if it returned prices
+                coverage = answered if coverage is None else (min(coverage[0], answered[0]), max(coverage[1], answered[1]))
+                if missing_close.shape[0] == 0:
+                    checked_at = now
+                elif confirmed is None:
+                    confirmed = answered
+                elif answered[0] <= confirmed[1] and answered[1] >= confirmed[0]:
+                    confirmed = (min(confirmed[0], answered[0]), max(confirmed[1], answered[1]))
+            if len(downloaded) > 0:
+                if close is not None:
+                    downloaded.append(close)
+                # the stable sort keeps the freshly downloaded price first on the days stored already
+                close = pd.concat(downloaded).sort_index(kind = "mergesort")
+                close = close[~close.index.duplicated(keep = "first")]
+            elif close is None:
+                close = pd.Series(dtype = float, index = pd.DatetimeIndex([]), name = ticker)
+            if coverage is not None and len(missing) > 0:
+                self.write(ticker, close, coverage, confirmed, checked_at)
+
+        if close is None:
+            return pd.Series(dtype = float, name = ticker)
+        return select_dates(close, start_date, end_date, ticker)
+
+# In-process market data shared by the calculations, the UI and the forecasts
+class MarketDataSession:
+    """Market Data Session: keeps the close prices of each ticker in memory once, over the widest date range asked for,
+    and answers every date range within it with a slice of them.
+    store = PriceStore or provider the prices are read through
+    provider = market data provider used when no store is given, providers that need the network are read
+               through a PriceStore, the others directly (default from $PORTFOLIO_DIVERSIFIER_PROVIDER, yahoo)
+    Returns, Monte Carlo close frames and aligned matrices are all derived from the one copy of the close prices,
+    which callers should treat as read only. The session can be shared between threads."""
+
+    def __init__(self, store = None, provider = None):
+        if store is None:
+            provider = provider if provider is not None else provider_from_name(default_provider_name)
+            store = provider if provider.offline else PriceStore(provider = provider)
+        self.store = store
+        self.closes = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    @property
+    def offline(self):
+        return self.store.offline
+
+    def held(self, ticker, start_date, end_date):
+        """Close prices held for the ticker if they cover the date range, or None"""
+        held = self.closes.get(ticker)
+        if held is not None and held[1] <= start_date and end_date <= held[2]:
+            return held[0]
+        return None
+
+    def close(self, ticker, start_date, end_date):
+        """Daily close prices of the ticker, fetched through the store the first time the date range is not held"""
+        start_date, end_date = pd.Timestamp(start_date), pd.Timestamp(end_date)
+        # prices already fetched are read without taking any lock
+        close = self.held(ticker, start_date, end_date)
+        if close is not None:
+            count("market_data_session_hits")
+            return slice_dates(close, start_date, end_date, ticker)
+        # one lock per ticker so concurrent requests for the same prices fetch them once
+        with self.lock:
+            ticker_lock = self.locks.setdefault(ticker, threading.Lock())
+        with ticker_lock:
+            close = self.held(ticker, start_date, end_date)
+            if close is not None:
+                count("market_data_session_hits")
+                return slice_dates(close, start_date, end_date, ticker)
+            count("market_data_session_misses")
+            # the range fetched spans the one held already, so it replaces it and the ticker is still held once
+            held = self.closes.get(ticker)
+            fetch_start = start_date if held is None else min(start_date, held[1])
+            fetch_end = end_date if held is None else max(end_date, held[2])
+            close = self.store.close(ticker, fetch_start, fetch_end)
+            # an empty answer is not kept so a retry asks the store again
+            if close.shape[0] > 0:
+                self.closes[ticker] = (close, fetch_start, fetch_end)
+        return slice_dates(close, start_date, end_date, ticker)
+
+    def returns(self, ticker, start_date, end_date):
+        """Daily returns of the ticker"""
+        returns = self.close(ticker, start_date, end_date).pct_change()
+        returns.name = ticker
+        return returns
+
+    def close_frame(self, ticker_list, start_date, end_date):
+        """Close prices of the tickers with (ticker, 'close') columns, as expected by MCSimulation"""
+        close_df = pd.concat([self.close(ticker, start_date, end_date) for ticker in ticker_list], axis = 1)
+        close_df.columns = pd.MultiIndex.from_product([list(ticker_list), ['close']])
+        return close_df
+
+    def aligned_returns(self, ticker_list, start_date, end_date):
+        """Daily returns of the tickers aligned in one data frame, one column per ticker"""
+        return pd.DataFrame({ticker: self.returns(ticker, start_date, end_date) for ticker in ticker_list})
+
+    def clear(self):
+        """Forget the prices held in memory"""
+        with self.lock:
+            self.closes = {}
+            self.locks = {}
+
+# Result of fetching the daily returns of many tickers
+class FetchResult:
+    """Fetch Result: daily returns of the tickers fetched and the reason the others failed.
+    returns_by_ticker = daily returns of each ticker fetched, on its own trading dates
+    failed = dictionary of ticker to error message for the tickers that could not be fetched
+    returns = the fetched returns aligned in one data frame, one column per ticker"""
+
+    def __init__(self, returns_by_ticker, failed):
+        self.returns_by_ticker = returns_by_ticker
+        self.failed = failed
+        self.returns = pd.DataFrame(returns_by_ticker)
+
+    def report(self):
+        """Short text summary of the tickers that failed"""
+        return "\n".join(f"Sorry, Data not available for '{ticker}': Exception is {error}"
+                         for ticker, error in self.failed.items())
+
+# Fetch the daily returns of one ticker, retrying with exponential backoff
+def fetch_ticker_returns(ticker, start_date, end_date, store, retries = 3, backoff = 1.0):
+    # an offline store will not find more data on a second attempt
+    attempts = 1 if store.offline else retries
+    for attempt in range(attempts):
+        try:
+            with span("fetch ticker", ticker = ticker, attempt = attempt):
+                price_df = store.close(ticker, start_date, end_date).pct_change()
+            # if no data retrieved raise exception
+            if price_df.shape[0] == 0:
+                raise Exception("No Prices.")
+            return price_df
+        except Exception:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+# Fetch the daily returns of all tickers concurrently before any metric is calculated
+def fetch_returns(ticker_list, start_date, end_date, store = None, max_workers = 8, retries = 3, backoff = 1.0):
+    """ticker_list = tickers to fetch, duplicates are fetched once
+    store = PriceStore or MarketDataSession to read through (default PriceStore())
+    max_workers = maximum number of tickers fetched at the same time
+    retries = attempts per ticker before it is reported as failed, waiting backoff * 2**attempt seconds in between
+    Returns a FetchResult, a failing ticker never stops the others."""
+    store = store if store is not None else PriceStore()
+    tickers = list(dict.fromkeys(ticker_list))
+    fetched = {}
+    failed = {}
+    # each fetch runs in a copy of the caller's context so its spans report to the caller's instrumented run
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        futures = {executor.submit(contextvars.copy_context().run, fetch_ticker_returns,
+                                   ticker, start_date, end_date, store, retries, backoff): ticker
+                   for ticker in tickers}
+        # progress is printed here, in the calling thread, so the lines of different tickers never interleave
+        for future in as_completed(futures):
+            ticker = futures[future]
+            try:
+                fetched[ticker] = future.result()
+                print(f"Processed Ticker {ticker}")
+            except Exception as ex:
+                failed[ticker] = str(ex)
+                print(f"Failed Ticker {ticker}")
+    # the returns keep the order of ticker_list whatever order the fetches finished in
+    returns_by_ticker = {ticker: fetched[ticker] for ticker in tickers if ticker in fetched}
+    return FetchResult(returns_by_ticker, {ticker: failed[ticker] for ticker in tickers if ticker in failed})
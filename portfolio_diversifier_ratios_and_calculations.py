@@ -11,10 +11,23 @@ import pandas as pd
 import datetime
 import numpy as np
 import yfinance as yf
-from pathlib import Path
-from datetime import datetime
 import hvplot
 import hvplot.pandas
+from portfolio_diversifier_market_data import MarketDataSession, fetch_returns
+from portfolio_diversifier_results import ResultStore
+from portfolio_diversifier_instrumentation import span, count, instrumented_run
+import hashlib
+import threading
+from collections import namedtuple, OrderedDict
+# numba compiles the single pass statistics kernel when it is installed, numpy is used otherwise
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Prices fetched during this run, shared by the calculations, the UI and the forecasts.
+# Yahoo prices are read through the local price store, $PORTFOLIO_DIVERSIFIER_PROVIDER selects another provider
+market_data_session = MarketDataSession()
 
 # Define function to calculate the sharpe ratio
 # The function takes in the data frame with daily return data
@@ -29,13 +42,15 @@ def sharpe_ratio(df, risk_free = 0, periodicity = 252):
     return calculated_sharpe
 
 # Define function to retrieve ticker daily return data from yahoo using ticker, start date and end date
-def retrieve_yahoo_data(ticker = 'spy', start_date = '2007-07-01', end_date = '2020-12-31'):
+# The prices already fetched in this run and the local price store are consulted first,
+# only the missing dates are downloaded
+def retrieve_yahoo_data(ticker = 'spy', start_date = '2007-07-01', end_date = '2020-12-31', store = None):
     try:
         # get data based on ticker
-        yahoo_data = yf.Ticker(ticker)
+        store = store if store is not None else market_data_session
         print(f"Processing Ticker {ticker}")
         # select data using start date and end data and calculate the daily return
-        price_df = yahoo_data.history(start=start_date, end=end_date).Close.pct_change()
+        price_df = store.close(ticker, start_date, end_date).pct_change()
         price_df.name = ticker
         # if no data retrieved raise exception
         if price_df.shape[0] == 0:
@@ -46,13 +61,15 @@ def retrieve_yahoo_data(ticker = 'spy', start_date = '2007-07-01', end_date = '2
         print(f"Sorry, Data not available for '{ticker}': Exception is {ex}")
 
 # Define function to retrieve ticker daily close data from yahoo using ticker, start date and end date
-def retrieve_yahoo_data_close(ticker = 'spy', start_date = '2007-07-01', end_date = '2020-12-31'):
+# The prices already fetched in this run and the local price store are consulted first,
+# only the missing dates are downloaded
+def retrieve_yahoo_data_close(ticker = 'spy', start_date = '2007-07-01', end_date = '2020-12-31', store = None):
     try:
         # get data based on ticker
-        yahoo_data = yf.Ticker(ticker)
+        store = store if store is not None else market_data_session
         print(f"Processing Ticker {ticker}")
         # select data using start date and end data and save the Close data
-        price_df = yahoo_data.history(start=start_date, end=end_date).Close
+        price_df = store.close(ticker, start_date, end_date)
         price_df.name = ticker
         # if no data retrieved raise exception
         if price_df.shape[0] == 0:
@@ -160,6 +177,94 @@ def return_maximum_drawdown_ratio(df, risk_free = 0, periodicity = 252):
     maximum_drawdown = get_maximum_drawdown(df, return_data = False)
     return (annual_return - risk_free) / abs(maximum_drawdown)
 
+# gather the statistics of a 1-D array of returns in one pass: number of valid returns, running mean and sum of
+# squared deviations (Welford), sum of squared downside, final net asset value and maximum drawdown
+def return_statistics_loop(values):
+    count = 0
+    mean = 0.0
+    sum_of_squares = 0.0
+    downside_sum_of_squares = 0.0
+    net_asset_value = 1.0
+    peak = -np.inf
+    maximum_drawdown_number = 0.0
+    for value in values:
+        # missing returns leave the net asset value unchanged, like nancumprod
+        if value == value:
+            count += 1
+            delta = value - mean
+            mean += delta / count
+            sum_of_squares += delta * (value - mean)
+            if value < 0:
+                downside_sum_of_squares += value * value
+            net_asset_value *= 1 + value
+        if net_asset_value > peak:
+            peak = net_asset_value
+        drawdown = (peak - net_asset_value) / peak
+        if drawdown > maximum_drawdown_number:
+            maximum_drawdown_number = drawdown
+    return count, mean, sum_of_squares, downside_sum_of_squares, net_asset_value, maximum_drawdown_number
+
+# the same statistics with numpy, one vectorized operation per statistic
+def return_statistics_numpy(values):
+    valid = ~np.isnan(values)
+    count = int(np.count_nonzero(valid))
+    mean = np.nanmean(values) if count > 0 else 0.0
+    sum_of_squares = np.nansum((values - mean) ** 2)
+    downside_sum_of_squares = np.nansum(np.minimum(values, 0) ** 2)
+    cumprod_return = np.nancumprod(values + 1.0)
+    peak_return = np.maximum.accumulate(cumprod_return)
+    maximum_drawdown_number = max(np.max((peak_return - cumprod_return) / peak_return), 0.0)
+    return count, mean, sum_of_squares, downside_sum_of_squares, cumprod_return[-1], maximum_drawdown_number
+
+# use the compiled loop when numba is available
+return_statistics_kernel = njit(cache = True, error_model = "numpy")(return_statistics_loop) if njit is not None else return_statistics_numpy
+
+# Statistics of a return series every ratio of the risk return tables can be derived from
+class ReturnStatistics(namedtuple('ReturnStatistics', ['length', 'count', 'mean', 'std', 'target_downside_deviation',
+                                                       'net_asset_value', 'maximum_drawdown'])):
+    """Return Statistics: gathered in a single pass over the returns by return_statistics.
+    length = number of returns, including the missing ones
+    count = number of returns that are not missing
+    mean, std = mean and sample standard deviation of the returns that are not missing
+    target_downside_deviation = downside deviation below 0, missing returns count as no downside
+    net_asset_value = final value of 1 invested at the start
+    maximum_drawdown = largest drop from a peak of the net asset value, as a positive number
+    The ratios match sharpe_ratio, sortino_ratio, annualized_return, maximum_drawdown and
+    return_maximum_drawdown_ratio applied to a pandas series of the same returns."""
+
+    __slots__ = ()
+
+    def sharpe_ratio(self, risk_free = 0, periodicity = 252):
+        risk_free = (1 + risk_free)**(1 / periodicity) - 1
+        return (self.mean - risk_free) / self.std * np.sqrt(periodicity)
+
+    def sortino_ratio(self, risk_free = 0, periodicity = 252):
+        risk_free = (1 + risk_free)**(1 / periodicity) - 1
+        return (self.mean - risk_free) / self.target_downside_deviation * np.sqrt(periodicity)
+
+    def annualized_return(self, periodicity = 252):
+        return self.net_asset_value ** (1 / (self.length / periodicity)) - 1
+
+    def return_maximum_drawdown_ratio(self, risk_free = 0, periodicity = 252):
+        risk_free = (1 + risk_free)**(1 / periodicity) - 1
+        return (self.annualized_return(periodicity = periodicity) - risk_free) / self.maximum_drawdown
+
+# calculate the statistics of a return series (series, 1-D array or single column array) in one pass
+def return_statistics(df):
+    values = np.ascontiguousarray(df, dtype = float).ravel()
+    count, mean, sum_of_squares, downside_sum_of_squares, net_asset_value, maximum_drawdown_number = \
+        return_statistics_kernel(values)
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        std = np.sqrt(sum_of_squares / (count - 1)) if count > 1 else np.nan
+        mean = mean if count > 0 else np.nan
+    return ReturnStatistics(length = len(values),
+                            count = count,
+                            mean = mean,
+                            std = std,
+                            target_downside_deviation = np.sqrt(downside_sum_of_squares / len(values)),
+                            net_asset_value = net_asset_value,
+                            maximum_drawdown = maximum_drawdown_number)
+
 # calculate average of the positives
 def average_positive(ret, drop_zero = 1):
     if drop_zero > 0:
@@ -179,6 +284,89 @@ def average_negative(ret):
     else:
         return -1*0.000000000000000000000000000001
 
+# Base portfolios already built, keyed on everything their statistics depend on, the least recently used are dropped
+base_portfolio_cache = OrderedDict()
+base_portfolio_cache_size = 32
+base_portfolio_cache_lock = threading.Lock()
+
+# Digest of the dates and values of a return series, so revised prices over the same dates give another key
+def returns_fingerprint(returns):
+    digest = hashlib.sha1(np.ascontiguousarray(returns.index.values).tobytes())
+    digest.update(np.ascontiguousarray(returns.values, dtype = float).tobytes())
+    return digest.hexdigest()
+
+# Base (replacement) portfolio built once per run, caching the statistics every candidate asset is compared with
+class BasePortfolio:
+    """Base Portfolio: weighted stock/bond portfolio whose return to risk statistics are calculated once and reused.
+    returns = daily returns of the base portfolio
+    risk_free_rate = Tbill rate (annualized) the cached ratios are calculated with
+    financing_rate = portfolio margin/borrowing cost (annualized) used by the runs sharing this base portfolio
+    periodicity = the frequency of the data, typically 12 for monthly or 252 for trading day count
+    sortino, target_downside_deviation, annualized_return, drawdown, maximum_drawdown and
+    return_maximum_drawdown are precomputed from the returns. Use BasePortfolio.build to share instances."""
+
+    def __init__(self, returns, risk_free_rate = 0, financing_rate = 0, periodicity = 252):
+        self.returns = returns
+        self.risk_free_rate = risk_free_rate
+        self.financing_rate = financing_rate
+        self.periodicity = periodicity
+        # precompute the statistics shared by all WARP calculations
+        self.sortino = sortino_ratio(returns, risk_free = risk_free_rate, periodicity = periodicity)
+        self.target_downside_deviation = target_downside_deviation(returns, periodicity = periodicity)
+        self.annualized_return = annualized_return(returns, periodicity = periodicity)
+        self.drawdown = get_maximum_drawdown(returns, return_data = True)
+        self.maximum_drawdown = np.abs(np.nanmin(self.drawdown))
+        risk_free = (1 + risk_free_rate)**(1 / periodicity) - 1
+        self.return_maximum_drawdown = (self.annualized_return - risk_free) / self.maximum_drawdown
+
+    @classmethod
+    def build(cls, stock_returns, bond_returns, weight_stock, weight_bond,
+              risk_free_rate = 0, financing_rate = 0, periodicity = 252):
+        """Build the base portfolio from stock and bond returns, reusing a cached one when the returns, weights,
+        risk free rate and financing rate have not changed."""
+        key = (stock_returns.name, bond_returns.name, weight_stock, weight_bond,
+               returns_fingerprint(stock_returns), returns_fingerprint(bond_returns),
+               risk_free_rate, financing_rate, periodicity)
+        with base_portfolio_cache_lock:
+            base_portfolio = base_portfolio_cache.get(key)
+            if base_portfolio is not None:
+                base_portfolio_cache.move_to_end(key)
+        if base_portfolio is not None:
+            count("base_portfolio_cache_hits")
+            return base_portfolio
+
+        count("base_portfolio_cache_misses")
+        # calculate the weighted returns
+        returns = (weight_stock * stock_returns) + (weight_bond * bond_returns)
+        base_portfolio = cls(returns, risk_free_rate, financing_rate, periodicity)
+        with base_portfolio_cache_lock:
+            base_portfolio_cache[key] = base_portfolio
+            while len(base_portfolio_cache) > base_portfolio_cache_size:
+                base_portfolio_cache.popitem(last = False)
+        return base_portfolio
+
+    def matches(self, risk_free_rate, periodicity):
+        """True if the cached ratios were calculated with this risk free rate and periodicity"""
+        return self.risk_free_rate == risk_free_rate and self.periodicity == periodicity
+
+# get the return series of a base portfolio given either as returns or as a BasePortfolio
+def base_portfolio_returns(base_portfolio):
+    if isinstance(base_portfolio, BasePortfolio):
+        return base_portfolio.returns
+    return base_portfolio
+
+# get the sortino ratio of a base portfolio, using the cached value when possible
+def base_portfolio_sortino_ratio(base_portfolio, risk_free = 0, periodicity = 252):
+    if isinstance(base_portfolio, BasePortfolio) and base_portfolio.matches(risk_free, periodicity):
+        return base_portfolio.sortino
+    return sortino_ratio(base_portfolio_returns(base_portfolio), risk_free = risk_free, periodicity = periodicity)
+
+# get the return to maximum drawdown ratio of a base portfolio, using the cached value when possible
+def base_portfolio_return_maximum_drawdown_ratio(base_portfolio, risk_free = 0, periodicity = 252):
+    if isinstance(base_portfolio, BasePortfolio) and base_portfolio.matches(risk_free, periodicity):
+        return base_portfolio.return_maximum_drawdown
+    return return_maximum_drawdown_ratio(base_portfolio_returns(base_portfolio), risk_free = risk_free, periodicity = periodicity)
+
 # calculate the WARP (Win Above Replacement Portfolio or Win Above Base Portfolio)
 def win_above_base_portfolio(
                     new_asset,
@@ -190,7 +378,7 @@ def win_above_base_portfolio(
                     periodicity = 252):
     """Win Above Base Portolio (WABP): Total score to evaluate whether any new investment improves or hurts the return to risk of your total portfolio.
     new_asset = returns of the asset you are thinking of adding to your portfolio
-    base_portfolio = returns of your pre-existing portfolio (e.g. S&P 500 Index, 60/40 Stock-Bond Portfolio)
+    base_portfolio = returns of your pre-existing portfolio (e.g. S&P 500 Index, 60/40 Stock-Bond Portfolio), or a BasePortfolio
     risk_free_rate = Tbill rate (annualized)
     financing_rate = portfolio margin/borrowing cost (annualized) to layer new asset on top of prevailing portfolio (e.g. LIBOR + 60bps). No financing rate is reasonable for derivate overlay products.
     weight_asset = % weight you wish to overlay for the new asset on top of the previous portfolio, 25% overlay allocation is standard
@@ -201,15 +389,16 @@ def win_above_base_portfolio(
     financing_rate = (1 + financing_rate)**(1 / periodicity) - 1
 
     #Calculate Base Portfolio Sortino Ratio
-    base_portfolio_sortino = sortino_ratio(base_portfolio, risk_free = risk_free_rate, periodicity = periodicity)
+    base_portfolio_sortino = base_portfolio_sortino_ratio(base_portfolio, risk_free = risk_free_rate, periodicity = periodicity)
 
     #Calculate Base Portfolio Return to Max Drawdown
-    base_portfolio_return_maximum_drawdown = return_maximum_drawdown_ratio(
+    base_portfolio_return_maximum_drawdown = base_portfolio_return_maximum_drawdown_ratio(
                                                     base_portfolio,
                                                     risk_free = risk_free_rate,
                                                     periodicity = periodicity)
 
     #Calculate New Portfolio Sortino Ratio
+    base_portfolio = base_portfolio_returns(base_portfolio)
     new_portfolio = (new_asset - financing_rate) * (weight_asset) + base_portfolio * (weight_base_portfolio)
     new_portfolio_sortino = sortino_ratio(new_portfolio, risk_free = risk_free_rate, periodicity = periodicity)
 
@@ -232,7 +421,7 @@ def wabp_additive_sortino(new_asset,
                           periodicity = 252):
     """Win Above Base Portolio (WABP) Sortino +: Isolates new investment effect on total portfolio Sortino Ratio, which is a portion of the holistic WABP score.
     new_asset = returns of the asset you are thinking of adding to your portfolio
-    base_portfolio = returns of your pre-existing portfolio (e.g. S&P 500 Index, 60/40 Stock-Bond Portfolio)
+    base_portfolio = returns of your pre-existing portfolio (e.g. S&P 500 Index, 60/40 Stock-Bond Portfolio), or a BasePortfolio
     risk_free_rate = Tbill rate (annualized)
     financing_rate = portfolio margin/borrowing cost (annualized) to layer new asset on top of prevailing portfolio (e.g. LIBOR + 60bps). No financing rate is reasonable for derivate overlay products.
     weight_asset = % weight you wish to overlay for the new asset on top of the previous portfolio, 25% overlay allocation is standard (translates to 20% in new portfolio)
@@ -243,9 +432,10 @@ def wabp_additive_sortino(new_asset,
     financing_rate = (1+financing_rate)**(1/periodicity)-1
 
     #Calculate Replacement Portfolio Sortino Ratio
-    base_portfolio_sortino = sortino_ratio(base_portfolio, risk_free = risk_free_rate, periodicity = periodicity)
+    base_portfolio_sortino = base_portfolio_sortino_ratio(base_portfolio, risk_free = risk_free_rate, periodicity = periodicity)
 
     #Calculate New Portfolio Sortino Ratio
+    base_portfolio = base_portfolio_returns(base_portfolio)
     new_portfolio = (new_asset - financing_rate)*(weight_asset) + base_portfolio * (weight_base_portfolio)
     new_portfolio_sortino = sortino_ratio(new_portfolio, risk_free = risk_free_rate, periodicity = periodicity)
 
@@ -265,7 +455,7 @@ def wabp_additive_return_maximum_drawdown(
                             periodicity = 252):
     """Win Above Base Portolio (WABP) Ret to Max DD +: Isolates new investment effect on total portfolio Return to Maximum Drawdown, which is a portion of the holistic WABP score.
     new_asset = returns of the asset you are thinking of adding to your portfolio
-    base_portfolio = returns of your pre-existing portfolio (e.g. S&P 500 Index, 60/40 Stock-Bond Portfolio)
+    base_portfolio = returns of your pre-existing portfolio (e.g. S&P 500 Index, 60/40 Stock-Bond Portfolio), or a BasePortfolio
     risk_free_rate = Tbill rate (annualized)
     financing_rate = portfolio margin/borrowing cost (annualized) to layer new asset on top of prevailing portfolio (e.g. LIBOR + 60bps). No financing rate is reasonable for derivate overlay products.
     weight_asset = % weight you wish to overlay for the new asset on top of the previous portfolio, 25% overlay allocation is standard
@@ -276,12 +466,13 @@ def wabp_additive_return_maximum_drawdown(
     financing_rate = (1 + financing_rate)**(1/periodicity)-1
 
     #Calculate Replacement Portfolio Return to Max Drawdown
-    base_portfolio_return_maximum_drawdown = return_maximum_drawdown_ratio(
+    base_portfolio_return_maximum_drawdown = base_portfolio_return_maximum_drawdown_ratio(
                                                                 base_portfolio,
                                                                 risk_free = risk_free_rate,
                                                                 periodicity = periodicity)
 
     #Calculate New Portfolio Return to Max Drawdown
+    base_portfolio = base_portfolio_returns(base_portfolio)
     new_portfolio = (new_asset-financing_rate)*(weight_asset) + base_portfolio * (weight_base_portfolio)
     new_portfolio_return_maximum_drawdown = return_maximum_drawdown_ratio(new_portfolio, risk_free=risk_free_rate, periodicity=periodicity)
 
@@ -300,7 +491,7 @@ def wabp_portfolio_return(new_asset,
                      periodicity = 252):
     """Win Above Base Portolio (WABP) Portfolio Return: Returns of the aggregate portfolio after a new asset is financed and layered on top of the replacement portfolio.
     new_asset = returns of the asset you are thinking of adding to your portfolio
-    base_portfolio = returns of your pre-existing portfolio (e.g. S&P 500 Index, 60/40 Stock-Bond Portfolio)
+    base_portfolio = returns of your pre-existing portfolio (e.g. S&P 500 Index, 60/40 Stock-Bond Portfolio), or a BasePortfolio
     risk_free_rate = Tbill rate (annualized)
     financing_rate = portfolio margin/borrowing cost (annualized) to layer new asset on top of prevailing portfolio (e.g. LIBOR + 60bps). No financing rate is reasonable for derivate overlay products.
     weight_asset = % weight you wish to overlay for the new asset on top of the previous portfolio, 25% overlay allocation is standard
@@ -310,6 +501,7 @@ def wabp_portfolio_return(new_asset,
     financing_rate=((financing_rate+1)**(1/periodicity)-1)
 
     # compose new portfolio
+    base_portfolio = base_portfolio_returns(base_portfolio)
     new_port=(new_asset-financing_rate)*(weight_asset) + base_portfolio*(weight_base_portfolio)
 
     # calculate annualized return of new portfolio and subtract risk-free rate
@@ -326,7 +518,7 @@ def wabp_portfolio_risk(new_asset,
                    periodicity = 252):
     """Win Above Base Portolio (WABP) Portfolio Risk: Volatility of the aggregate portfolio after a new asset is financed and layered on top of the replacement portfolio.
     new_asset = returns of the asset you are thinking of adding to your portfolio
-    base_portfolio = returns of your pre-existing portfolio (e.g. S&P 500 Index, 60/40 Stock-Bond Portfolio)
+    base_portfolio = returns of your pre-existing portfolio (e.g. S&P 500 Index, 60/40 Stock-Bond Portfolio), or a BasePortfolio
     risk_free_rate = Tbill rate (annualized)
     financing_rate = portfolio margin/borrowing cost (annualized) to layer new asset on top of prevailing portfolio (e.g. LIBOR + 60bps). No financing rate is reasonable for derivate overlay products.
     weight_asset = % weight you wish to overlay for the new asset on top of the previous portfolio, 25% overlay allocation is standard
@@ -336,6 +528,7 @@ def wabp_portfolio_risk(new_asset,
     financing_rate = ((financing_rate+1)**(1/periodicity)-1)
     risk_free_rate = ((risk_free_rate+1)**(1/periodicity)-1)
     # compose new portfolio
+    base_portfolio = base_portfolio_returns(base_portfolio)
     new_portfolio = (new_asset - financing_rate)*(weight_asset) + base_portfolio*(weight_base_portfolio)
     # calculated target downside deviation (TDD)
     target_downside_deviation_number = target_downside_deviation(new_portfolio, minimum_acceptable_return = 0)*np.sqrt(periodicity)
@@ -351,7 +544,7 @@ def wabp_new_portfolio_data(new_asset,
                        periodicity = 252):
     """Win Above Base Portolio (WABP) return stream: Return series after a new asset is financed and layered on top of the replacement portfolio.
     new_asset = returns of the asset you are thinking of adding to your portfolio
-    base_portfolio = returns of your pre-existing portfolio (e.g. S&P 500 Index, 60/40 Stock-Bond Portfolio)
+    base_portfolio = returns of your pre-existing portfolio (e.g. S&P 500 Index, 60/40 Stock-Bond Portfolio), or a BasePortfolio
     risk_free_rate = Tbill rate
     financing_rate = portfolio margin/borrowing cost to layer new asset on top of prevailing portfolio (e.g. LIBOR + 60bps). No financing rate is reasonable for derivate overlay products.
     weight_asset = % weight you wish to overlay for the new asset on top of the previous portfolio, 25% overlay allocation is standard
@@ -359,153 +552,529 @@ def wabp_new_portfolio_data(new_asset,
     periodicity = the frequency of the data you are sampling, typically 12 for monthly or 252 for trading day count"""
     # convert annual financing based on periodicity
     financing_rate = ((financing_rate + 1)**(1/periodicity) - 1)
+    base_portfolio = base_portfolio_returns(base_portfolio)
     new_portfolio = (new_asset - financing_rate) * (weight_asset) + base_portfolio * (weight_base_portfolio)
     return new_portfolio
 
-# calculate various risk returns based on non-aggregated portfolio and save these values in the data frame
-def calculate_risk_return(ticker, ticker_data, base_portfolio, risk_free_rate, financing_rate, weight_asset,
-                          weight_base_portfolio, data_periodicity, risk_return_df):
-    risk_return_df.loc[ticker, 'WARP'] = win_above_base_portfolio(
-                                                new_asset = ticker_data, 
+# build the aggregate portfolio of a ticker and the statistics of its returns, shared by both risk return tables
+def new_portfolio_and_statistics(ticker, ticker_data, base_portfolio, risk_free_rate, financing_rate, weight_asset,
+                                 weight_base_portfolio, data_periodicity):
+    with span("new portfolio", ticker = ticker):
+        new_portfolio = wabp_new_portfolio_data(new_asset = ticker_data,
                                                 base_portfolio = base_portfolio,
                                                 risk_free_rate = risk_free_rate,
                                                 financing_rate = financing_rate,
                                                 weight_asset = weight_asset,
                                                 weight_base_portfolio = weight_base_portfolio,
                                                 periodicity = data_periodicity)
-    risk_return_df.loc[ticker, '+Sortino'] = wabp_additive_sortino(new_asset = ticker_data, 
-                                                                base_portfolio = base_portfolio,
-                                                                        risk_free_rate = risk_free_rate,
-                                                                        financing_rate = financing_rate,
-                                                                        weight_asset = weight_asset,
-                                                                        weight_base_portfolio = weight_base_portfolio,
-                                                                        periodicity = data_periodicity)
-    risk_return_df.loc[ticker, '+Ret_To_MaxDD'] = wabp_additive_return_maximum_drawdown(
-                                                            new_asset = ticker_data, 
-                                                            base_portfolio = base_portfolio,
-                                                            risk_free_rate = risk_free_rate,
-                                                            financing_rate = financing_rate,
-                                                            weight_asset = weight_asset,
-                                                            weight_base_portfolio = weight_base_portfolio,
-                                                            periodicity = data_periodicity)
-    risk_return_df.loc[ticker, 'Sharpe'] = sharpe_ratio(
-                                                    ticker_data,
-                                                    risk_free = risk_free_rate,
-                                                    periodicity = data_periodicity)
-    risk_return_df.loc[ticker, 'Sortino'] = sortino_ratio(
-                                                        ticker_data,
-                                                        risk_free = risk_free_rate,
-                                                        periodicity = data_periodicity)
-    risk_return_df.loc[ticker, 'Max_DD'] = maximum_drawdown(ticker_data)
+        return new_portfolio, return_statistics(new_portfolio)
+
+# calculate various risk returns based on non-aggregated portfolio and save these values in the data frame
+# new_portfolio and new_portfolio_statistics are built from the ticker data when they are not given
+def calculate_risk_return(ticker, ticker_data, base_portfolio, risk_free_rate, financing_rate, weight_asset,
+                          weight_base_portfolio, data_periodicity, risk_return_df,
+                          new_portfolio = None, new_portfolio_statistics = None):
+    if new_portfolio_statistics is None:
+        new_portfolio, new_portfolio_statistics = new_portfolio_and_statistics(
+            ticker, ticker_data, base_portfolio, risk_free_rate, financing_rate, weight_asset,
+            weight_base_portfolio, data_periodicity)
+    with span("ratios", ticker = ticker):
+        # the asset is traversed once, every ratio is derived from its statistics and those of the new portfolio
+        asset_statistics = return_statistics(ticker_data)
+        sortino_improvement = (new_portfolio_statistics.sortino_ratio(risk_free = risk_free_rate, periodicity = data_periodicity)
+                               / base_portfolio_sortino_ratio(base_portfolio, risk_free = risk_free_rate,
+                                                              periodicity = data_periodicity))
+        return_maximum_drawdown_improvement = (new_portfolio_statistics.return_maximum_drawdown_ratio(
+                                                        risk_free = risk_free_rate, periodicity = data_periodicity)
+                                               / base_portfolio_return_maximum_drawdown_ratio(
+                                                        base_portfolio, risk_free = risk_free_rate,
+                                                        periodicity = data_periodicity))
+        ratios = {}
+        ratios['WARP'] = ((return_maximum_drawdown_improvement * sortino_improvement) ** (1/2) - 1) * 100
+        ratios['+Sortino'] = (sortino_improvement - 1) * 100
+        ratios['+Ret_To_MaxDD'] = (return_maximum_drawdown_improvement - 1) * 100
+        ratios['Sharpe'] = asset_statistics.sharpe_ratio(risk_free = risk_free_rate, periodicity = data_periodicity)
+        ratios['Sortino'] = asset_statistics.sortino_ratio(risk_free = risk_free_rate, periodicity = data_periodicity)
+        ratios['Max_DD'] = asset_statistics.maximum_drawdown
+    # the data frame is written separately so the instrumentation can tell the ratios from the writes
+    with span("loc writes", ticker = ticker):
+        for column, value in ratios.items():
+            risk_return_df.loc[ticker, column] = value
 
 # calculate various risk returns based on aggregated portfolio and save these values in the data frame
+# new_portfolio and new_portfolio_statistics are built from the ticker data when they are not given
 def calculate_new_risk_return(ticker, ticker_data, base_portfolio, risk_free_rate, financing_rate, weight_asset,
-                           weight_base_portfolio, data_periodicity, risk_return_df, new_risk_return_df, new_portfolios):
-    new_risk_return_df.loc[ticker, 'Return'] = wabp_portfolio_return(
-                                                        new_asset = ticker_data,
-                                                        base_portfolio = base_portfolio,
-                                                        risk_free_rate = risk_free_rate,
-                                                        financing_rate = financing_rate,
-                                                        weight_asset = weight_asset,
-                                                        weight_base_portfolio = weight_base_portfolio,
-                                                        periodicity = data_periodicity)
-    new_risk_return_df.loc[ticker, 'Vol'] = wabp_portfolio_risk(
-                                                    new_asset = ticker_data,
-                                                    base_portfolio = base_portfolio,
-                                                    risk_free_rate = risk_free_rate,
-                                                    financing_rate = financing_rate,
-                                                    weight_asset = weight_asset,
-                                                    weight_base_portfolio = weight_base_portfolio,
-                                                    periodicity = data_periodicity)
-    wnpd = wabp_new_portfolio_data(new_asset = ticker_data,
-                              base_portfolio = base_portfolio,
-                              risk_free_rate = risk_free_rate,
-                              financing_rate = financing_rate,
-                              weight_asset = weight_asset,
-                              weight_base_portfolio = weight_base_portfolio,
-                              periodicity = data_periodicity)
-    new_portfolios[ticker] = wnpd
-    new_risk_return_df.loc[ticker, 'Sharpe'] = sharpe_ratio(wnpd.copy(),
-                                                         risk_free = risk_free_rate,
-                                                         periodicity = data_periodicity)
-    new_risk_return_df.loc[ticker, 'Sortino'] = sortino_ratio(
-                                                        wnpd.copy(),
-                                                        risk_free = risk_free_rate,
-                                                        periodicity = data_periodicity)
-    new_risk_return_df.loc[ticker, 'Max_DD'] = maximum_drawdown(wnpd.copy())
-    new_risk_return_df.loc[ticker, 'Ret_To_MaxDD'] = return_maximum_drawdown_ratio(
-                                                                            wnpd.copy(),
-                                                                            risk_free = risk_free_rate,
-                                                                            periodicity = data_periodicity)
-    new_risk_return_df.loc[ticker, f'WARP_{round(100*weight_asset)}%_asset'] = risk_return_df.loc[ticker, 'WARP']
-
-
-# Retrieve ticker data and calculate non-aggregated risk return and update it in the data frame
-def retrieve_ticker_data_and_update_risk_return_data_frame(ticker, yahoo,
-                                                           csv_file, risk_return_df,
-                                                           base_portfolio,
-                                                           risk_free_rate, financing_rate, weight_asset, weight_base_portfolio,
-                                                           start_date, end_date,
-                                                           data_periodicity = 252):
-    if yahoo == True:
-        ticker_data = retrieve_yahoo_data(ticker, start_date, end_date)
-        risk_return_df.loc[ticker, 'Start Date'] = min(ticker_data.index).date()
-        risk_return_df.loc[ticker, 'End Date'] = max(ticker_data.index).date()
-    else:
-        ticker_data = pd.read_csv(Path(csv_file), index_col='ReturnDate', skiprows=2)
-        ticker_data = ticker_data[['PercentReturn']]
-        risk_return_df.loc[ticker, 'Start Date'] = datetime.strptime(min(ticker_data.index), '%b %Y').date()
-        risk_return_df.loc[ticker, 'End Date'] = datetime.strptime(max(ticker_data.index), '%b %Y').date()
-        ticker_data = ticker_data[['PercentReturn']]
-        ticker_data.reset_index(drop=True, inplace=True)
-        ticker_data = ticker_data[:].values
-        
-    calculate_risk_return(ticker, ticker_data, base_portfolio, risk_free_rate, financing_rate, weight_asset,
-                          weight_base_portfolio, data_periodicity, risk_return_df)
-
-# Retrieve ticker data and calculate non-aggregated and aggregated risk return and update it in the data frame
-def retrieve_ticker_data_and_update_data_frames(ticker, yahoo,
-                                               csv_file, risk_return_df, ticker_data_dict, new_risk_return_df, new_portfolios,
-                                               base_portfolio,
-                                               risk_free_rate, financing_rate, weight_asset, weight_base_portfolio,
-                                               start_date, end_date,
-                                               data_periodicity = 252):
-    if yahoo == True:
-        ticker_data = retrieve_yahoo_data(ticker, start_date, end_date)
-        ticker_data_dict[ticker] = ticker_data
+                           weight_base_portfolio, data_periodicity, risk_return_df, new_risk_return_df, new_portfolios,
+                           new_portfolio = None, new_portfolio_statistics = None):
+    if new_portfolio_statistics is None:
+        new_portfolio, new_portfolio_statistics = new_portfolio_and_statistics(
+            ticker, ticker_data, base_portfolio, risk_free_rate, financing_rate, weight_asset,
+            weight_base_portfolio, data_periodicity)
+    new_portfolios[ticker] = new_portfolio
+    with span("new portfolio ratios", ticker = ticker):
+        # every ratio of the new portfolio comes out of the one pass over its returns
+        statistics = new_portfolio_statistics
+        ratios = {}
+        ratios['Return'] = statistics.annualized_return(periodicity = data_periodicity) - risk_free_rate
+        ratios['Vol'] = statistics.target_downside_deviation * np.sqrt(data_periodicity)
+        ratios['Sharpe'] = statistics.sharpe_ratio(risk_free = risk_free_rate, periodicity = data_periodicity)
+        ratios['Sortino'] = statistics.sortino_ratio(risk_free = risk_free_rate, periodicity = data_periodicity)
+        ratios['Max_DD'] = statistics.maximum_drawdown
+        ratios['Ret_To_MaxDD'] = statistics.return_maximum_drawdown_ratio(risk_free = risk_free_rate,
+                                                                          periodicity = data_periodicity)
+    with span("loc writes", ticker = ticker):
+        for column, value in ratios.items():
+            new_risk_return_df.loc[ticker, column] = value
+        new_risk_return_df.loc[ticker, f'WARP_{round(100*weight_asset)}%_asset'] = risk_return_df.loc[ticker, 'WARP']
+
+
+# calculate the sortino ratio of every column of a 2-D array of returns
+def columns_sortino_ratio(returns, risk_free = 0, periodicity = 252):
+    # annualize the risk free values
+    risk_free = (1 + risk_free) ** (1/periodicity) - 1
+    # calculate the column means by ignoring Nans and substract risk free from them
+    columns_mean = np.nanmean(returns, axis = 0) - risk_free
+    # calculate target downside deviation, missing returns count as no downside like in target_downside_deviation
+    downside = np.where(returns < 0, returns, 0)
+    columns_target_downside_deviation = np.sqrt(np.mean(downside ** 2, axis = 0))
+    # calculate annualized sortino
+    return (columns_mean / columns_target_downside_deviation) * np.sqrt(periodicity)
+
+# calculate the number of rows of every column's own history in a 2-D array of returns aligned on other dates:
+# from the missing first return of its history to its last return
+def columns_history_length(returns):
+    valid = ~np.isnan(returns)
+    first_valid = np.argmax(valid, axis = 0)
+    last_valid = len(returns) - 1 - np.argmax(valid[::-1], axis = 0)
+    return last_valid - np.maximum(first_valid - 1, 0) + 1
+
+# calculate the sortino ratio of every column of a 2-D array of returns over each column's own history, so the rows
+# padding a later starting asset do not count as days without downside, like sortino_ratio of the unaligned returns
+def columns_history_sortino_ratio(returns, risk_free = 0, periodicity = 252):
+    risk_free = (1 + risk_free) ** (1/periodicity) - 1
+    columns_mean = np.nanmean(returns, axis = 0) - risk_free
+    downside = np.where(returns < 0, returns, 0)
+    columns_target_downside_deviation = np.sqrt(np.sum(downside ** 2, axis = 0) / columns_history_length(returns))
+    return (columns_mean / columns_target_downside_deviation) * np.sqrt(periodicity)
+
+# calculate the maximum drawdown of every column of a 2-D array of returns
+def columns_maximum_drawdown(returns):
+    # calculate cumulative returns and the running peak of each column
+    cumprod_return = np.nancumprod(returns + 1.0, axis = 0)
+    peak_return = np.maximum.accumulate(cumprod_return, axis = 0)
+    # determine drawdowns relative to the peak and return the largest one as a positive number
+    drawdown = (cumprod_return - peak_return) / peak_return
+    return np.abs(np.nanmin(drawdown, axis = 0)), cumprod_return[-1]
+
+# calculate the return to maximum drawdown ratio of every column of a 2-D array of returns
+def columns_return_maximum_drawdown_ratio(returns, risk_free = 0, periodicity = 252):
+    # convert annualized risk free rate into appropriate value for the periodicity
+    risk_free = (1 + risk_free)**(1 / periodicity) - 1
+    # the final net asset value comes out of the same cumulative product as the drawdown
+    columns_maximum_drawdown_number, end_net_asset_value = columns_maximum_drawdown(returns)
+    annual_return = end_net_asset_value ** (1 / (len(returns) / periodicity)) - 1
+    return (annual_return - risk_free) / columns_maximum_drawdown_number
+
+# calculate the risk return ratios of all assets at once
+def calculate_risk_return_batch(returns_df,
+                                base_portfolio,
+                                risk_free_rate = 0,
+                                financing_rate = 0,
+                                weight_asset = 0.20,
+                                weight_base_portfolio = 0.80,
+                                periodicity = 252):
+    """Batched version of calculate_risk_return: WARP, +Sortino, +Ret_To_MaxDD, Sharpe, Sortino and Max_DD for every column at once.
+    returns_df = T x N returns of the assets you are thinking of adding to your portfolio, one column per asset
+    base_portfolio = T returns of your pre-existing portfolio or a BasePortfolio, aligned with returns_df (pandas inputs are aligned on the base portfolio dates)
+    risk_free_rate = Tbill rate (annualized)
+    financing_rate = portfolio margin/borrowing cost (annualized) to layer new asset on top of prevailing portfolio
+    weight_asset = % weight you wish to overlay for the new assets on top of the previous portfolio
+    weight_base_portfolio = % weight of the base portfolio
+    periodicity = the frequency of the data you are sampling, typically 12 for monthly or 252 for trading day count
+    Returns a DataFrame with one row per asset and the same columns as the risk return data frame."""
+    # base portfolio ratios are calculated once for all assets
+    base_portfolio_sortino = base_portfolio_sortino_ratio(base_portfolio, risk_free = risk_free_rate, periodicity = periodicity)
+    base_portfolio_return_maximum_drawdown = base_portfolio_return_maximum_drawdown_ratio(
+                                                    base_portfolio, risk_free = risk_free_rate, periodicity = periodicity)
+    base_portfolio = base_portfolio_returns(base_portfolio)
+
+    # align the assets on the base portfolio dates, as pandas does when the series are combined one by one
+    if isinstance(returns_df, pd.DataFrame) and isinstance(base_portfolio, pd.Series):
+        returns_df = returns_df.reindex(base_portfolio.index)
+    tickers = returns_df.columns if isinstance(returns_df, pd.DataFrame) else range(np.shape(returns_df)[1])
+    asset_returns = np.asarray(returns_df, dtype = float)
+    base_returns = np.asarray(base_portfolio, dtype = float).reshape(-1, 1)
+
+    # convert annualized financing rate into appropriate value for provided periodicity
+    financing_rate = (1 + financing_rate)**(1 / periodicity) - 1
+
+    # blend every asset with the base portfolio in one operation
+    new_portfolios = (asset_returns - financing_rate) * weight_asset + base_returns * weight_base_portfolio
+    new_portfolios_sortino = columns_sortino_ratio(new_portfolios, risk_free = risk_free_rate, periodicity = periodicity)
+    new_portfolios_return_maximum_drawdown = columns_return_maximum_drawdown_ratio(
+                                                    new_portfolios, risk_free = risk_free_rate, periodicity = periodicity)
+
+    # relative improvement of the blended portfolios over the base portfolio
+    sortino_improvement = new_portfolios_sortino / base_portfolio_sortino
+    return_maximum_drawdown_improvement = new_portfolios_return_maximum_drawdown / base_portfolio_return_maximum_drawdown
+
+    # stand alone ratios of the assets, the sharpe ratio uses the sample standard deviation like pandas
+    daily_risk_free = (1 + risk_free_rate)**(1 / periodicity) - 1
+    assets_sharpe = ((np.nanmean(asset_returns, axis = 0) - daily_risk_free) /
+                     np.nanstd(asset_returns, axis = 0, ddof = 1)) * np.sqrt(periodicity)
+
+    return pd.DataFrame({
+        'WARP': ((return_maximum_drawdown_improvement * sortino_improvement) ** (1/2) - 1) * 100,
+        '+Sortino': (sortino_improvement - 1) * 100,
+        '+Ret_To_MaxDD': (return_maximum_drawdown_improvement - 1) * 100,
+        'Sharpe': assets_sharpe,
+        'Sortino': columns_history_sortino_ratio(asset_returns, risk_free = risk_free_rate, periodicity = periodicity),
+        'Max_DD': columns_maximum_drawdown(asset_returns)[0]},
+        index = tickers)
+
+# calculate the risk return ratios of the portfolios made of each asset layered on the base portfolio at once
+def calculate_new_risk_return_batch(returns_df,
+                                    base_portfolio,
+                                    risk_free_rate = 0,
+                                    financing_rate = 0,
+                                    weight_asset = 0.20,
+                                    weight_base_portfolio = 0.80,
+                                    periodicity = 252):
+    """Batched version of calculate_new_risk_return: Return, Vol, Sharpe, Sortino, Max_DD and Ret_To_MaxDD of every new portfolio at once.
+    returns_df = T x N returns of the assets you are thinking of adding to your portfolio, one column per asset
+    base_portfolio = T returns of your pre-existing portfolio or a BasePortfolio, aligned with returns_df (pandas inputs are aligned on the base portfolio dates)
+    The other parameters are the same as calculate_risk_return_batch.
+    Returns a DataFrame with one row per asset and the same columns as the new risk return data frame, without WARP."""
+    base_portfolio = base_portfolio_returns(base_portfolio)
+    if isinstance(returns_df, pd.DataFrame) and isinstance(base_portfolio, pd.Series):
+        returns_df = returns_df.reindex(base_portfolio.index)
+    tickers = returns_df.columns if isinstance(returns_df, pd.DataFrame) else range(np.shape(returns_df)[1])
+    asset_returns = np.asarray(returns_df, dtype = float)
+    base_returns = np.asarray(base_portfolio, dtype = float).reshape(-1, 1)
+
+    # blend every asset with the base portfolio in one operation
+    financing_rate = (1 + financing_rate)**(1 / periodicity) - 1
+    new_portfolios = (asset_returns - financing_rate) * weight_asset + base_returns * weight_base_portfolio
+
+    daily_risk_free = (1 + risk_free_rate)**(1 / periodicity) - 1
+    columns_maximum_drawdown_number, end_net_asset_value = columns_maximum_drawdown(new_portfolios)
+    annual_return = end_net_asset_value ** (1 / (len(new_portfolios) / periodicity)) - 1
+    downside = np.where(new_portfolios < 0, new_portfolios, 0)
+    return pd.DataFrame({
+        'Return': annual_return - risk_free_rate,
+        'Vol': np.sqrt(np.mean(downside ** 2, axis = 0)) * np.sqrt(periodicity),
+        'Sharpe': ((np.nanmean(new_portfolios, axis = 0) - daily_risk_free) /
+                   np.nanstd(new_portfolios, axis = 0, ddof = 1)) * np.sqrt(periodicity),
+        'Sortino': columns_sortino_ratio(new_portfolios, risk_free = risk_free_rate, periodicity = periodicity),
+        'Max_DD': columns_maximum_drawdown_number,
+        'Ret_To_MaxDD': (annual_return - daily_risk_free) / columns_maximum_drawdown_number},
+        index = tickers)
+
+# calculate WARP and its components over a grid of overlay weights and base portfolio stock/bond splits
+def warp_sensitivity_surface(ticker_returns_df,
+                             stock_returns,
+                             bond_returns,
+                             overlay_weights = np.arange(0, 51) / 100,
+                             stock_shares = np.arange(0, 21) / 20,
+                             risk_free_rate = 0,
+                             financing_rate = 0,
+                             periodicity = 252,
+                             file_name = "warp_surface.npz",
+                             max_elements = 20000000):
+    """WARP sensitivity surface: WARP, +Sortino and +Ret_To_MaxDD for every overlay weight x stock share x ticker.
+    ticker_returns_df = T x N returns of the candidate assets, one column per ticker (already loaded)
+    stock_returns = returns of the base portfolio stock, e.g. spy
+    bond_returns = returns of the base portfolio bond, e.g. ief
+    overlay_weights = weights of the new asset, the base portfolio gets the rest (default 0% to 50% in 1% steps)
+    stock_shares = stock share of the base portfolio, the bond gets the rest (default 0% to 100% in 5% steps)
+    risk_free_rate = Tbill rate (annualized)
+    financing_rate = portfolio margin/borrowing cost (annualized) to layer new asset on top of prevailing portfolio
+    periodicity = the frequency of the data you are sampling, typically 12 for monthly or 252 for trading day count
+    file_name = compressed numpy file the surface is written to for the dashboard, None to skip writing
+    max_elements = upper bound on the size of the blended returns array processed at once
+    Returns a DataFrame indexed by (overlay_weight, stock_share, ticker)."""
+    overlay_weights = np.asarray(overlay_weights, dtype = float)
+    stock_shares = np.asarray(stock_shares, dtype = float)
+    # align everything on the stock dates
+    bond_returns = bond_returns.reindex(stock_returns.index)
+    ticker_returns_df = ticker_returns_df.reindex(stock_returns.index)
+    tickers = list(ticker_returns_df.columns)
+    asset_returns = np.asarray(ticker_returns_df, dtype = float)
+    financing_rate = (1 + financing_rate)**(1 / periodicity) - 1
+
+    # every base portfolio of the grid as one T x S array, with its ratios calculated column-wise
+    base_returns = (np.asarray(stock_returns, dtype = float)[:, None] * stock_shares +
+                    np.asarray(bond_returns, dtype = float)[:, None] * (1 - stock_shares))
+    base_sortino = columns_sortino_ratio(base_returns, risk_free = risk_free_rate, periodicity = periodicity)
+    base_return_maximum_drawdown = columns_return_maximum_drawdown_ratio(base_returns, risk_free = risk_free_rate,
+                                                                          periodicity = periodicity)
+
+    # overlay weight x stock share x ticker results
+    shape = (len(overlay_weights), len(stock_shares), len(tickers))
+    sortino_improvement = np.empty(shape)
+    return_maximum_drawdown_improvement = np.empty(shape)
+
+    # the T x overlay weight x ticker blends of one stock share are broadcast in a single operation,
+    # split over tickers only when the array would exceed max_elements
+    tickers_per_block = max(1, max_elements // max(1, len(base_returns) * len(overlay_weights)))
+    for start in range(0, len(tickers), tickers_per_block):
+        block = slice(start, start + tickers_per_block)
+        # the overlay part of the block is shared by every stock share, and never built for all tickers at once
+        overlay_part = (asset_returns[:, block] - financing_rate)[:, None, :] * overlay_weights[None, :, None]
+        for s in range(len(stock_shares)):
+            new_portfolios = overlay_part + (base_returns[:, s, None, None] * (1 - overlay_weights)[None, :, None])
+            new_portfolios = new_portfolios.reshape(len(base_returns), -1)
+            block_shape = (len(overlay_weights), -1)
+            sortino_improvement[:, s, block] = (columns_sortino_ratio(new_portfolios, risk_free = risk_free_rate,
+                                                                     periodicity = periodicity).reshape(block_shape)
+                                               / base_sortino[s])
+            return_maximum_drawdown_improvement[:, s, block] = (columns_return_maximum_drawdown_ratio(
+                                                                     new_portfolios, risk_free = risk_free_rate,
+                                                                     periodicity = periodicity).reshape(block_shape)
+                                                               / base_return_maximum_drawdown[s])
+
+    warp = ((return_maximum_drawdown_improvement * sortino_improvement) ** (1/2) - 1) * 100
+    plus_sortino = (sortino_improvement - 1) * 100
+    plus_ret_to_maxdd = (return_maximum_drawdown_improvement - 1) * 100
+
+    # save one compact file the dashboard can slice by overlay weight, stock share and ticker
+    if file_name is not None:
+        np.savez_compressed(file_name,
+                            warp = warp,
+                            plus_sortino = plus_sortino,
+                            plus_ret_to_maxdd = plus_ret_to_maxdd,
+                            overlay_weights = overlay_weights,
+                            stock_shares = stock_shares,
+                            tickers = np.array(tickers, dtype = str))
+
+    index = pd.MultiIndex.from_product([overlay_weights, stock_shares, tickers],
+                                       names = ['overlay_weight', 'stock_share', 'ticker'])
+    return pd.DataFrame({'WARP': warp.ravel(),
+                         '+Sortino': plus_sortino.ravel(),
+                         '+Ret_To_MaxDD': plus_ret_to_maxdd.ravel()},
+                        index = index)
+
+# convert a Series or DataFrame of returns into a 2-D array plus the labels needed to convert it back
+def rolling_input(df):
+    values = np.asarray(df, dtype = float)
+    if values.ndim == 1:
+        values = values[:, None]
+    return values, getattr(df, 'index', None), getattr(df, 'columns', None)
+
+# convert a 2-D array of rolling results back into the shape of the input
+def rolling_output(values, index, columns):
+    if columns is None:
+        return pd.Series(values[:, 0], index = index)
+    return pd.DataFrame(values, index = index, columns = columns)
+
+# calculate the sum over a trailing window of every column using running sums, missing values count as 0
+def rolling_sum(values, window):
+    running_sum = np.nancumsum(values, axis = 0, dtype = float)
+    result = running_sum.copy()
+    result[window:] -= running_sum[:-window]
+    result[:window - 1] = np.nan
+    return result
+
+# calculate the sharpe ratio over a trailing window in linear time
+def rolling_sharpe_ratio(df, window = 252, risk_free = 0, periodicity = 252):
+    """df - asset return series or data frame (one column per asset)
+    window - number of periods in each trailing window
+    Returns the sharpe ratio of each window, aligned with the end of the window."""
+    values, index, columns = rolling_input(df)
+    risk_free = (1 + risk_free)**(1 / periodicity) - 1
+    # running sums of the count, mean and squares of the returns; the variance is calculated
+    # around the full period mean to keep the running sums accurate
+    valid = ~np.isnan(values)
+    centered = values - np.nanmean(values, axis = 0)
+    count = rolling_sum(valid, window)
+    centered_sum = rolling_sum(centered, window)
+    centered_sum_of_squares = rolling_sum(centered ** 2, window)
+    # windows of a late-start column may hold too few returns, their divides are left to produce NaN
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        window_mean = centered_sum / count + np.nanmean(values, axis = 0)
+        window_std = np.sqrt((centered_sum_of_squares - centered_sum ** 2 / count) / (count - 1))
+        ratio = (window_mean - risk_free) / window_std * np.sqrt(periodicity)
+    # the standard deviation needs at least two returns
+    ratio[count < 2] = np.nan
+    return rolling_output(ratio, index, columns)
+
+# calculate the sortino ratio over a trailing window in linear time
+def rolling_sortino_ratio(df, window = 252, risk_free = 0, periodicity = 252):
+    """df - asset return series or data frame (one column per asset)
+    window - number of periods in each trailing window
+    Returns the sortino ratio of each window, aligned with the end of the window."""
+    values, index, columns = rolling_input(df)
+    risk_free = (1 + risk_free)**(1 / periodicity) - 1
+    # running sums of the returns and of the squared downside, missing returns count as no downside
+    count = rolling_sum(~np.isnan(values), window)
+    downside = np.where(values < 0, values, 0)
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        window_mean = rolling_sum(values, window) / count - risk_free
+        window_target_downside_deviation = np.sqrt(rolling_sum(downside ** 2, window) / window)
+        ratio = window_mean / window_target_downside_deviation * np.sqrt(periodicity)
+    # a window without any returns has no mean
+    ratio[count < 1] = np.nan
+    return rolling_output(ratio, index, columns)
+
+# calculate the annualized return over a trailing window in linear time
+def rolling_annualized_return(df, window = 252, periodicity = 252):
+    values, index, columns = rolling_input(df)
+    # running sum of log returns gives the growth of each window
+    window_growth = np.exp(rolling_sum(np.log1p(values), window))
+    annualized_return = window_growth ** (periodicity / window) - 1
+    # a window without any returns has no growth rather than a growth of 0
+    annualized_return[rolling_sum(~np.isnan(values), window) < 1] = np.nan
+    return rolling_output(annualized_return, index, columns)
+
+# calculate the maximum drawdown over a trailing window in linear time
+def rolling_maximum_drawdown(df, window = 252):
+    """df - asset return series or data frame (one column per asset)
+    window - number of periods in each trailing window
+    Returns the maximum drawdown of each window as a positive number, aligned with the end of the window.
+    The data is split into blocks of window rows (van Herk/Gil-Werman): the largest drop within each block is
+    accumulated forwards and backwards, and every window combines the end of one block with the start of the next."""
+    values, index, columns = rolling_input(df)
+    length, number_of_columns = values.shape
+    # work with the log of the net asset value, a drawdown is a drop between an earlier and a later value
+    log_net_asset_value = np.nancumsum(np.log1p(values), axis = 0)
+    padded_length = -(-length // window) * window
+    blocks = np.pad(log_net_asset_value, ((0, padded_length - length), (0, 0)), mode = 'edge')
+    blocks = blocks.reshape(-1, window, number_of_columns)
+
+    # from the start of each block up to every row: lowest value and largest drop
+    forward_peak = np.maximum.accumulate(blocks, axis = 1)
+    forward_low = np.minimum.accumulate(blocks, axis = 1)
+    forward_drop = np.maximum.accumulate(forward_peak - blocks, axis = 1)
+    # from every row to the end of its block: highest value and largest drop
+    reverse = blocks[:, ::-1]
+    backward_peak = np.maximum.accumulate(reverse, axis = 1)[:, ::-1]
+    backward_low = np.minimum.accumulate(reverse, axis = 1)[:, ::-1]
+    backward_drop = np.maximum.accumulate((blocks - backward_low)[:, ::-1], axis = 1)[:, ::-1]
+    forward_low, forward_drop, backward_peak, backward_drop = (
+        x.reshape(padded_length, number_of_columns) for x in (forward_low, forward_drop, backward_peak, backward_drop))
+
+    # a window starting at a block boundary is one whole block, otherwise it is the end of the block holding its
+    # first row followed by the start of the next block, and the peak may fall in the first part and the trough in the second
+    window_start = np.arange(length - window + 1)
+    window_end = window_start + window - 1
+    drop = np.maximum(np.maximum(backward_drop[window_start], forward_drop[window_end]),
+                      backward_peak[window_start] - forward_low[window_end])
+    whole_block = window_start % window == 0
+    drop[whole_block] = backward_drop[window_start[whole_block]]
+
+    result = np.full((length, number_of_columns), np.nan)
+    result[window - 1:] = 1 - np.exp(-drop)
+    # a window without any returns has no drawdown rather than a drawdown of 0
+    result[rolling_sum(~np.isnan(values), window) < 1] = np.nan
+    return rolling_output(result, index, columns)
+
+# calculate the return to maximum drawdown ratio over a trailing window in linear time
+def rolling_return_maximum_drawdown_ratio(df, window = 252, risk_free = 0, periodicity = 252):
+    risk_free = (1 + risk_free)**(1 / periodicity) - 1
+    return ((rolling_annualized_return(df, window, periodicity = periodicity) - risk_free) /
+            rolling_maximum_drawdown(df, window))
+
+# calculate the WARP over a trailing window in linear time
+def rolling_warp(ticker_returns_df,
+                 base_portfolio,
+                 window = 252,
+                 risk_free_rate = 0,
+                 financing_rate = 0,
+                 weight_asset = 0.20,
+                 weight_base_portfolio = 0.80,
+                 periodicity = 252):
+    """Rolling Win Above Base Portolio (WABP): WARP of each trailing window, for every asset at once.
+    ticker_returns_df = returns of the assets you are thinking of adding to your portfolio, one column per asset
+    base_portfolio = returns of your pre-existing portfolio, or a BasePortfolio
+    window = number of periods in each trailing window
+    Other parameters as in win_above_base_portfolio. Returns a DataFrame aligned with ticker_returns_df."""
+    base_portfolio = base_portfolio_returns(base_portfolio)
+    ticker_returns_df = ticker_returns_df.reindex(base_portfolio.index)
+    financing_rate = (1 + financing_rate)**(1 / periodicity) - 1
+    new_portfolios = (ticker_returns_df - financing_rate) * weight_asset + base_portfolio.values[:, None] * weight_base_portfolio
+
+    # the base portfolio ratios are calculated once and broadcast across the assets
+    base_sortino = rolling_sortino_ratio(base_portfolio, window, risk_free = risk_free_rate, periodicity = periodicity)
+    base_return_maximum_drawdown = rolling_return_maximum_drawdown_ratio(base_portfolio, window, risk_free = risk_free_rate,
+                                                                         periodicity = periodicity)
+    new_sortino = rolling_sortino_ratio(new_portfolios, window, risk_free = risk_free_rate, periodicity = periodicity)
+    new_return_maximum_drawdown = rolling_return_maximum_drawdown_ratio(new_portfolios, window, risk_free = risk_free_rate,
+                                                                        periodicity = periodicity)
+    return ((new_return_maximum_drawdown.div(base_return_maximum_drawdown, axis = 0) *
+             new_sortino.div(base_sortino, axis = 0)) ** (1/2) - 1) * 100
+
+# Calculate non-aggregated and aggregated risk return of ticker data already retrieved and update it in the data frames
+def update_data_frames(ticker, ticker_data, risk_return_df, ticker_data_dict, new_risk_return_df, new_portfolios,
+                       base_portfolio,
+                       risk_free_rate, financing_rate, weight_asset, weight_base_portfolio,
+                       data_periodicity = 252):
+    count("rows_processed", len(ticker_data))
+    ticker_data_dict[ticker] = ticker_data
+    with span("loc writes", ticker = ticker):
         risk_return_df.loc[ticker, 'Start Date'] = min(ticker_data.index).date()
         risk_return_df.loc[ticker, 'End Date'] = max(ticker_data.index).date()
-    else:
-        ticker_data = pd.read_csv(Path(csv_file), index_col='ReturnDate', skiprows=2)
-        ticker_data = ticker_data[['PercentReturn']]
-        ticker_data_dict[ticker] = ticker_data
-        risk_return_df.loc[ticker, 'Start Date'] = datetime.strptime(min(ticker_data.index), '%b %Y').date()
-        risk_return_df.loc[ticker, 'End Date'] = datetime.strptime(max(ticker_data.index), '%b %Y').date()
-        ticker_data = ticker_data[['PercentReturn']]
-        ticker_data.reset_index(drop=True, inplace=True)
-        ticker_data = ticker_data[:].values
-        
+    # the new portfolio and its statistics are built once for both tables
+    new_portfolio, new_portfolio_statistics = new_portfolio_and_statistics(
+        ticker, ticker_data, base_portfolio, risk_free_rate, financing_rate, weight_asset,
+        weight_base_portfolio, data_periodicity)
     calculate_risk_return(ticker, ticker_data, base_portfolio, risk_free_rate, financing_rate, weight_asset,
-                          weight_base_portfolio, data_periodicity, risk_return_df)
+                          weight_base_portfolio, data_periodicity, risk_return_df,
+                          new_portfolio = new_portfolio, new_portfolio_statistics = new_portfolio_statistics)
     calculate_new_risk_return(ticker, ticker_data, base_portfolio, risk_free_rate, financing_rate, weight_asset,
-                           weight_base_portfolio, data_periodicity, risk_return_df, new_risk_return_df, new_portfolios)
+                           weight_base_portfolio, data_periodicity, risk_return_df, new_risk_return_df, new_portfolios,
+                           new_portfolio = new_portfolio, new_portfolio_statistics = new_portfolio_statistics)
 
-# diversify using the list of tickers provided relevant to a base portfolio
-def diversify_stocks_with_base_portfolio(
-                                    base_portfolio_name, ticker_list, selected_ticker_list, risk_free_rate, 
-                                    financing_rate, weight_asset, weight_base_portfolio,
-                                    weight_base_portfolio_stock, weight_base_portfolio_bond,
-                                    ticker_base_portfolio_stock, ticker_base_portfolio_bond,
-                                    start_date, end_date, save_plots):
+# Parameters identifying a diversification run in the result store and in caches of results
+def diversification_parameters(ticker_list, selected_ticker_list, risk_free_rate,
+                               financing_rate, weight_asset, weight_base_portfolio,
+                               weight_base_portfolio_stock, weight_base_portfolio_bond,
+                               ticker_base_portfolio_stock, ticker_base_portfolio_bond,
+                               start_date, end_date):
+    return {'ticker_list': list(ticker_list), 'selected_ticker_list': list(selected_ticker_list),
+            'risk_free_rate': risk_free_rate, 'financing_rate': financing_rate,
+            'weight_asset': weight_asset, 'weight_base_portfolio': weight_base_portfolio,
+            'weight_base_portfolio_stock': weight_base_portfolio_stock,
+            'weight_base_portfolio_bond': weight_base_portfolio_bond,
+            'ticker_base_portfolio_stock': ticker_base_portfolio_stock,
+            'ticker_base_portfolio_bond': ticker_base_portfolio_bond,
+            'start_date': str(start_date), 'end_date': str(end_date)}
+
+# Calculate the ratios, new portfolios and cumulative returns of the tickers relevant to a base portfolio
+# and return them as the tables of the run along with the base portfolio returns
+def calculate_diversification(
+                            base_portfolio_name, ticker_list, selected_ticker_list, risk_free_rate, 
+                            financing_rate, weight_asset, weight_base_portfolio,
+                            weight_base_portfolio_stock, weight_base_portfolio_bond,
+                            ticker_base_portfolio_stock, ticker_base_portfolio_bond,
+                            start_date, end_date, save_plots = False, save_warp_surface = False,
+                            max_workers = 8, provider = None, session = None):
     
     new_portfolios = {}
-    # retrieve base stock data
-    stock_df = retrieve_yahoo_data(ticker_base_portfolio_stock, start_date, end_date)
-    # retrieve base bond data
-    bond_df = retrieve_yahoo_data(ticker_base_portfolio_bond, start_date, end_date)
-    # calculate the weighted returns
-    base_portfolio_df = ((weight_base_portfolio_stock * stock_df) + 
-                        (weight_base_portfolio_bond * bond_df))
+    # prices come from the market data session given, the shared session or a session of another provider
+    if session is None:
+        session = market_data_session if provider is None else MarketDataSession(provider = provider)
+    # retrieve the base stock, base bond and ticker data concurrently before calculating anything
+    with span("fetch"):
+        fetch_result = fetch_returns([ticker_base_portfolio_stock, ticker_base_portfolio_bond] + list(ticker_list),
+                                     start_date, end_date, store = session, max_workers = max_workers)
+    count("tickers_fetched", len(fetch_result.returns_by_ticker))
+    count("tickers_failed", len(fetch_result.failed))
+    if len(fetch_result.failed) > 0:
+        print(fetch_result.report())
+    for base_ticker in [ticker_base_portfolio_stock, ticker_base_portfolio_bond]:
+        if base_ticker in fetch_result.failed:
+            raise ValueError(f"Base portfolio data not available for '{base_ticker}': {fetch_result.failed[base_ticker]}")
+    # only the tickers with data are analyzed
+    ticker_list = [ticker for ticker in ticker_list if ticker not in fetch_result.failed]
+    selected_ticker_list = [ticker for ticker in selected_ticker_list if ticker not in fetch_result.failed]
+    # base stock and bond data
+    stock_df = fetch_result.returns_by_ticker[ticker_base_portfolio_stock]
+    bond_df = fetch_result.returns_by_ticker[ticker_base_portfolio_bond]
+    # build the base portfolio once, its statistics are shared by all tickers
+    with span("base portfolio"):
+        base_portfolio = BasePortfolio.build(stock_df, bond_df, weight_base_portfolio_stock, weight_base_portfolio_bond,
+                                             risk_free_rate, financing_rate, 252)
+    base_portfolio_df = base_portfolio.returns
 
     # Set up the risk return related dataframes
     risk_return_df = pd.DataFrame(
@@ -514,50 +1083,75 @@ def diversify_stocks_with_base_portfolio(
     new_risk_return_df = pd.DataFrame(
                     index = ticker_list,
                     columns = ['Return','Vol','Sharpe','Sortino','Max_DD','Ret_To_MaxDD',f'WARP_{round(100*weight_asset)}%_asset'])
+    # keep the tickers that could not be retrieved with the results
+    risk_return_df.attrs['failed_tickers'] = fetch_result.failed
     ticker_data_dict = {}
-    csv_file = ""
 
-    # Go through the list of tickers and retrieve the ticker data along with the various ratios
+    # Go through the list of tickers and calculate the various ratios from the retrieved data
     for ticker in ticker_list:
-        retrieve_ticker_data_and_update_data_frames(
-                                            ticker, True, csv_file, risk_return_df, ticker_data_dict, new_risk_return_df,
-                                            new_portfolios, base_portfolio_df,
-                                            risk_free_rate, financing_rate, weight_asset, weight_base_portfolio,
-                                            start_date, end_date,
-                                            252)
-
-    # save the data frames for the UI and DASH
-    risk_return_reset_index = risk_return_df.reset_index() 
-    risk_return_df.to_csv(f"risk_return_{base_portfolio_name}.csv")
-    risk_return_df.to_csv(f'risk_return.csv')
-    risk_return_reset_index = risk_return_reset_index.rename(columns = {'index':'ticker'})
-    risk_return_reset_index.to_csv(f"risk_return_dash.csv")
-    
-    new_risk_return_reset_index = new_risk_return_df.reset_index()
-    new_risk_return_df.to_csv(f"new_risk_return_{base_portfolio_name}.csv")
-    new_risk_return_df.to_csv(f"new_risk_return.csv")
-    new_risk_return_reset_index = new_risk_return_reset_index.rename(columns = {'index':'ticker'})
-    new_risk_return_reset_index.to_csv(f"new_risk_return_dash.csv")
-
-    new_portfolios_df = pd.DataFrame(new_portfolios)
-    new_portfolios_df.to_csv(f"new_portfolios_{base_portfolio_name}.csv")
-    new_portfolios_df.to_csv(f"new_portfolios.csv")
-    ticker_data_df = pd.DataFrame(ticker_data_dict)
-    ticker_data_df.to_csv(f"ticker_data_{base_portfolio_name}.csv")
-    ticker_data_df.to_csv(f"ticker_data.csv")
+        with span("ticker", ticker = ticker):
+            update_data_frames(ticker, fetch_result.returns_by_ticker[ticker], risk_return_df, ticker_data_dict,
+                               new_risk_return_df, new_portfolios, base_portfolio,
+                               risk_free_rate, financing_rate, weight_asset, weight_base_portfolio,
+                               252)
+
+    with span("combine"):
+        new_portfolios_df = pd.DataFrame(new_portfolios)
+        ticker_data_df = pd.DataFrame(ticker_data_dict)
+
+    # save the WARP surface over overlay weights and stock/bond splits from the returns already loaded
+    if save_warp_surface == True:
+        with span("warp surface"):
+            warp_sensitivity_surface(ticker_data_df, stock_df, bond_df,
+                                     risk_free_rate = risk_free_rate, financing_rate = financing_rate,
+                                     file_name = f"warp_surface_{base_portfolio_name}.npz")
 
     # Plot and save the plots if so requested
-    save_portfolio_cumulative_data_plots(
-                                    base_portfolio_name,
-                                    ticker_list,
-                                    selected_ticker_list,
-                                    risk_return_df,
-                                    new_risk_return_df,
-                                    base_portfolio_df,
-                                    new_portfolios,
-                                    save_plots)
-
-    return risk_return_df, new_risk_return_df, base_portfolio_df, new_portfolios_df
+    with span("cumulative returns and plots"):
+        cumulative_returns_tables = save_portfolio_cumulative_data_plots(
+                                        base_portfolio_name,
+                                        ticker_list,
+                                        selected_ticker_list,
+                                        risk_return_df,
+                                        new_risk_return_df,
+                                        base_portfolio_df,
+                                        new_portfolios,
+                                        save_plots)
+
+    tables = dict({'risk_return': risk_return_df,
+                   'new_risk_return': new_risk_return_df,
+                   'new_portfolios': new_portfolios_df,
+                   'ticker_data': ticker_data_df},
+                  **cumulative_returns_tables)
+    return tables, base_portfolio_df
+
+# diversify using the list of tickers provided relevant to a base portfolio
+def diversify_stocks_with_base_portfolio(
+                                    base_portfolio_name, ticker_list, selected_ticker_list, risk_free_rate, 
+                                    financing_rate, weight_asset, weight_base_portfolio,
+                                    weight_base_portfolio_stock, weight_base_portfolio_bond,
+                                    ticker_base_portfolio_stock, ticker_base_portfolio_bond,
+                                    start_date, end_date, save_plots, save_warp_surface = False,
+                                    max_workers = 8, provider = None, result_store = None, instrumentation = None,
+                                    session = None):
+    # instrumentation = Instrumentation, True or False, by default enabled by $PORTFOLIO_DIVERSIFIER_PROFILE
+    parameters = diversification_parameters(ticker_list, selected_ticker_list, risk_free_rate,
+                                            financing_rate, weight_asset, weight_base_portfolio,
+                                            weight_base_portfolio_stock, weight_base_portfolio_bond,
+                                            ticker_base_portfolio_stock, ticker_base_portfolio_bond,
+                                            start_date, end_date)
+    with instrumented_run(instrumentation, name = f"diversify {base_portfolio_name}"):
+        tables, base_portfolio_df = calculate_diversification(base_portfolio_name, save_plots = save_plots,
+                                                              save_warp_surface = save_warp_surface,
+                                                              max_workers = max_workers, provider = provider,
+                                                              session = session, **parameters)
+
+        # save the data frames for the UI and DASH once, as the latest run of this base portfolio and parameters
+        result_store = result_store if result_store is not None else ResultStore()
+        with span("result store write"):
+            result_store.write(base_portfolio_name, parameters, tables)
+
+    return tables['risk_return'], tables['new_risk_return'], base_portfolio_df, tables['new_portfolios']
 
 # calculate cumulative product of the ticker data
 def calculate_cumulative_product(ticker_list, new_ports, replacement_portfolio, replacement_portfolio_name):
@@ -570,7 +1164,7 @@ def calculate_cumulative_product(ticker_list, new_ports, replacement_portfolio,
     cumulative_returns_df.to_csv(f"cumulative_returns_{replacement_portfolio_name}.csv")
     return cumulative_returns_df
 
-# save portfolios cumulative data returns
+# calculate the portfolios cumulative returns and save their plots
 def save_portfolio_cumulative_data_plots(
                             base_portfolio_name, ticker_list, selected_ticker_list, risk_return_df,
                             new_risk_return_df, base_portfolio_df, new_portfolios, save_plot):
@@ -586,10 +1180,8 @@ def save_portfolio_cumulative_data_plots(
     cumulative_returns[base_portfolio_name] = (1 + base_portfolio_df).cumprod()
     #print(f"{cumulative_returns}")
 
-    # save the cumulative returns for the total time frame
+    # cumulative returns for the total time frame
     cumulative_returns_df = pd.DataFrame(cumulative_returns)
-    cumulative_returns_df.to_csv(f"cumulative_returns.csv")
-    cumulative_returns_df.to_csv(f"cumulative_returns_{base_portfolio_name}.csv")
     
     # save the plot if needed 
     if save_plot == True:
@@ -599,12 +1191,11 @@ def save_portfolio_cumulative_data_plots(
             ylabel = "Cumulative Return",
             height = 500,
             width = 1000)
-        hvplot.save(plot, "cumulative_returns.png")
+        with span("plot export", file = "cumulative_returns.png"):
+            hvplot.save(plot, "cumulative_returns.png")
 
-    # save the cumulative returns based on the selected ticker list
+    # cumulative returns based on the selected ticker list
     cumulative_returns_selected_df = cumulative_returns_df[selected_ticker_list + [base_portfolio_name]]
-    cumulative_returns_selected_df.to_csv(f"cumulative_returns_selected.csv")
-    cumulative_returns_selected_df.to_csv(f"cumulative_returns_selected_{base_portfolio_name}.csv")
 
     # save the plot if needed
     if save_plot == True:
@@ -614,12 +1205,11 @@ def save_portfolio_cumulative_data_plots(
             ylabel = "Cumulative Return",
             height = 500,
             width = 1000)
-        hvplot.save(plot, "cumulative_returns_selected.png")
+        with span("plot export", file = "cumulative_returns_selected.png"):
+            hvplot.save(plot, "cumulative_returns_selected.png")
 
-    # save the cumulative returns of the selected tickers from 2008 to 2009 (downturn period)
+    # cumulative returns of the selected tickers from 2008 to 2009 (downturn period)
     cumulative_returns_selected_2008_2009_df = cumulative_returns_selected_df.loc['01-01-2008':'12-31-2009']
-    cumulative_returns_selected_2008_2009_df.to_csv(f"cumulative_returns_selected_2008_2009.csv")
-    cumulative_returns_selected_2008_2009_df.to_csv(f"cumulative_returns_selected_2008_2009_{base_portfolio_name}.csv")
     
     # save the plot if needed
     if save_plot == True:
@@ -629,17 +1219,16 @@ def save_portfolio_cumulative_data_plots(
             ylabel = "Cumulative Return",
             height = 450,
             width = 900)
-        hvplot.save(plot, "cumulative_returns_selected_2008_2009.png")
+        with span("plot export", file = "cumulative_returns_selected_2008_2009.png"):
+            hvplot.save(plot, "cumulative_returns_selected_2008_2009.png")
 
-    # calculate and save the cumulative returns for 2020. 
+    # calculate the cumulative returns for 2020. 
     cumulative_returns_2020 = {}
     for ticker in ticker_list:
         cumulative_returns_2020[ticker] = (1 + new_portfolios[ticker].loc['01-01-2020':'12-31-2020']).cumprod()
     cumulative_returns_2020[base_portfolio_name] = (1 + base_portfolio_df).loc['01-01-2020':'12-31-2020'].cumprod()    
     cumulative_returns_2020_df = pd.DataFrame(cumulative_returns_2020)
     cumulative_returns_selected_2020_df = cumulative_returns_2020_df[selected_ticker_list + [base_portfolio_name]]
-    cumulative_returns_selected_2020_df.to_csv(f"cumulative_returns_selected_2020.csv")
-    cumulative_returns_selected_2020_df.to_csv(f"cumulative_returns_selected_2020_{base_portfolio_name}.csv")
     
     # save the plot if needed
     if save_plot == True:
@@ -649,17 +1238,16 @@ def save_portfolio_cumulative_data_plots(
             ylabel = "Cumulative Return",
             height = 450,
             width = 900)
-        hvplot.save(plot, "cumulative_returns_seleted_2008_2010.csv")
+        with span("plot export", file = "cumulative_returns_seleted_2008_2010.csv"):
+            hvplot.save(plot, "cumulative_returns_seleted_2008_2010.csv")
 
-    # Calculate and save the cumulative returns for 2010 to 2019 
+    # Calculate the cumulative returns for 2010 to 2019 
     cumulative_returns_2010_2019 = {}
     for ticker in ticker_list:
         cumulative_returns_2010_2019[ticker] = (1 + new_portfolios[ticker].loc['01-01-2010':'12-31-2019']).cumprod()
     cumulative_returns_2010_2019[base_portfolio_name] = (1 + base_portfolio_df).loc['01-01-2010':'12-31-2019'].cumprod()    
     cumulative_returns_2010_2019_df = pd.DataFrame(cumulative_returns_2010_2019)
     cumulative_returns_selected_2010_2019_df = cumulative_returns_2010_2019_df[selected_ticker_list + [base_portfolio_name]]
-    cumulative_returns_selected_2010_2019_df.to_csv(f"cumulative_returns_selected_2010_2019.csv")
-    cumulative_returns_selected_2010_2019_df.to_csv(f"cumulative_returns_selected_2010_2019_{base_portfolio_name}.csv")
     
     # save the plot if needed
     if save_plot == True:
@@ -669,7 +1257,15 @@ def save_portfolio_cumulative_data_plots(
             ylabel = "Cumulative Return",
             height = 450,
             width = 900)
-        hvplot.save(plot, "cumulative_returns_seleted_2008_2010.csv")
+        with span("plot export", file = "cumulative_returns_seleted_2008_2010.csv"):
+            hvplot.save(plot, "cumulative_returns_seleted_2008_2010.csv")
+
+    # the cumulative returns are stored with the other results of the run
+    return {'cumulative_returns': cumulative_returns_df,
+            'cumulative_returns_selected': cumulative_returns_selected_df,
+            'cumulative_returns_selected_2008_2009': cumulative_returns_selected_2008_2009_df,
+            'cumulative_returns_selected_2020': cumulative_returns_selected_2020_df,
+            'cumulative_returns_selected_2010_2019': cumulative_returns_selected_2010_2019_df}
 
 # Run the various calculations from command line for testing purpose
 def run_calculations():
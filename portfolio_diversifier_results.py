@@ -0,0 +1,267 @@
+'''
+portfolio_diversifier_results.py
+
+Versioned columnar store of the results of each diversification run
+
+'''
+
+# Import appropriate modules
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import datetime
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+import numpy as np
+import pandas as pd
+from portfolio_diversifier_instrumentation import count
+
+# Default location of the result store, can be set from the environment
+default_results_dir = os.environ.get("PORTFOLIO_DIVERSIFIER_RESULTS_DIR", "results")
+
+# Version of the layout of the stored results
+format_version = 1
+
+# One lock per results directory, so runs written by concurrent sessions of this process never lose manifest entries
+manifest_locks = {}
+manifest_locks_lock = threading.Lock()
+
+def manifest_lock(results_dir):
+    with manifest_locks_lock:
+        return manifest_locks.setdefault(os.path.abspath(results_dir), threading.Lock())
+
+# Convert a column into a numpy array that can be saved without pickling and memory mapped back
+def column_array(column):
+    values = column.values
+    if values.dtype.kind in "biuf":
+        return values, "numeric"
+    if values.dtype.kind == "M":
+        return column.values.astype("datetime64[ns]"), "datetime"
+    # columns filled cell by cell hold objects, keep them as numbers, dates or text
+    try:
+        return column.astype(float).values, "numeric"
+    except (TypeError, ValueError):
+        pass
+    if len(column) > 0 and all(isinstance(value, (datetime.date, pd.Timestamp)) for value in column.dropna()):
+        return pd.to_datetime(column).values.astype("datetime64[ns]"), "datetime"
+    return np.array([str(value) for value in column], dtype = str), "text"
+
+# Convert a stored array back into the values of a column
+def array_values(values, kind):
+    if kind == "datetime" and values.dtype.kind == "M":
+        return pd.DatetimeIndex(values)
+    return values
+
+# Save one data frame as one file per column plus its index
+def write_table(table_dir, table_df):
+    os.makedirs(table_dir)
+    columns = []
+    for position, (name, column) in enumerate(table_df.items()):
+        values, kind = column_array(column)
+        np.save(os.path.join(table_dir, f"{position}.npy"), values)
+        count("bytes_written", os.path.getsize(os.path.join(table_dir, f"{position}.npy")))
+        columns.append({"name": str(name), "file": f"{position}.npy", "kind": kind})
+    index_values, index_kind = column_array(table_df.index.to_series())
+    np.save(os.path.join(table_dir, "index.npy"), index_values)
+    count("bytes_written", os.path.getsize(os.path.join(table_dir, "index.npy")))
+    count("rows_written", int(table_df.shape[0]))
+    return {"columns": columns,
+            "index": {"name": table_df.index.name, "file": "index.npy", "kind": index_kind},
+            "rows": int(table_df.shape[0])}
+
+# Store of diversification results, one directory per base portfolio and parameters, one sub directory per version
+class ResultStore:
+    """Result Store: versioned columnar store of the data frames produced by a diversification run.
+    results_dir = directory holding the results (default results or $PORTFOLIO_DIVERSIFIER_RESULTS_DIR)
+    keep_versions = number of versions kept for each base portfolio and parameters (default 3)
+    max_runs = number of base portfolios and parameters kept, the least recently written are removed (default no limit)
+    Every column is a separate .npy file, so readers memory map only the columns they need.
+    manifest.json records each run by base portfolio name and parameters and which run is the latest.
+    A run is written to a temporary directory and moved into place before the manifest is replaced,
+    so readers never see a partial run."""
+
+    def __init__(self, results_dir = None, keep_versions = 3, max_runs = None):
+        self.results_dir = results_dir if results_dir is not None else default_results_dir
+        self.keep_versions = keep_versions
+        self.max_runs = max_runs
+
+    def manifest_path(self):
+        return os.path.join(self.results_dir, "manifest.json")
+
+    def manifest(self):
+        """The manifest of all stored runs"""
+        try:
+            with open(self.manifest_path()) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {"format_version": format_version, "latest": None, "runs": {}}
+
+    def write_manifest(self, manifest):
+        file_descriptor, temporary_path = tempfile.mkstemp(dir = self.results_dir, suffix = ".json.tmp")
+        with os.fdopen(file_descriptor, "w") as file:
+            json.dump(manifest, file, indent = 2, default = str)
+        os.replace(temporary_path, self.manifest_path())
+
+    @staticmethod
+    def run_key(base_portfolio_name, parameters):
+        """Key of the run, the base portfolio name followed by a digest of the parameters"""
+        digest = hashlib.sha1(json.dumps(parameters, sort_keys = True, default = str).encode()).hexdigest()
+        return f"{base_portfolio_name}_{digest[:12]}"
+
+    def write(self, base_portfolio_name, parameters, tables):
+        """Store the data frames of one run as a new version and make it the latest run
+        tables = dictionary of table name to data frame
+        Returns the key and version of the run."""
+        os.makedirs(self.results_dir, exist_ok = True)
+        with manifest_lock(self.results_dir):
+            return self.write_run(base_portfolio_name, parameters, tables)
+
+    def write_run(self, base_portfolio_name, parameters, tables):
+        key = self.run_key(base_portfolio_name, parameters)
+        manifest = self.manifest()
+        run = manifest["runs"].get(key, {"base_portfolio_name": base_portfolio_name,
+                                         "parameters": parameters,
+                                         "versions": {}})
+        version = max([int(number) for number in run["versions"]], default = 0) + 1
+
+        temporary_dir = tempfile.mkdtemp(dir = self.results_dir, prefix = f".{key}.")
+        try:
+            table_entries = {name: write_table(os.path.join(temporary_dir, name), table_df)
+                             for name, table_df in tables.items()}
+            os.makedirs(os.path.join(self.results_dir, key), exist_ok = True)
+            os.replace(temporary_dir, os.path.join(self.results_dir, key, f"v{version}"))
+        except BaseException:
+            shutil.rmtree(temporary_dir, ignore_errors = True)
+            raise
+
+        run["versions"][str(version)] = {"created": datetime.datetime.now().isoformat(timespec = "microseconds"),
+                                         "tables": table_entries}
+        # only the most recent versions are kept
+        for number in sorted(run["versions"], key = int)[:-self.keep_versions]:
+            del run["versions"][number]
+            shutil.rmtree(os.path.join(self.results_dir, key, f"v{number}"), ignore_errors = True)
+        manifest["runs"][key] = run
+        manifest["latest"] = {"key": key, "version": version}
+        if self.max_runs is not None:
+            runs_by_age = sorted(manifest["runs"], key = lambda key: max(entry["created"] for entry in
+                                                                        manifest["runs"][key]["versions"].values()))
+            excess = max(len(runs_by_age) - self.max_runs, 0)
+            for old_key in [old_key for old_key in runs_by_age if old_key != key][:excess]:
+                del manifest["runs"][old_key]
+                shutil.rmtree(os.path.join(self.results_dir, old_key), ignore_errors = True)
+        self.write_manifest(manifest)
+        return key, version
+
+    def locate(self, base_portfolio_name = None, parameters = None, version = None):
+        """Key and version of a stored run, the latest run if no base portfolio is given"""
+        manifest = self.manifest()
+        if base_portfolio_name is None:
+            if manifest["latest"] is None:
+                raise FileNotFoundError(f"No results stored in {self.results_dir}")
+            return manifest["latest"]["key"], manifest["latest"]["version"]
+        if parameters is not None:
+            keys = [self.run_key(base_portfolio_name, parameters)]
+        else:
+            keys = [key for key, run in manifest["runs"].items() if run["base_portfolio_name"] == base_portfolio_name]
+        keys = [key for key in keys if key in manifest["runs"]]
+        if len(keys) == 0:
+            raise FileNotFoundError(f"No results stored for '{base_portfolio_name}' in {self.results_dir}")
+        # without parameters the most recently created run of the base portfolio is used
+        key = max(keys, key = lambda key: max(entry["created"] for entry in manifest["runs"][key]["versions"].values()))
+        if version is None:
+            version = max(int(number) for number in manifest["runs"][key]["versions"])
+        return key, int(version)
+
+    def tables(self, base_portfolio_name = None, parameters = None, version = None):
+        """Names of the tables stored for a run"""
+        key, version = self.locate(base_portfolio_name, parameters, version)
+        return list(self.manifest()["runs"][key]["versions"][str(version)]["tables"])
+
+    def read(self, table, columns = None, base_portfolio_name = None, parameters = None, version = None):
+        """Read a table of a stored run, only the columns asked for are loaded
+        columns = names of the columns to load (default all)
+        The columns are memory mapped, the data frame returned is backed by the files where pandas allows it."""
+        key, version = self.locate(base_portfolio_name, parameters, version)
+        entry = self.manifest()["runs"][key]["versions"][str(version)]["tables"][table]
+        table_dir = os.path.join(self.results_dir, key, f"v{version}", table)
+
+        def load(column_entry):
+            return array_values(np.load(os.path.join(table_dir, column_entry["file"]), mmap_mode = "r"),
+                                column_entry["kind"])
+
+        selected = entry["columns"] if columns is None else [
+            column_entry for name in columns for column_entry in entry["columns"] if column_entry["name"] == name]
+        if columns is not None and len(selected) != len(columns):
+            missing = set(columns) - {column_entry["name"] for column_entry in selected}
+            raise KeyError(f"Columns {sorted(missing)} not stored in table '{table}'")
+        index = pd.Index(load(entry["index"]), name = entry["index"]["name"])
+        return pd.DataFrame({column_entry["name"]: load(column_entry) for column_entry in selected},
+                            index = index, copy = False)
+
+    def read_all(self, base_portfolio_name = None, parameters = None, version = None):
+        """Read every table of a stored run into a dictionary of table name to data frame"""
+        key, version = self.locate(base_portfolio_name, parameters, version)
+        return {table: self.read(table, None, base_portfolio_name, parameters, version)
+                for table in self.tables(base_portfolio_name, parameters, version)}
+
+# Bounded cache of the tables of diversification runs, keyed by base portfolio name and parameters
+class ResultCache:
+    """Result Cache: keeps the tables of the most recently used runs in memory, optionally backed by a result store.
+    max_entries = number of runs kept in memory, the least recently used are dropped (default 16)
+    disk_store = ResultStore used as a second, persistent tier (default none)
+    Callers asking for a run being calculated wait for that calculation instead of starting their own."""
+
+    def __init__(self, max_entries = 16, disk_store = None):
+        self.max_entries = max_entries
+        self.disk_store = disk_store
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, base_portfolio_name, parameters, calculate):
+        """Tables of the run, from memory, from the disk store or from calculate() as a last resort"""
+        key = ResultStore.run_key(base_portfolio_name, parameters)
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                count("result_cache_hits")
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            future = self.in_flight.get(key)
+            calculating = future is None
+            if calculating:
+                self.misses += 1
+                count("result_cache_misses")
+                future = Future()
+                self.in_flight[key] = future
+        if not calculating:
+            return future.result()
+
+        try:
+            tables = None
+            if self.disk_store is not None:
+                try:
+                    tables = self.disk_store.read_all(base_portfolio_name, parameters)
+                except FileNotFoundError:
+                    pass
+            if tables is None:
+                tables = calculate()
+                if self.disk_store is not None:
+                    self.disk_store.write(base_portfolio_name, parameters, tables)
+            with self.lock:
+                self.entries[key] = tables
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last = False)
+            future.set_result(tables)
+            return tables
+        except BaseException as ex:
+            future.set_exception(ex)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
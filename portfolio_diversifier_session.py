@@ -0,0 +1,141 @@
+'''
+portfolio_diversifier_session.py
+
+Choices and results of one client, so many clients can be served by one process
+
+'''
+
+# Import appropriate modules
+from portfolio_diversifier_ratios_and_calculations import diversify_stocks_with_base_portfolio
+from portfolio_diversifier_ratios_and_calculations import diversification_parameters, market_data_session
+from portfolio_diversifier_forecasting import forecast_diversified_portfolios
+from portfolio_diversifier_results import ResultStore
+
+# Tickers a client can choose from
+default_ticker_list = ["qqq", "lqd", "hyg", "tlt", "ief", "shy", "gld", "slv", "efa", "eem", "iyr", "xle", "xlk", "xlf"]
+
+# Tickers selected for a new client
+default_selected_ticker_list = ['shy', 'gld', 'tlt']
+
+# Stock/bond split recommended for each age band
+age_band_allocations = {"18 - 30": (0.80, 0.20),
+                        "30 - 50": (0.60, 0.40),
+                        "50 - 70": (0.40, 0.60),
+                        "> 70": (0.20, 0.80)}
+
+# Stock/bond split of each allocation a client can pick
+allocations = {"100% stocks": (1.00, 0.00),
+               "80% stocks - 20% bonds": (0.80, 0.20),
+               "60% stocks - 40% bonds": (0.60, 0.40),
+               "40% stocks - 60% bonds": (0.40, 0.60),
+               "20% stocks - 80% bonds": (0.20, 0.80),
+               "100% bonds": (0.00, 1.00)}
+
+# Everything one client chose and the results calculated for it
+class DiversifierSession:
+    """Diversifier Session: allocation, tickers, dates and cached results of one client.
+    ticker_list = tickers the client can choose from (default default_ticker_list), the list is copied
+    tickers = tickers selected (default default_selected_ticker_list), the list is copied
+    market_data = MarketDataSession the prices are read from, shared read only by all the sessions
+                  (default the shared market_data_session)
+    result_store = ResultStore the runs are saved to (default ResultStore())
+    The other parameters are those of diversify_stocks_with_base_portfolio.
+    A session is meant to be used by one thread at a time, sessions of different clients can run in parallel."""
+
+    def __init__(self, ticker_list = None, tickers = None,
+                 weight_base_portfolio_stock = 0.60, weight_base_portfolio_bond = 0.40,
+                 weight_diversifying_asset = 0.20, weight_base_portfolio = 0.80,
+                 risk_free_rate = 0.00, financing_rate = 0.00,
+                 ticker_base_portfolio_stock = 'spy', ticker_base_portfolio_bond = 'ief',
+                 start_date = '2008-01-01', end_date = '2020-12-31',
+                 market_data = None, result_store = None):
+        self.ticker_list = list(ticker_list if ticker_list is not None else default_ticker_list)
+        self.tickers = list(tickers if tickers is not None else default_selected_ticker_list)
+        self.weight_base_portfolio_stock = weight_base_portfolio_stock
+        self.weight_base_portfolio_bond = weight_base_portfolio_bond
+        self.weight_diversifying_asset = weight_diversifying_asset
+        self.weight_base_portfolio = weight_base_portfolio
+        self.risk_free_rate = risk_free_rate
+        self.financing_rate = financing_rate
+        self.ticker_base_portfolio_stock = ticker_base_portfolio_stock
+        self.ticker_base_portfolio_bond = ticker_base_portfolio_bond
+        self.start_date = start_date
+        self.end_date = end_date
+        self.market_data = market_data if market_data is not None else market_data_session
+        self.result_store = result_store if result_store is not None else ResultStore()
+        # results of the last calculation and the parameters they were calculated with
+        self.results = None
+        self.results_parameters = None
+
+    @property
+    def base_portfolio_name(self):
+        return f'stock_{self.weight_base_portfolio_stock * 100:.0f}_bond_{self.weight_base_portfolio_bond * 100:.0f}'
+
+    def set_allocation(self, weight_base_portfolio_stock, weight_base_portfolio_bond = None):
+        """Set the stock/bond split of the base portfolio, the bond gets the rest of the stock by default"""
+        if weight_base_portfolio_bond is None:
+            weight_base_portfolio_bond = 1.00 - weight_base_portfolio_stock
+        self.weight_base_portfolio_stock = weight_base_portfolio_stock
+        self.weight_base_portfolio_bond = weight_base_portfolio_bond
+
+    def set_age_band(self, age_band):
+        """Set the stock/bond split recommended for the age band, one of age_band_allocations"""
+        self.set_allocation(*age_band_allocations[age_band])
+
+    def available_tickers(self):
+        """Tickers of the ticker list not selected yet"""
+        return [ticker for ticker in self.ticker_list if ticker not in self.tickers]
+
+    def add_tickers(self, tickers):
+        self.tickers = self.tickers + [ticker for ticker in tickers if ticker not in self.tickers]
+
+    def remove_tickers(self, tickers):
+        self.tickers = [ticker for ticker in self.tickers if ticker not in tickers]
+
+    def parameters(self):
+        """Parameters identifying the run of this session in the result store"""
+        return diversification_parameters(self.tickers, self.tickers,
+                                          self.risk_free_rate, self.financing_rate,
+                                          self.weight_diversifying_asset, self.weight_base_portfolio,
+                                          self.weight_base_portfolio_stock, self.weight_base_portfolio_bond,
+                                          self.ticker_base_portfolio_stock, self.ticker_base_portfolio_bond,
+                                          self.start_date, self.end_date)
+
+    def calculate(self, save_plots = False):
+        """Calculate the ratios and returns of the diversified portfolios, unless they are already calculated
+        for the current choices. Returns the risk return, new risk return, base portfolio and new portfolios."""
+        parameters = self.parameters()
+        if self.results is None or self.results_parameters != parameters:
+            self.results = diversify_stocks_with_base_portfolio(self.base_portfolio_name, self.tickers, self.tickers,
+                                                                self.risk_free_rate, self.financing_rate,
+                                                                self.weight_diversifying_asset, self.weight_base_portfolio,
+                                                                self.weight_base_portfolio_stock,
+                                                                self.weight_base_portfolio_bond,
+                                                                self.ticker_base_portfolio_stock,
+                                                                self.ticker_base_portfolio_bond,
+                                                                self.start_date, self.end_date, save_plots,
+                                                                session = self.market_data,
+                                                                result_store = self.result_store)
+            self.results_parameters = parameters
+        return self.results
+
+    def risk_return(self, columns = None):
+        """Risk return table of the current choices, from this session or from the result store"""
+        if self.results is not None and self.results_parameters == self.parameters():
+            risk_return_df = self.results[0]
+            return risk_return_df if columns is None else risk_return_df[columns]
+        return self.result_store.read('risk_return', columns = columns,
+                                      base_portfolio_name = self.base_portfolio_name, parameters = self.parameters())
+
+    def forecast(self, **simulation_options):
+        """Monte Carlo forecast of the portfolio diversified with each selected ticker"""
+        forecast_diversified_portfolios(self.tickers,
+                                        self.ticker_base_portfolio_stock,
+                                        self.ticker_base_portfolio_bond,
+                                        self.weight_diversifying_asset,
+                                        self.weight_base_portfolio * self.weight_base_portfolio_stock,
+                                        self.weight_base_portfolio * self.weight_base_portfolio_bond,
+                                        self.start_date,
+                                        self.end_date,
+                                        session = self.market_data,
+                                        **simulation_options)
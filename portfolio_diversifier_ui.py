@@ -11,29 +11,11 @@ import fire
 import questionary
 from pathlib import Path
 import pandas as pd
-from portfolio_diversifier_ratios_and_calculations import diversify_stocks_with_base_portfolio
-from portfolio_diversifier_ratios_and_calculations import retrieve_yahoo_data_close
-from portfolio_diversifier_forecasting import execute_monte_carlo_simulation
-
-# Set the globals including tickers, ticker list, rates, portfolio weights and dates 
-ticker_list = ["qqq", "lqd", "hyg", "tlt", "ief", "shy", "gld", "slv", "efa", "eem", "iyr", "xle", "xlk", "xlf"]
-#selected_ticker_list = ['shy', 'gld', 'tlt']
-selected_ticker_list = ['shy', 'gld', 'tlt']
-tickers = selected_ticker_list
-risk_free_rate = 0.00
-financing_rate = 0.00
-weight_diversifying_asset = 0.20
-weight_base_portfolio = 0.80
-
-weight_base_portfolio_stock = 0.60
-weight_base_portfolio_bond  = 0.40
-ticker_base_portfolio_stock = 'spy'
-ticker_base_portfolio_bond  = 'ief'
-start_date = '2008-01-01'
-end_date = '2020-12-31'
-
-base_portfolio_df = pd.DataFrame()
-new_portfolios_df = pd.DataFrame()
+from portfolio_diversifier_results import ResultStore
+from portfolio_diversifier_session import DiversifierSession, age_band_allocations, allocations
+
+# The tickers, ticker list, rates, portfolio weights, dates and results of the client are kept in a
+# DiversifierSession passed to every function, so nothing here is shared between clients
 
 """ Function to decide main options"""
 def initial_action():
@@ -49,34 +31,21 @@ def initial_action():
     ).ask()
     return initial_action
 
-""" Functions to pull the ratios from CSV"""
+""" Functions to pull the ratios from the result store"""
 
-def load_ratios():
-    """Writes account information from CSV to list."""
-    csvpath = Path('./risk_return.csv')
+def load_ratios(session = None):
+    """Reads the ratios of the session (or of the latest run of the result store) into a list."""
+    ratio_columns = ["WARP", "+Sortino", "+Ret_To_MaxDD", "Sharpe", "Sortino", "Max_DD"]
+    if session is not None:
+        ratios_df = session.risk_return(columns = ratio_columns)
+    else:
+        ratios_df = ResultStore().read('risk_return', columns = ratio_columns)
     ratios = []
-    with open(csvpath, newline='') as csvfile:
-        rows = csv.reader(csvfile)
-        header = next(rows)
-        for row in rows:
-            ticker = str(row[0])
-            warp = float(row[3])
-            plus_sortino = float(row[4])
-            ret_to_maxdd = float(row[5])
-            sharpe = float(row[6])
-            sortino = float(row[7])
-            max_dd = float(row[8])
-            ratio = {
-                "ticker" : ticker,
-                "WARP" : warp,
-                "+Sortino" : plus_sortino,
-                "+Ret_To_MaxDD" : ret_to_maxdd,
-                "Sharpe" : sharpe,
-                "Sortino" : sortino,
-                "Max_DD" : max_dd,
-            }
-            ratios.append(ratio)
-        return ratios
+    for ticker, row in ratios_df.iterrows():
+        ratio = {"ticker" : str(ticker)}
+        ratio.update({column : float(row[column]) for column in ratio_columns})
+        ratios.append(ratio)
+    return ratios
 
 """ Functions to make a choice of ratio"""
 
@@ -90,12 +59,12 @@ def ratios_menu():
     return ratios_action
 
 """The function for running the ratios selected."""
-def run_ratios():
+def run_ratios(session):
 
     # Cleans the Dataframe
-    ratios_df = pd.DataFrame(load_ratios())
+    ratios_df = pd.DataFrame(load_ratios(session))
     ratios_df = ratios_df.set_index("ticker")
-    ratios_df_clean = ratios_df.loc[tickers]
+    ratios_df_clean = ratios_df.loc[[ticker for ticker in session.tickers if ticker in ratios_df.index]]
 
     # Initiates action based on selected ratios
     ratios_action = ratios_menu()
@@ -124,15 +93,15 @@ def run_ratios():
         )
 
 """Function that runs the code related to selecting ratios, including looping back in case more actions are needed"""
-def run_ratios_function():
+def run_ratios_function(session):
 
-    run_ratios()
+    run_ratios(session)
 
     question = questionary.confirm("Would you like to perform another action").ask()
 
     """Conditional to determine if the clients wants to do any additional actions"""
     if question == True:
-        run_final_function()
+        run_final_function(session)
     else:
         sys.exit(
         "Thank you for choosing our services"
@@ -149,20 +118,11 @@ def ticker_action():
     return ticker_action
 
 """ Function to either add ticker or remove"""
-def add_ticker():
-    
-    global tickers
-
-    # Cleans the Dataframe
-    ratios_df = pd.DataFrame(load_ratios())
-    ratios_df = ratios_df.set_index("ticker")
-    all_tickers = ticker_list
-    for ticker in tickers:
-        all_tickers.remove(ticker)
+def add_ticker(session):
 
     add_ticker_action = questionary.checkbox(
         "Which of the following tickers would you like to add?",
-        choices = (all_tickers)
+        choices = (session.available_tickers())
     ).ask()
 
     print(f"""
@@ -170,27 +130,22 @@ def add_ticker():
     return add_ticker_action
 
 # UI to add tickers and recalculate ratios and returns
-def run_add_tickers():
-
-    global tickers
+def run_add_tickers(session):
 
-    tickers_to_be_added = add_ticker()
-    for ticker in tickers_to_be_added:
-        tickers.append(ticker)
+    tickers_to_be_added = add_ticker(session)
+    session.add_tickers(tickers_to_be_added)
     print((f"""
     The new list of tickers is:
-    {tickers}"""))
-    calculate_ratios_and_returns_for_diversified_portfolio()
-    return(tickers)
+    {session.tickers}"""))
+    calculate_ratios_and_returns_for_diversified_portfolio(session)
+    return(session.tickers)
 
 # UI to remove tickers
-def remove_ticker():
-    
-    global tickers
+def remove_ticker(session):
 
     remove_ticker_action = questionary.checkbox(
         "Which of the following tickers would you like to remove?",
-        choices = (tickers)
+        choices = (session.tickers)
     ).ask()
 
     print(f"""
@@ -198,66 +153,51 @@ def remove_ticker():
     return remove_ticker_action
 
 # UI to remove tickers and re-calculate the ratios and returns
-def run_remove_tickers():
+def run_remove_tickers(session):
 
-    global tickers
-
-    tickers_to_be_remove = remove_ticker()
-    for ticker in tickers_to_be_remove:
-        tickers.remove(ticker)
+    tickers_to_be_remove = remove_ticker(session)
+    session.remove_tickers(tickers_to_be_remove)
     print(f"""
     The new list of tickers is:
-    {tickers}""")
-    calculate_ratios_and_returns_for_diversified_portfolio()
-    return(tickers)
+    {session.tickers}""")
+    calculate_ratios_and_returns_for_diversified_portfolio(session)
+    return(session.tickers)
 
 # Function to Allow add or remove of tickers 
-def run_add_and_remove_function():
+def run_add_and_remove_function(session):
 
     add_or_remove_action = ticker_action()
 
     if add_or_remove_action == "Add tickers":
-        run_add_tickers()
+        run_add_tickers(session)
     elif add_or_remove_action == "Remove tickers":
-        run_remove_tickers()
+        run_remove_tickers(session)
 
-    run_final_function()
+    run_final_function(session)
 
 
 # End function to run everything
-def run_final_function():
+def run_final_function(session):
 
     first_action = initial_action()
 
     if first_action == "Check financial ratios":
-        run_ratios_function()
+        run_ratios_function(session)
     elif first_action == "Forecast using Monte Carlo":
-        for ticker in tickers:
-            ticker_df = retrieve_yahoo_data_close(ticker, start_date, end_date)
-            base_stock_df = retrieve_yahoo_data_close(ticker_base_portfolio_stock, start_date, end_date)
-            base_bond_df = retrieve_yahoo_data_close(ticker_base_portfolio_bond, start_date, end_date)
-            daily_returns_df = pd.concat([ticker_df, base_stock_df, base_bond_df], axis=1)
-            daily_returns_df.columns = [ticker, ticker_base_portfolio_stock, ticker_base_portfolio_bond]
-            daily_returns_df.columns = pd.MultiIndex.from_product([daily_returns_df.columns, ['close']])
-            
-            execute_monte_carlo_simulation(	ticker,
-                                            daily_returns_df,
-                                            weight_diversifying_asset,
-                                            weight_base_portfolio * weight_base_portfolio_stock,
-                                            weight_base_portfolio * weight_base_portfolio_bond,
-                                            number_of_years = 5)
+        # close prices come from the market data of the session, each ticker is fetched only once per run
+        session.forecast(number_of_years = 5)
 
         file = open('selected_tickers.csv', 'w', newline = '\n')
         with file:
             writer = csv.writer(file)
-            writer.writerow(tickers)
+            writer.writerow(session.tickers)
 
         question = questionary.confirm("Would you like to perform another action").ask()
 
         """Conditional to determine if the clients wants to do any additional actions"""
     
         if question == True:
-            run_final_function()
+            run_final_function(session)
         else:
             sys.exit(
             "Thank you for choosing our services"
@@ -265,90 +205,43 @@ def run_final_function():
     elif first_action == 'Visualize results':
         sys.exit("Please type python <full path of the portfolio diversifier folder>/portfolio_diversifier_ui_dash_db.py on the command line")
     elif first_action == "Add/remove tickers":
-        run_add_and_remove_function()
+        run_add_and_remove_function(session)
     elif first_action == "Exit":
         sys.exit("Thank you for using our service")
 
 # Display the age menu and pre-select portfolio weights based on age
-def age_menu():
+def age_menu(session):
     "Dialog to select age"
-    global weight_base_portfolio_stock
-    global weight_base_portfolio_bond
 
     age_action = questionary.select(
         "Please select your age",
-        choices = ["18 - 30", "30 - 50", "50 - 70", "> 70"]
+        choices = list(age_band_allocations)
     ).ask()
 
-    if age_action == "18 - 30":
-        recommended_percent = "80% stocks - 20% bonds"
-        weight_base_portfolio_stock = 0.80
-        weight_base_portfolio_bond  = 0.20
-    elif age_action == "30 - 50":
-        recommended_percent = "60% stocks - 40% bonds"
-        weight_base_portfolio_stock = 0.60
-        weight_base_portfolio_bond  = 0.40
-    elif age_action == "50 - 70":
-        recommended_percent = "40% stocks - 60% bonds"
-        weight_base_portfolio_stock = 0.40
-        weight_base_portfolio_bond  = 0.60
-    elif age_action == "> 70":
-        recommended_percent = "20% stocks - 80% bonds"
-        weight_base_portfolio_stock = 0.20
-        weight_base_portfolio_bond  = 0.80
+    session.set_age_band(age_action)
+    recommended_percent = (f"{session.weight_base_portfolio_stock * 100:.0f}% stocks - "
+                           f"{session.weight_base_portfolio_bond * 100:.0f}% bonds")
 
     print(f"Based on your age we recomend a portfolio of {recommended_percent}")
 
     return age_action
 
 # Function that invokes main function to calculate ratios and returns 
-def calculate_ratios_and_returns_for_diversified_portfolio():
-    global base_portfolio_df
-    global new_portfolios_df
-    base_portfolio_name = f'stock_{weight_base_portfolio_stock * 100:.0f}_bond_{weight_base_portfolio_bond * 100:.0f}'
-    risk_return_df, new_risk_return_df, base_portfolio_df, new_portfolios_df = diversify_stocks_with_base_portfolio(
-                                        base_portfolio_name, selected_ticker_list, selected_ticker_list,
-                                        risk_free_rate, financing_rate, weight_diversifying_asset, weight_base_portfolio,
-                                        weight_base_portfolio_stock, weight_base_portfolio_bond,
-                                        ticker_base_portfolio_stock, ticker_base_portfolio_bond,
-                                        start_date, end_date, save_plots = False)
+def calculate_ratios_and_returns_for_diversified_portfolio(session):
+    return session.calculate(save_plots = False)
 
 # Function to display the allocation menu that allows you to change the portfolio weights
-def allocation_menu():
+def allocation_menu(session):
     "Dialog to select allocation"
-    global weight_base_portfolio_stock
-    global weight_base_portfolio_bond
 
     allocation_action = questionary.select(
         "Please select your portfolio allocation",
-        choices = [ "100% stocks",
-                    "80% stocks - 20% bonds",
-                    "60% stocks - 40% bonds",
-                    "40% stocks - 60% bonds",
-                    "20% stocks - 80% bonds",
-                    "100% bonds", 
-                    "Enter Manually"]
+        choices = list(allocations) + ["Enter Manually"]
     ).ask()
 
     # change portfolio weights based on the allocation
-    if allocation_action == "100% stocks":
-        weight_base_portfolio_stock = 1.00
-        weight_base_portfolio_bond  = 0.00
-    elif allocation_action == "80% stocks - 20% bonds":
-        weight_base_portfolio_stock = 0.80
-        weight_base_portfolio_bond  = 0.20
-    elif allocation_action == "60% stocks - 40% bonds":
-        weight_base_portfolio_stock = 0.60
-        weight_base_portfolio_bond  = 0.40
-    elif allocation_action == "40% stocks - 60% bonds":
-        weight_base_portfolio_stock = 0.40
-        weight_base_portfolio_bond  = 0.60
-    elif allocation_action == "20% stocks - 80% bonds":
-        weight_base_portfolio_stock = 0.20
-        weight_base_portfolio_bond  = 0.80
-    elif allocation_action == "100% bonds":
-        weight_base_portfolio_stock = 0.00
-        weight_base_portfolio_bond  = 1.00
+    if allocation_action in allocations:
+        session.set_allocation(*allocations[allocation_action])
     elif allocation_action == "Enter Manually":
         # if manual entry was selected - allow the user to enter the stock percentage and calculate bond
         # percentage based on it.
@@ -357,35 +250,34 @@ def allocation_menu():
             stock_percentage = float(stock_percentage)
             if stock_percentage >= 0.00 and stock_percentage <= 100.00:
                 print(f"Selecting  {stock_percentage:.02f}% stocks/{100.00-stock_percentage:.02f}% bonds")
-                weight_base_portfolio_stock = stock_percentage/100
-                weight_base_portfolio_bond = 1.00 - stock_percentage/100
+                session.set_allocation(stock_percentage/100)
             else:
                 print("Selecting the default 60/40 portfolio due to invalid entry")
-                weight_base_portfolio_stock = 0.60
-                weight_base_portfolio_bond  = 0.40
+                session.set_allocation(0.60, 0.40)
         except:
             print("Selecting the default 60/40 portfolio")
-            weight_base_portfolio_stock = 0.60
-            weight_base_portfolio_bond  = 0.40
+            session.set_allocation(0.60, 0.40)
     
     # re-calculate the ratios and returns for diversified portfolios
-    calculate_ratios_and_returns_for_diversified_portfolio()
-    run_final_function()
+    calculate_ratios_and_returns_for_diversified_portfolio(session)
+    run_final_function(session)
     return allocation_action
     
 
 """Function that runs the code related to allocation"""
-def run_age_function():
+def run_age_function(session = None):
+
+    session = session if session is not None else DiversifierSession()
 
-    age_menu()
+    age_menu(session)
 
     question = questionary.confirm("Would you like to modify this diversification?").ask()
 
     if question == True:
-        allocation_menu()
+        allocation_menu(session)
     else:
-        calculate_ratios_and_returns_for_diversified_portfolio()
-        run_final_function()
+        calculate_ratios_and_returns_for_diversified_portfolio(session)
+        run_final_function(session)
 
 # the main entry point for the program
 if __name__ == "__main__":
@@ -6,7 +6,11 @@ Author: Dylan Bowsky
 """
 
 # import appropriate modules
-import csv
+import time
+start_time = time.perf_counter()
+import glob
+import json
+import functools
 import dash
 import dash_core_components as dcc
 from dash_core_components.Dropdown import Dropdown
@@ -15,11 +19,14 @@ import dash_html_components as html
 import pandas as pd
 import plotly.express as px
 import dash_bootstrap_components as dbc
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State, MATCH
+from dash.exceptions import PreventUpdate
 import dash_table
 from pathlib import Path
 import os
 import sys
+from portfolio_diversifier_results import ResultStore, ResultCache, default_results_dir
+from portfolio_diversifier_downsampling import downsample_frame
 
 # get current directory
 cur_dir = os.getcwd()
@@ -32,95 +39,175 @@ def create_full_path(file_name):
     cur_full_path = os.path.join(cur_dir, file_name)
   return cur_full_path
 
-#Read risk return ratio with all mixes of Tickers 
-try:
-  risk_return = pd.read_csv(create_full_path("risk_return.csv"))
-  column_names = ['Tickers','Start Date','End Date','WARP','+Sortino','+Ret_To_MaxDD','Sharpe','Sortino','Max_DD']
-  risk_return.columns = column_names
-except:
-  sys.exit("Please run python portfolio_diviersifier_ui.py")
+# results of the latest run of the diversifier, only the columns plotted are loaded
+if os.path.isabs(default_results_dir):
+  result_store = ResultStore(default_results_dir)
+else:
+  result_store = ResultStore(create_full_path(default_results_dir))
+
+# runs calculated from the dashboard controls, kept in memory and on disk if $PORTFOLIO_DIVERSIFIER_DASH_CACHE_DIR is set
+dash_cache_dir = os.environ.get("PORTFOLIO_DIVERSIFIER_DASH_CACHE_DIR")
+result_cache = ResultCache(max_entries=16,
+                           disk_store=ResultStore(dash_cache_dir, keep_versions=1, max_runs=64) if dash_cache_dir else None)
+
+# Parameters shown when the dashboard opens if no run is stored yet, the same as the questionary UI
+default_parameters = {'ticker_list': ['shy', 'gld', 'tlt'], 'selected_ticker_list': ['shy', 'gld', 'tlt'],
+                      'risk_free_rate': 0.0, 'financing_rate': 0.0,
+                      'weight_asset': 0.2, 'weight_base_portfolio': 0.8,
+                      'weight_base_portfolio_stock': 0.6, 'weight_base_portfolio_bond': 0.4,
+                      'ticker_base_portfolio_stock': 'spy', 'ticker_base_portfolio_bond': 'ief',
+                      'start_date': '2008-01-01', 'end_date': '2020-12-31'}
+ticker_choices = ["qqq", "lqd", "hyg", "tlt", "ief", "shy", "gld", "slv", "efa", "eem", "iyr", "xle", "xlk", "xlf"]
+
+def base_portfolio_name_of(parameters):
+  return f"stock_{parameters['weight_base_portfolio_stock'] * 100:.0f}_bond_{parameters['weight_base_portfolio_bond'] * 100:.0f}"
+
+# Base portfolio name and parameters of the latest stored run, or None
+def stored_run():
+  manifest = result_store.manifest()
+  if manifest["latest"] is None:
+    return None
+  run = manifest["runs"][manifest["latest"]["key"]]
+  return run["base_portfolio_name"], run["parameters"]
+
+# Calculate a run from the parameters, the prices are fetched once per process by the calculation module
+def calculate_tables(base_portfolio_name, parameters):
+  from portfolio_diversifier_ratios_and_calculations import calculate_diversification
+  tables, base_portfolio_df = calculate_diversification(base_portfolio_name, **parameters)
+  return tables
+
+# Tables of the run with the parameters given as json, the stored run when it matches, the cache otherwise
+def run_tables(parameters_json):
+  parameters = json.loads(parameters_json)
+  stored = stored_run()
+  if stored is not None and stored[1] == parameters:
+    return memoized(result_store.read_all, result_store.manifest_path())
+  base_portfolio_name = base_portfolio_name_of(parameters)
+  return result_cache.get(base_portfolio_name, parameters, lambda: calculate_tables(base_portfolio_name, parameters))
 
 """Here are all the graphs we will be using for the dash
 as of now we currently have 3 categories with risk return ratio, cumulative return,
-and Forcasting using Monte Carlo. The Dataframes we are using are the ones created 
-by the csv files selected by the user this Dash gives an interactive look into the 
-possible returns for user"""
-
-risk_return.sort_values('WARP', inplace=True, ascending=False)
-fig_bar_warp = px.bar(risk_return,
- x="Tickers",y='WARP',
-  hover_data=["Tickers"],
-   title="Risk and return looking at only WARP Ratio", template='plotly_dark')
-risk_return.sort_values('Sharpe', inplace=True, ascending=False)
-fig_bar_sharpe = px.bar(risk_return,
- x="Tickers",y='Sharpe',
-  hover_data=["Tickers"], title="Risk and return looking at only Sharpe Ratio")
-
-risk_return.sort_values('Sortino', inplace=True, ascending=False)
-fig_bar_sortino = px.bar(risk_return,
- x="Tickers",y='Sortino',
-  hover_data=["Tickers"],
-   title="Risk and return looking at Sortino Ratio", template='plotly_dark')
-
-# Cumulative Returns
-# Read Cumulative returns of selected tickers and plot
-try:
-  cumulative_total= pd.read_csv(create_full_path('cumulative_returns_selected.csv'),index_col='Date')
-  fig_cumulative_total = px.line(cumulative_total,
-    title='Cumulative Returns since 2008 to 2020', template='plotly_dark')
-except:
-  sys.exit("Please run python portfolio_diviersifier_ui.py")
-
-# Read cumulative returns from 2010 to 2019 and plot  
-try: 
-  cumulative_bull= pd.read_csv(create_full_path('cumulative_returns_selected_2010_2019.csv'),index_col='Date')
-  fig_cumulative_bull = px.line(cumulative_bull,
-                            title='Cumulative returns would be in a bull market 2010-2019')
-except:
-  sys.exit("Please run python portfolio_diviersifier_ui.py")
-
-# Read cumulative returns from 2008 to 2009 and plot
-try:
-  cumulative_bear= pd.read_csv(create_full_path('cumulative_returns_selected_2008_2009.csv'), index_col='Date')
-  fig_cumulative_bear= px.line(cumulative_bear,
-  title='Cumulative Returns during a bear market 2008-2009', template='plotly_dark')
-except:
-  sys.exit("Please run python portfolio_diviersifier_ui.py")
-
-# Read cumulative returns from 2020 and plot
-try:
-  cumulative_2020= pd.read_csv(create_full_path('cumulative_returns_selected_2020.csv'), index_col='Date')
-  fig_cumulative_2020= px.line(cumulative_2020,
-    title='Cumulative Returns during Pandemic of 2020')
-except:
-  sys.exit("Please run python portfolio_diviersifier_ui.py")
-
-# Read tickers to be used for reading and displaying monte carlo simulations
-selected_tickers = []
-try:
-  file = open(create_full_path('selected_tickers.csv'), 'r', newline = '')
-  with file:
-    reader = csv.reader(file, delimiter=',')
-    for row in reader:
-      selected_tickers = selected_tickers + row
-except:
-  sys.exit("Please run python portfolio_diviersifier_ui.py and monte carlo simulations using forecast option")
-
-# Use tickers to read appropriate montecarlo files and set up the right tables
-i = 0
-for ticker in selected_tickers:
-  try:
-    globals()[f'mc_{ticker}_table'] = pd.read_csv(create_full_path(f"monte_carlo_simulation_table_{ticker}.csv"))
-  except:
-    sys.exit("Please run python portfolio_diviersifier_ui.py and monte carlo simulations using forecase option")
-  globals()[f'mc_{ticker}_table'].columns= ['type', 'value']
-  globals()[f'mc_{ticker}'] = pd.read_csv(create_full_path(f'monte_carlo_simulative_returns_{ticker}.csv'))
-  globals()[f'mc_{ticker}'].columns= ['Trading Days','mean','median','min','max']
-  globals()[f'mc_{ticker}'].set_index('Trading Days',inplace=True)
-  if i%2 == 0:
-    globals()[f'fig_mc_{ticker}'] = px.line(globals()[f'mc_{ticker}'], y=['max','min','mean','median'], template='plotly_dark')
-  else:
-    globals()[f'fig_mc_{ticker}'] = px.line(globals()[f'mc_{ticker}'], y=['max','min','mean','median'])
+and Forcasting using Monte Carlo. The Dataframes we are using are the ones stored 
+by the diversifier run selected by the user this Dash gives an interactive look into the 
+possible returns for user. The figures of a tab are only built when the tab is first shown
+and are kept until the results they come from change on disk"""
+
+missing_results_message = "Please run python portfolio_diviersifier_ui.py"
+missing_forecasts_message = "Please run python portfolio_diviersifier_ui.py and monte carlo simulations using forecast option"
+
+# line charts ship at most this many points per series to the browser, zooming in fetches the detail
+points_per_series = 500
+
+# Risk return ratio figures with all mixes of Tickers
+def build_risk_ratio_figures(parameters_json):
+  risk_return = run_tables(parameters_json)['risk_return'][['WARP','Sharpe','Sortino']].astype(float)
+  risk_return = risk_return.rename_axis('Tickers').reset_index()
+
+  risk_return.sort_values('WARP', inplace=True, ascending=False)
+  fig_bar_warp = px.bar(risk_return,
+   x="Tickers",y='WARP',
+    hover_data=["Tickers"],
+     title="Risk and return looking at only WARP Ratio", template='plotly_dark')
+  risk_return.sort_values('Sharpe', inplace=True, ascending=False)
+  fig_bar_sharpe = px.bar(risk_return,
+   x="Tickers",y='Sharpe',
+    hover_data=["Tickers"], title="Risk and return looking at only Sharpe Ratio")
+
+  risk_return.sort_values('Sortino', inplace=True, ascending=False)
+  fig_bar_sortino = px.bar(risk_return,
+   x="Tickers",y='Sortino',
+    hover_data=["Tickers"],
+     title="Risk and return looking at Sortino Ratio", template='plotly_dark')
+  return [fig_bar_warp, fig_bar_sharpe, fig_bar_sortino]
+
+# Cumulative Returns of selected tickers over the whole period, the bull market, the bear market and 2020,
+# each chart with its title and template
+cumulative_charts = {
+  'cumulative_returns_selected': ('Cumulative Returns since 2008 to 2020', 'plotly_dark'),
+  'cumulative_returns_selected_2010_2019': ('Cumulative returns would be in a bull market 2010-2019', None),
+  'cumulative_returns_selected_2008_2009': ('Cumulative Returns during a bear market 2008-2009', 'plotly_dark'),
+  'cumulative_returns_selected_2020': ('Cumulative Returns during Pandemic of 2020', None),
+}
+
+# Discover the tickers forecast so far from the monte carlo files on disk
+forecast_prefix = 'monte_carlo_simulative_returns_'
+
+def forecast_ticker(forecast_file):
+  return os.path.basename(forecast_file)[len(forecast_prefix):-len('.csv')]
+
+def forecast_files():
+  return sorted(glob.glob(create_full_path(f'{forecast_prefix}*.csv')))
+
+def forecast_tickers():
+  return [forecast_ticker(forecast_file) for forecast_file in forecast_files()]
+
+# Line charts are the cumulative return tables of the selected run and the forecast tickers
+def chart_source(chart):
+  if chart in cumulative_charts:
+    return result_store.manifest_path()
+  return create_full_path(f'{forecast_prefix}{chart}.csv')
+
+def chart_style(chart):
+  if chart in cumulative_charts:
+    return cumulative_charts[chart]
+  # alternate the templates of the forecast figures
+  i = forecast_tickers().index(chart) if chart in forecast_tickers() else 0
+  return f"Forecast of {chart}", 'plotly_dark' if i%2 == 0 else None
+
+# Daily data of a line chart at full resolution, the forecasts do not depend on the parameters
+def load_chart_data(chart, parameters_json):
+  if chart in cumulative_charts:
+    return run_tables(parameters_json)[chart]
+  mc_ticker = pd.read_csv(chart_source(chart))
+  mc_ticker.columns = ['Trading Days','mean','median','min','max']
+  mc_ticker.set_index('Trading Days',inplace=True)
+  return mc_ticker[['max','min','mean','median']]
+
+# Line chart downsampled to a bounded number of points per series, over the whole period or the zoomed x range
+def build_line_figure(chart, parameters_json, x_range = None):
+  chart_data = memoized(load_chart_data, chart_source(chart), chart, parameters_json)
+  if x_range is not None:
+    if isinstance(chart_data.index, pd.DatetimeIndex):
+      start, end = pd.Timestamp(x_range[0]), pd.Timestamp(x_range[1])
+    else:
+      start, end = float(x_range[0]), float(x_range[1])
+    chart_data = chart_data[(chart_data.index >= start) & (chart_data.index <= end)]
+  title, template = chart_style(chart)
+  points = downsample_frame(chart_data, points_per_series)
+  fig = px.line(points, x=points.columns[0], y='value', color='variable', title=title, template=template)
+  # keep the zoom of the user when the figure is replaced
+  fig.update_layout(uirevision=f"{chart} {parameters_json}")
+  if x_range is not None:
+    fig.update_xaxes(range=list(x_range), autorange=False)
+  return fig
+
+def line_graph(chart, parameters_json):
+  return dcc.Graph(id={'type': 'line-chart', 'index': chart},
+                   figure=memoized(build_line_figure, chart_source(chart), chart, parameters_json))
+
+# Built figures and loaded data are memoized by the file they come from and its modification time,
+# so switching back to a tab is free until the results are written again
+@functools.lru_cache(maxsize=64)
+def cached_results(builder, path, modified_time, *arguments):
+  return builder(*arguments)
+
+def memoized(builder, path, *arguments):
+  modified_time = os.path.getmtime(path) if os.path.exists(path) else None
+  return cached_results(builder, path, modified_time, *arguments)
+
+# Build the graphs of a tab for the parameters selected
+def tab_graphs(tab, parameters_json):
+  if tab == 'tab-1':
+    return [dcc.Graph(figure=figure)
+            for figure in memoized(build_risk_ratio_figures, result_store.manifest_path(), parameters_json)]
+  elif tab == 'tab-2':
+    return [line_graph(chart, parameters_json) for chart in cumulative_charts]
+  elif tab == 'tab-3':
+    tickers = forecast_tickers()
+    if len(tickers) == 0:
+      return [html.P(missing_forecasts_message)]
+    return [line_graph(ticker, None) for ticker in tickers]
+  return []
 
 
 #Creating the style of the Dashboard currently using a simple tab measure
@@ -191,58 +278,129 @@ dbc.Row(
 ],style={"height": "10vh"})
 
 
+# Controls of the run shown, they start from the latest stored run
+stored = stored_run()
+initial_parameters = stored[1] if stored is not None else default_parameters
+controls = dbc.Container([
+dbc.Row(
+            [
+            dbc.Col([html.Label("Stock share of the base portfolio (%)", style={"color": "white"}),
+                     dcc.Slider(id='stock_share', min=0, max=100, step=5,
+                                value=round(initial_parameters['weight_base_portfolio_stock'] * 100),
+                                marks={share: str(share) for share in range(0, 101, 20)})]),
+            dbc.Col([html.Label("Weight of the diversifying asset (%)", style={"color": "white"}),
+                     dcc.Slider(id='overlay_weight', min=0, max=50, step=5,
+                                value=round(initial_parameters['weight_asset'] * 100),
+                                marks={weight: str(weight) for weight in range(0, 51, 10)})]),
+            ]),
+dbc.Row(
+            [
+            dbc.Col([html.Label("Tickers", style={"color": "white"}),
+                     dcc.Dropdown(id='tickers', multi=True,
+                                  options=[{'label': ticker, 'value': ticker}
+                                           for ticker in dict.fromkeys(ticker_choices + initial_parameters['selected_ticker_list'])],
+                                  value=initial_parameters['selected_ticker_list'])]),
+            dbc.Col([html.Label("Date range", style={"color": "white"}),
+                     dcc.DatePickerRange(id='date_range',
+                                         start_date=initial_parameters['start_date'],
+                                         end_date=initial_parameters['end_date'],
+                                         display_format='YYYY-MM-DD')]),
+            ]),
+])
+
+# Values of the controls showing the parameters of a run
+def control_values_of(parameters):
+  return (round(parameters['weight_base_portfolio_stock'] * 100), round(parameters['weight_asset'] * 100),
+          list(parameters['selected_ticker_list']), parameters['start_date'], parameters['end_date'])
+
+# Parameters of the run from the controls, as json so they can key caches. Controls set back to the initial run
+# give its parameters unchanged, its ticker_list and off grid weights cannot be picked with the controls
+def parameters_json_of(stock_share, overlay_weight, tickers, start_date, end_date):
+  if (stock_share, overlay_weight, list(tickers), str(start_date)[:10], str(end_date)[:10]) == control_values_of(initial_parameters):
+    return json.dumps(initial_parameters, sort_keys=True)
+  parameters = dict(initial_parameters)
+  parameters.update({'ticker_list': list(tickers), 'selected_ticker_list': list(tickers),
+                     'weight_asset': round(overlay_weight / 100, 2),
+                     'weight_base_portfolio': round(1 - overlay_weight / 100, 2),
+                     'weight_base_portfolio_stock': round(stock_share / 100, 2),
+                     'weight_base_portfolio_bond': round(1 - stock_share / 100, 2),
+                     'start_date': str(start_date)[:10], 'end_date': str(end_date)[:10]})
+  return json.dumps(parameters, sort_keys=True)
+
 #clean up graph hover ticker
 app.layout = html.Div(id="output_container",
     children =[
         html.H1( body),
         html.P(body_sub),
+        controls,
+        dcc.Store(id='parameters', data=json.dumps(initial_parameters, sort_keys=True)),
         dcc.Tabs(id='tabs', value="tab-1",
          children=[
-             dcc.Tab(label="Risk Ratio Graphs and Data", children=[
-                 dcc.Graph(figure=fig_bar_warp),
-        html.Br(),
-        dcc.Graph(id="sharpe_ratio",
-            figure= fig_bar_sharpe),
-        dcc.Graph(
-            figure=fig_bar_sortino),
-            ] ),
-            dcc.Tab(label='Cumulative returns', value= 'tab-2', children=[
-                 dcc.Graph(figure=fig_cumulative_total),
-                 dcc.Graph(figure=fig_cumulative_bull),
-                 dcc.Graph(figure=fig_cumulative_bear),
-                 dcc.Graph(figure=fig_cumulative_2020),
-            ]),
-            dcc.Tab(label='Forcasting Results', value='tab-3', children=[
-          #     dash_table.DataTable(id='table',
-          #             columns=[{"name": 'type', "id": 'value'}],
-          #             data=mc_gld_table.to_dict(),
-          # ),
-          # Hard coded for now - future improvement is to dynamically load thse figures
-                dcc.Graph(figure=fig_mc_gld),
-                dcc.Graph(figure=fig_mc_shy),
-                dcc.Graph(figure=fig_mc_tlt),
-        ]),
-    ])
-         
+             dcc.Tab(label="Risk Ratio Graphs and Data", value='tab-1'),
+             dcc.Tab(label='Cumulative returns', value= 'tab-2'),
+             dcc.Tab(label='Forcasting Results', value='tab-3'),
+         ]),
+        # the graphs of the selected tab are built by the callback below
+        html.Div(id='tabs_content'),
     ]
 )
 
-# The dash application callback 
-@app.callback(Output('tabs_selection', 'children'),
-              Input('tabs', 'value'))
-def render_content(tab):
-    if tab == 'tab-1':
-        return html.Div([
-            html.H3('Tab content 1')
-        ])
-    elif tab == 'tab-2':
-        return html.Div([
-            html.H3('Tab content 2')
-            ])
-    elif tab == 'tab-3':
-        return html.Div([
-            html.H3('Tab content 3')
-        ])
+# time it took to import the modules and set up the application
+startup_time = time.perf_counter() - start_time
+print(f"Dash application ready in {startup_time:.3f} s")
+first_paint_reported = False
+
+# The controls select the parameters of the run shown, the store already holds the initial run when the page loads
+@app.callback(Output('parameters', 'data'),
+              Input('stock_share', 'value'),
+              Input('overlay_weight', 'value'),
+              Input('tickers', 'value'),
+              Input('date_range', 'start_date'),
+              Input('date_range', 'end_date'),
+              prevent_initial_call=True)
+def select_parameters(stock_share, overlay_weight, tickers, start_date, end_date):
+    if not tickers or start_date is None or end_date is None:
+        raise PreventUpdate
+    return parameters_json_of(stock_share, overlay_weight, tickers, start_date, end_date)
+
+# The dash application callback builds the graphs of the selected tab
+@app.callback(Output('tabs_content', 'children'),
+              Input('tabs', 'value'),
+              Input('parameters', 'data'))
+def render_content(tab, parameters_json):
+    global first_paint_reported
+    tab_start_time = time.perf_counter()
+    try:
+        graphs = tab_graphs(tab, parameters_json)
+    except (FileNotFoundError, KeyError):
+        graphs = [html.P(missing_results_message)]
+    except Exception as ex:
+        graphs = [html.P(f"Sorry, the diversification could not be calculated: {ex}")]
+    print(f"Tab {tab} built in {time.perf_counter() - tab_start_time:.3f} s")
+    if not first_paint_reported:
+        first_paint_reported = True
+        print(f"First tab served {time.perf_counter() - start_time:.3f} s after start")
+    return html.Div(graphs)
+
+# Zooming a line chart replaces it with the zoomed range at full detail, resetting the zoom restores the overview
+@app.callback(Output({'type': 'line-chart', 'index': MATCH}, 'figure'),
+              Input({'type': 'line-chart', 'index': MATCH}, 'relayoutData'),
+              State({'type': 'line-chart', 'index': MATCH}, 'id'),
+              State('parameters', 'data'),
+              prevent_initial_call=True)
+def zoom_line_chart(relayout_data, graph_id, parameters_json):
+    chart = graph_id['index']
+    parameters_json = parameters_json if chart in cumulative_charts else None
+    if relayout_data is None:
+        raise PreventUpdate
+    if 'xaxis.range[0]' in relayout_data:
+        return build_line_figure(chart, parameters_json,
+                                 (relayout_data['xaxis.range[0]'], relayout_data['xaxis.range[1]']))
+    if 'xaxis.range' in relayout_data:
+        return build_line_figure(chart, parameters_json, tuple(relayout_data['xaxis.range']))
+    if relayout_data.get('xaxis.autorange'):
+        return memoized(build_line_figure, chart_source(chart), chart, parameters_json)
+    raise PreventUpdate
  
  
  
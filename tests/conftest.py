@@ -0,0 +1,28 @@
+'''
+conftest.py
+
+Shared fixtures of the regression tests
+
+'''
+
+# Import appropriate modules
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+# the modules are top level scripts, make them importable from the tests
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Deterministic close prices of three stocks, in the layout MCSimulation reads
+@pytest.fixture
+def portfolio_data():
+    rng = np.random.default_rng(0)
+    index = pd.bdate_range('2015-01-01', periods = 500)
+    closes = {}
+    for ticker, (mean, std) in {'a': (4e-4, 1.2e-2), 'b': (3e-4, 1e-2), 'c': (1e-4, 4e-3)}.items():
+        closes[(ticker, 'close')] = 100 * np.cumprod(1 + rng.normal(mean, std, len(index)))
+    portfolio_data = pd.DataFrame(closes, index = index)
+    portfolio_data.columns = pd.MultiIndex.from_tuples(portfolio_data.columns)
+    return portfolio_data
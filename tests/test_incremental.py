@@ -0,0 +1,87 @@
+'''
+test_incremental.py
+
+Regression tests of the incremental daily update against a full recompute
+
+'''
+
+# Import appropriate modules
+import numpy as np
+import pandas as pd
+import pytest
+from portfolio_diversifier_benchmarks import synthetic_returns
+from portfolio_diversifier_ratios_and_calculations import BasePortfolio, calculate_risk_return, calculate_new_risk_return
+from portfolio_diversifier_incremental import IncrementalDiversifier
+
+parameters = {'ticker_base_portfolio_stock': 'stock', 'ticker_base_portfolio_bond': 'bond',
+              'risk_free_rate': 0.01, 'financing_rate': 0.02}
+
+# Daily returns of the base portfolio stock and bond, a full history ticker and a late-start ticker,
+# the first return of each history is missing as the market data session gives them
+@pytest.fixture
+def history():
+    index = pd.bdate_range('2005-01-03', periods = 1500)
+    def returns(values, start = 0):
+        returns = pd.Series(values[start:], index = index[start:])
+        returns.iloc[0] = np.nan
+        return returns
+    stock_returns, bond_returns = synthetic_returns(len(index), seed = 0)
+    asset_returns, late_returns = synthetic_returns(len(index), seed = 1)
+    return returns(stock_returns), returns(bond_returns), {'asset': returns(asset_returns), 'late': returns(late_returns, 600)}
+
+# Risk return tables calculated ticker by ticker over the whole history
+def full_recompute(stock_returns, bond_returns, returns_by_ticker):
+    base_portfolio = BasePortfolio.build(stock_returns, bond_returns, 0.60, 0.40, 0.01, 0.02, 252)
+    risk_return_df = pd.DataFrame(index = list(returns_by_ticker),
+                                  columns = ['Start Date', 'End Date', 'WARP', '+Sortino', '+Ret_To_MaxDD',
+                                             'Sharpe', 'Sortino', 'Max_DD'])
+    new_risk_return_df = pd.DataFrame(index = list(returns_by_ticker),
+                                      columns = ['Return', 'Vol', 'Sharpe', 'Sortino', 'Max_DD', 'Ret_To_MaxDD'])
+    for ticker, returns in returns_by_ticker.items():
+        risk_return_df.loc[ticker, 'Start Date'] = min(returns.index).date()
+        risk_return_df.loc[ticker, 'End Date'] = max(returns.index).date()
+        calculate_risk_return(ticker, returns, base_portfolio, 0.01, 0.02, 0.20, 0.80, 252, risk_return_df)
+        calculate_new_risk_return(ticker, returns, base_portfolio, 0.01, 0.02, 0.20, 0.80, 252,
+                                  risk_return_df, new_risk_return_df, {})
+    return risk_return_df, new_risk_return_df
+
+# the running statistics give the ratios of a full recompute
+def test_incremental_matches_full_recompute(history):
+    stock_returns, bond_returns, returns_by_ticker = history
+    diversifier = IncrementalDiversifier(list(returns_by_ticker), **parameters)
+    assert diversifier.append(stock_returns, bond_returns, returns_by_ticker) == len(stock_returns)
+    risk_return_df, new_risk_return_df = full_recompute(stock_returns, bond_returns, returns_by_ticker)
+
+    risk_return = diversifier.risk_return()
+    assert list(risk_return['Start Date']) == list(risk_return_df['Start Date'])
+    assert list(risk_return['End Date']) == list(risk_return_df['End Date'])
+    ratio_columns = ['WARP', '+Sortino', '+Ret_To_MaxDD', 'Sharpe', 'Sortino', 'Max_DD']
+    np.testing.assert_allclose(risk_return[ratio_columns].values, risk_return_df[ratio_columns].values.astype(float),
+                               rtol = 1e-9)
+    new_columns = list(new_risk_return_df.columns)
+    np.testing.assert_allclose(diversifier.new_risk_return()[new_columns].values,
+                               new_risk_return_df.values.astype(float), rtol = 1e-9)
+
+# a refresh adding the later days, also after saving and loading the state, gives the same numbers as one update
+def test_refresh_split_is_exact(history, tmp_path):
+    stock_returns, bond_returns, returns_by_ticker = history
+    whole = IncrementalDiversifier(list(returns_by_ticker), **parameters)
+    whole.append(stock_returns, bond_returns, returns_by_ticker)
+
+    split_date = stock_returns.index[1000]
+    before = lambda returns: returns[returns.index <= split_date]
+    split = IncrementalDiversifier(list(returns_by_ticker), **parameters)
+    split.append(before(stock_returns), before(bond_returns),
+                 {ticker: before(returns) for ticker, returns in returns_by_ticker.items()})
+    split.save(tmp_path / "state.npz")
+    split = IncrementalDiversifier.load(tmp_path / "state.npz")
+    # the refresh fetches from the last day already added, which is skipped
+    after = lambda returns: returns[returns.index >= split_date]
+    assert split.append(after(stock_returns), after(bond_returns),
+                        {ticker: after(returns) for ticker, returns in returns_by_ticker.items()}) == len(stock_returns) - 1001
+
+    pd.testing.assert_frame_equal(split.risk_return(), whole.risk_return())
+    pd.testing.assert_frame_equal(split.new_risk_return(), whole.new_risk_return())
+    # adding a day already added is refused
+    with pytest.raises(ValueError):
+        split.update(split_date, 0.0, 0.0, {})
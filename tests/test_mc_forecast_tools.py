@@ -0,0 +1,88 @@
+'''
+test_mc_forecast_tools.py
+
+Regression tests of the Monte Carlo simulation: worker independence, loop parity and streaming statistics
+
+'''
+
+# Import appropriate modules
+import numpy as np
+import pytest
+from MCForecastTools import MCSimulation, terminal_estimates, batch_standard_errors
+
+weights = [0.2, 0.48, 0.32]
+
+# Run a simulation of 60 trading days in small chunks
+def simulate(portfolio_data, **parameters):
+    simulation = MCSimulation(portfolio_data, weights, num_trading_days = 60, chunk_size = 100, **parameters)
+    simulation.calc_cumulative_return()
+    return simulation
+
+# the chunks are seeded and combined in order, so the number of workers never changes a result
+@pytest.mark.parametrize("parameters", [{}, {"streaming": True}, {"method": "stationary_bootstrap"},
+                                        {"variance_reduction": ["antithetic", "control_variate"]}])
+def test_results_do_not_depend_on_n_workers(portfolio_data, parameters):
+    single = simulate(portfolio_data, num_simulation = 450, seed = 7, n_workers = 1, **parameters)
+    parallel = simulate(portfolio_data, num_simulation = 450, seed = 7, n_workers = 3, **parameters)
+    if single.streaming:
+        np.testing.assert_array_equal(single.streamed_summary.mean, parallel.streamed_summary.mean)
+        np.testing.assert_array_equal(single.streamed_summary.m2, parallel.streamed_summary.m2)
+        np.testing.assert_array_equal(single.streamed_summary.sketch.quantile(0.5),
+                                      parallel.streamed_summary.sketch.quantile(0.5))
+    else:
+        np.testing.assert_array_equal(single.simulated_return.values, parallel.simulated_return.values)
+    np.testing.assert_array_equal(single.confidence_interval.values, parallel.confidence_interval.values)
+
+# the same seed gives the same paths, a different seed different ones
+def test_seed_reproduces_paths(portfolio_data):
+    first = simulate(portfolio_data, num_simulation = 200, seed = 3)
+    second = simulate(portfolio_data, num_simulation = 200, seed = 3)
+    other = simulate(portfolio_data, num_simulation = 200, seed = 4)
+    np.testing.assert_array_equal(first.simulated_return.values, second.simulated_return.values)
+    assert not np.array_equal(first.simulated_return.values, other.simulated_return.values)
+
+# the vectorized generator draws from the same distribution as the original loop (vectorized=False)
+def test_vectorized_matches_loop(portfolio_data):
+    np.random.seed(0)
+    loop = simulate(portfolio_data, num_simulation = 400, vectorized = False)
+    vectorized = simulate(portfolio_data, num_simulation = 4000, seed = 0)
+    assert loop.simulated_return.shape == (61, 400)
+    assert vectorized.simulated_return.shape == (61, 4000)
+    np.testing.assert_array_equal(loop.simulated_return.iloc[0].values, 1)
+    np.testing.assert_array_equal(vectorized.simulated_return.iloc[0].values, 1)
+
+    # final means agree within four standard errors, standard deviations within 15%
+    loop_final = loop.simulated_return.iloc[-1]
+    vectorized_final = vectorized.simulated_return.iloc[-1]
+    standard_error = np.sqrt(loop_final.var() / len(loop_final) + vectorized_final.var() / len(vectorized_final))
+    assert abs(loop_final.mean() - vectorized_final.mean()) < 4 * standard_error
+    assert abs(loop_final.std() / vectorized_final.std() - 1) < 0.15
+
+    # the daily standard deviations grow alike along the paths
+    np.testing.assert_allclose(loop.simulated_return.std(axis = 1).values[1:],
+                               vectorized.simulated_return.std(axis = 1).values[1:], rtol = 0.15)
+
+# streaming keeps running statistics equal to those of the paths kept in memory
+@pytest.mark.parametrize("parameters", [{}, {"variance_reduction": "control_variate"}])
+def test_streaming_matches_in_memory(portfolio_data, parameters):
+    in_memory = simulate(portfolio_data, num_simulation = 2000, seed = 11, **parameters)
+    streaming = simulate(portfolio_data, num_simulation = 2000, seed = 11, streaming = True, **parameters)
+    expected = in_memory.daily_statistics()
+    statistics = streaming.daily_statistics()
+    np.testing.assert_allclose(statistics["mean"], expected["mean"], rtol = 1e-12)
+    np.testing.assert_allclose(statistics["min"], expected["min"], rtol = 1e-12)
+    np.testing.assert_allclose(statistics["max"], expected["max"], rtol = 1e-12)
+    np.testing.assert_allclose(streaming.streamed_summary.std(), in_memory.simulated_return.std(axis = 1), rtol = 1e-9)
+    # the median and the confidence interval come from the quantile sketch
+    np.testing.assert_allclose(statistics["median"], expected["median"], rtol = 2e-3)
+    np.testing.assert_allclose(streaming.confidence_interval.values, in_memory.confidence_interval.values, rtol = 5e-3)
+
+    # the mean (with the control variate if enabled) is exact, and the batch means standard errors use the same chunks
+    np.testing.assert_allclose(streaming.terminal_estimates()["mean"], in_memory.terminal_estimates()["mean"], rtol = 1e-12)
+    batch_estimates = [terminal_estimates(in_memory.final_values[start:start + 100],
+                                          None if in_memory.controls is None else in_memory.controls[start:start + 100],
+                                          in_memory.control_mean)
+                       for start in range(0, 2000, 100)]
+    np.testing.assert_allclose(streaming.standard_error()["standard_error"].values,
+                               batch_standard_errors(batch_estimates).values, rtol = 1e-9)
+    assert streaming.simulated_return == ""
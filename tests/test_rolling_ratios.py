@@ -0,0 +1,79 @@
+'''
+test_rolling_ratios.py
+
+Regression tests of the linear time rolling ratios against the ratios of each window
+
+'''
+
+# Import appropriate modules
+import warnings
+import numpy as np
+import pandas as pd
+import pytest
+from portfolio_diversifier_ratios_and_calculations import sharpe_ratio, sortino_ratio, annualized_return
+from portfolio_diversifier_ratios_and_calculations import maximum_drawdown, return_maximum_drawdown_ratio
+from portfolio_diversifier_ratios_and_calculations import win_above_base_portfolio
+from portfolio_diversifier_ratios_and_calculations import rolling_sharpe_ratio, rolling_sortino_ratio
+from portfolio_diversifier_ratios_and_calculations import rolling_annualized_return, rolling_maximum_drawdown
+from portfolio_diversifier_ratios_and_calculations import rolling_return_maximum_drawdown_ratio, rolling_warp
+
+window = 60
+
+# Daily returns of two full history assets, a late-start asset and a base portfolio
+@pytest.fixture
+def returns_df():
+    rng = np.random.default_rng(1)
+    index = pd.bdate_range('2010-01-01', periods = 400)
+    returns_df = pd.DataFrame(rng.normal(3e-4, 0.01, (len(index), 4)), index = index,
+                              columns = ['asset', 'other', 'late', 'base'])
+    returns_df.iloc[:250, 2] = np.nan
+    return returns_df
+
+# Calculate a ratio of every trailing window of a column the slow way, NaN before the first whole window
+def per_window(function, returns):
+    result = pd.Series(np.nan, index = returns.index)
+    for end in range(window, len(returns) + 1):
+        result.iloc[end - 1] = function(returns.iloc[end - window:end])
+    return result
+
+# windows of full history columns match the ratios of each window
+@pytest.mark.parametrize("rolling_function, function", [
+    (rolling_sharpe_ratio, sharpe_ratio),
+    (rolling_sortino_ratio, sortino_ratio),
+    (lambda df, window: rolling_annualized_return(df, window), annualized_return),
+    (rolling_maximum_drawdown, maximum_drawdown),
+    (rolling_return_maximum_drawdown_ratio, return_maximum_drawdown_ratio)])
+def test_rolling_ratios_match_each_window(returns_df, rolling_function, function):
+    full_history = returns_df[['asset', 'other']]
+    result = rolling_function(full_history, window)
+    for column in full_history:
+        np.testing.assert_allclose(result[column], per_window(function, full_history[column]), rtol = 1e-9, atol = 1e-12)
+    # a series gives the column of a data frame
+    pd.testing.assert_series_equal(rolling_function(full_history['asset'], window), result['asset'], check_names = False)
+
+# a late-start column gives NaN, without warnings, until its windows hold enough returns
+def test_rolling_ratios_of_late_start_column(returns_df):
+    late = returns_df['late']
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        sharpe = rolling_sharpe_ratio(returns_df, window)['late']
+        sortino = rolling_sortino_ratio(returns_df, window)['late']
+        drawdown = rolling_maximum_drawdown(returns_df, window)['late']
+        growth = rolling_annualized_return(returns_df, window)['late']
+    # the first return of the late column is on row 250, sharpe needs two
+    assert sharpe.iloc[:251].isna().all() and sharpe.iloc[251:].notna().all()
+    assert sortino.iloc[:250].isna().all() and sortino.iloc[250:].notna().all()
+    assert drawdown.iloc[:250].isna().all() and drawdown.iloc[250:].notna().all()
+    assert growth.iloc[:250].isna().all() and growth.iloc[250:].notna().all()
+    # windows partly before the start use the returns they hold
+    np.testing.assert_allclose(sharpe.iloc[251:], per_window(lambda x: sharpe_ratio(x.dropna()), late).iloc[251:], rtol = 1e-9)
+    np.testing.assert_allclose(drawdown.iloc[250:], per_window(maximum_drawdown, late).iloc[250:], rtol = 1e-9, atol = 1e-12)
+
+# the rolling WARP of every asset matches win_above_base_portfolio of each window
+def test_rolling_warp_matches_each_window(returns_df):
+    assets, base = returns_df[['asset', 'other']], returns_df['base']
+    result = rolling_warp(assets, base, window, risk_free_rate = 0.01, financing_rate = 0.02)
+    for column in assets:
+        expected = per_window(lambda x: win_above_base_portfolio(x, base.loc[x.index], risk_free_rate = 0.01,
+                                                                 financing_rate = 0.02), assets[column])
+        np.testing.assert_allclose(result[column], expected, rtol = 1e-9)